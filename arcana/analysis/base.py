@@ -8,16 +8,16 @@ import os.path as op
 import types
 from copy import copy
 from logging import getLogger
-from nipype.interfaces.utility import IdentityInterface
 from arcana.pipeline import Pipeline
 from arcana.data import (
     BaseData, BaseInputMixin, BaseInputSpecMixin, FilesetFilter, FieldFilter,
     BaseFileset)
+from arcana.data.input import unique_fileset_matches
 from nipype.pipeline import engine as pe
 from .parameter import Parameter, SwitchSpec
-from arcana.repository.interfaces import RepositorySource
 from arcana.repository import Dataset
 from arcana.processor import SingleProc
+from arcana.processor.plan import ExecutionPlan
 from arcana.environment import StaticEnv
 from arcana.utils import get_class_info, wrap_text
 from arcana.exceptions import (
@@ -114,6 +114,15 @@ class Analysis(object):
         # Initialise caches for data slices and pipeline objects
         self._bound_specs = {}
         self._pipelines_cache = {}
+        # The environment and values of the parameters read by the
+        # constructor of each cached pipeline, which are checked before the
+        # cached pipeline is reused
+        self._pipeline_deps = {}
+        # Maps the names of outputs to the cached pipeline that produces them
+        self._output_pipelines = {}
+        # The parameters read by the pipeline constructor currently being
+        # called
+        self._params_read = None
         # Set parameters
         if parameters is None:
             parameters = {}
@@ -173,9 +182,60 @@ class Analysis(object):
                     raise ArcanaUsageError(
                         "Passed fileset ({}) as input to field spec {}"
                         .format(inpt, spec))
-        # "Bind" input selectors to the current analysis object, and attempt to
-        # match with data in the repository
-        input_errors = []
+        # Input selectors are "bound" to the current analysis object, and
+        # matched with data in the repository, on first access (see
+        # '_bound_input') so constructing the analysis doesn't require the
+        # repository to be queried
+        self._input_selectors = inputs
+        self._dropped_inputs = set()
+        self._enforce_inputs = enforce_inputs
+        # Check remaining specs are optional or have default values
+        for spec in self.data_specs():
+            if spec.name not in inputs:
+                self._check_missing_input(spec)
+
+    def _check_missing_input(self, spec):
+        """
+        Checks whether an acquired spec that hasn't been provided an input
+        (or whose input was dropped as it didn't match any data) is
+        optional or has a default value
+        """
+        if not spec.derived and spec.default is None:
+            # Emit a warning if an acquired fileset has not been
+            # provided for an "acquired fileset"
+            msg = (" input fileset '{}' was not provided to {}."
+                   .format(spec.name, self))
+            if spec.optional:
+                logger.info('Optional' + msg)
+            else:
+                if self._enforce_inputs:
+                    raise ArcanaMissingInputError(
+                        'Non-optional' + msg + " Pipelines depending "
+                        "on this fileset will not run")
+
+    def _bound_input(self, name):
+        """
+        Returns the input selector provided for a data spec bound to the
+        analysis, matching it against the data in the repository the first
+        time it is accessed
+
+        Parameters
+        ----------
+        name : str
+            Name of the data spec
+
+        Raises
+        ------
+        KeyError
+            If no input was provided for the spec or it was dropped as it
+            didn't match any data
+        """
+        try:
+            return self._inputs[name]
+        except KeyError:
+            if name in self._dropped_inputs:
+                raise
+            inpt = self._input_selectors[name]
         with self.dataset.repository:
             if not self.subject_ids:
                 raise ArcanaUsageError(
@@ -185,64 +245,55 @@ class Analysis(object):
                 raise ArcanaUsageError(
                     "No visit IDs provided and destination repository "
                     "is empty")
-            for inpt_name, inpt in list(inputs.items()):
-                try:
+            try:
+                bound_inpt = inpt.bind(self, spec_name=name)
+            except ArcanaInputMissingMatchError as e:
+                if not inpt.drop_if_missing:
+                    raise e
+                self._dropped_inputs.add(name)
+                self._check_missing_input(self.data_spec(name))
+                raise KeyError(name)
+            # if not any(f.exists for f in bound_inpt.slice):
+            #     raise ArcanaInputMissingMatchError(
+            #         "No {}s matched {}".format(
+            #             (inpt.SliceClass.SlicedClass.__name__
+            #              .lower()), inpt))
+            spec = self.data_spec(name)
+            if spec.is_fileset:
+                if spec.derived:
                     try:
-                        self._inputs[inpt_name] = bound_inpt = inpt.bind(
-                            self, spec_name=inpt_name)
-                    except ArcanaInputMissingMatchError as e:
-                        if not inpt.drop_if_missing:
-                            raise e
-                    else:
-                        # if not any(f.exists for f in bound_inpt.slice):
-                        #     raise ArcanaInputMissingMatchError(
-                        #         "No {}s matched {}".format(
-                        #             (inpt.SliceClass.SlicedClass.__name__
-                        #              .lower()), inpt))
-                        spec = self.data_spec(inpt_name)
-                        if spec.is_fileset:
-                            if spec.derived:
-                                try:
-                                    spec.format.converter_from(
-                                        bound_inpt.format)
-                                except ArcanaNoConverterError as e:
-                                    e.msg += (
-                                        ", which is requried to convert:\n"
-                                        + "{} to\n{}.").format(e, bound_inpt,
-                                                            spec)
-                                    raise e
-                            else:
-                                if (bound_inpt.format
-                                        not in spec.valid_formats):
-                                    raise ArcanaUsageError(
-                                        "Cannot pass {} as an input to {} as "
-                                        "it is not in one of the valid formats"
-                                        " ('{}')".format(
-                                            bound_inpt, spec,
-                                            "', '".join(
-                                                f.name
-                                                for f in spec.valid_formats)))
-                except ArcanaInputError as e:
-                    # Collate errors across all inputs into a single error
-                    # message
-                    input_errors.append(e)
+                        spec.format.converter_from(bound_inpt.format)
+                    except ArcanaNoConverterError as e:
+                        e.msg += (
+                            ", which is requried to convert:\n"
+                            + "{} to\n{}.").format(e, bound_inpt, spec)
+                        raise e
+                else:
+                    if bound_inpt.format not in spec.valid_formats:
+                        raise ArcanaUsageError(
+                            "Cannot pass {} as an input to {} as it is not in "
+                            "one of the valid formats ('{}')".format(
+                                bound_inpt, spec,
+                                "', '".join(
+                                    f.name for f in spec.valid_formats)))
+        self._inputs[name] = bound_inpt
+        return bound_inpt
+
+    def _bind_inputs(self):
+        """
+        Binds all inputs provided to the analysis that haven't been bound
+        yet, collating the errors across all inputs into a single error
+        """
+        input_errors = []
+        for name in self._input_selectors:
+            try:
+                self._bound_input(name)
+            except KeyError:
+                pass  # Dropped as it didn't match any data
+            except ArcanaInputError as e:
+                input_errors.append(e)
         if input_errors:
             raise ArcanaInputError('\n'.join(str(e) for e in input_errors))
-        # Check remaining specs are optional or have default values
-        for spec in self.data_specs():
-            if spec.name not in self.input_names:
-                if not spec.derived and spec.default is None:
-                    # Emit a warning if an acquired fileset has not been
-                    # provided for an "acquired fileset"
-                    msg = (" input fileset '{}' was not provided to {}."
-                           .format(spec.name, self))
-                    if spec.optional:
-                        logger.info('Optional' + msg)
-                    else:
-                        if enforce_inputs:
-                            raise ArcanaMissingInputError(
-                                'Non-optional' + msg + " Pipelines depending "
-                                "on this fileset will not run")
 
     def derive(self, name, subject_ids=None, visit_ids=None, session_ids=None,
                **kwargs):
@@ -368,10 +419,50 @@ class Analysis(object):
             all_data = all_data[0]
         return all_data
 
+    def plan(self, name, subject_ids=None, visit_ids=None, session_ids=None,
+             **kwargs):
+        """
+        Returns the plan of the pipelines and subject/visit nodes that would
+        be processed in order to derive the data associated with the provided
+        spec name(s), without running them. Takes the same arguments as
+        'derive'.
+
+        Returns
+        -------
+        plan : ExecutionPlan
+            The execution plan, which is displayed as a table when printed
+        """
+        (names, subject_ids, visit_ids, session_ids,
+         _, _, _, _, _, kwargs) = self._pluralise_names_and_ids(
+             name=name, subject_ids=subject_ids, visit_ids=visit_ids,
+             session_ids=session_ids, **kwargs)
+        pipelines, required_outputs = self._derivation_pipelines(names)
+        if not pipelines:
+            return ExecutionPlan()
+        return self.processor.plan(
+            *pipelines, subject_ids=subject_ids, visit_ids=visit_ids,
+            session_ids=session_ids, required_outputs=required_outputs,
+            **kwargs)
+
     def _derive(self, names, subject_ids, visit_ids, session_ids, **kwargs):
         """
         Internals of the dataset derivation
         """
+        pipelines, required_outputs = self._derivation_pipelines(names)
+        # Run required pipelines
+        if pipelines:
+            kwargs = copy(kwargs)
+            kwargs.update({'subject_ids': subject_ids,
+                           'visit_ids': visit_ids,
+                           'session_ids': session_ids})
+            kwargs['required_outputs'] = required_outputs
+            self.processor.run(*pipelines, **kwargs)
+
+    def _derivation_pipelines(self, names):
+        """
+        Returns the pipelines that need to be run to derive the data for the
+        given spec names along with the outputs required from each of them
+        """
         specs = [self.spec(n) for n in names]
         # Work out which pipelines need to be run
         pipeline_getters = defaultdict(set)
@@ -380,22 +471,17 @@ class Analysis(object):
                 # Add name of spec to set of required outputs
                 pipeline_getters[(spec.pipeline_getter,
                                   spec.pipeline_args)].add(spec.name)
-        # Run required pipelines
-        if pipeline_getters:
-            kwargs = copy(kwargs)
-            kwargs.update({'subject_ids': subject_ids,
-                           'visit_ids': visit_ids,
-                           'session_ids': session_ids})
-            try:
-                pipelines, required_outputs = zip(*(
-                    (self.pipeline(getter, pipeline_args=args), req_outs)
-                    for (getter, args), req_outs in pipeline_getters.items()))
-            except ArcanaError as e:
-                e.msg += ", in order to derive '{}'".format(
-                    "', '".join(names))
-                raise e
-            kwargs['required_outputs'] = required_outputs
-            self.processor.run(*pipelines, **kwargs)
+        if not pipeline_getters:
+            return (), ()
+        try:
+            pipelines, required_outputs = zip(*(
+                (self.pipeline(getter, pipeline_args=args), req_outs)
+                for (getter, args), req_outs in pipeline_getters.items()))
+        except ArcanaError as e:
+            e.msg += ", in order to derive '{}'".format(
+                "', '".join(names))
+            raise e
+        return pipelines, required_outputs
 
     def _pluralise_names_and_ids(self, name, subject_ids=None, visit_ids=None,
                                  session_ids=None, **kwargs):
@@ -452,7 +538,10 @@ class Analysis(object):
         """
         Returns a pipeline from a analysis by getting the method corresponding
         to the given name and checking that the required outputs are generated
-        given the parameters of the analysis
+        given the parameters of the analysis. Pipelines are cached between
+        runs and only regenerated if the values of the parameters read by the
+        constructor or the environment of the analysis change (or they are
+        removed with 'clear_pipelines')
 
         Parameters
         ----------
@@ -470,9 +559,19 @@ class Analysis(object):
             pipeline_args = tuple(pipeline_args.items())
         if required_outputs is None:
             required_outputs = ()
+        key = (getter_name, pipeline_args)
         try:
-            pipeline = self._pipelines_cache[(getter_name, pipeline_args)]
+            pipeline = self._pipelines_cache[key]
         except KeyError:
+            pipeline = None
+        else:
+            environment, params_read = self._pipeline_deps[key]
+            if environment is not self.environment or any(
+                    self._get_parameter(n).value != v
+                    for n, v in params_read.items()):
+                self._uncache_pipeline(key)
+                pipeline = None
+        if pipeline is None:
             try:
                 getter = getattr(self, getter_name)
             except AttributeError:
@@ -480,6 +579,8 @@ class Analysis(object):
                     "There is no pipeline constructor method named '{}' in "
                     "present in '{}' analysis".format(getter_name, self))
             self._pipeline_to_generate = getter_name
+            outer_params_read = self._params_read
+            self._params_read = params_read = {}
             try:
                 pipeline = getter(**dict(pipeline_args))
             except ArcanaMissingDataException as e:
@@ -491,6 +592,7 @@ class Analysis(object):
                 raise e
             finally:
                 self._pipeline_to_generate = None
+                self._params_read = outer_params_read
             if pipeline is None:
                 raise ArcanaDesignError(
                     "'{}' pipeline constructor in {} is missing return "
@@ -505,18 +607,25 @@ class Analysis(object):
             # generated pipelines (if two getter methods return equivalent
             # pipelines) and whether any outputs are to be generated twice
             # by different pipelines within the same workflow
-            for prev_pipeline in self._pipelines_cache.values():
+            for output_name in pipeline.output_names:
+                try:
+                    prev_pipeline = self._output_pipelines[output_name]
+                except KeyError:
+                    continue
                 if pipeline == prev_pipeline:
                     pipeline = prev_pipeline
                     break
-                elif any(o in prev_pipeline.outputs for o in pipeline.outputs):
+                else:
                     raise ArcanaDesignError(
                         "'{}' outputs are produced by more than one pipeline "
                         "({} and {})".format(
                             set(pipeline.output_names).intersection(
                                 prev_pipeline.output_names),
                             prev_pipeline, pipeline))
-            self._pipelines_cache[(getter_name, pipeline_args)] = pipeline
+            self._pipelines_cache[key] = pipeline
+            self._pipeline_deps[key] = (self.environment, params_read)
+            self._output_pipelines.update(
+                (o, pipeline) for o in pipeline.output_names)
         if required_outputs is not None:
             # Check that the required outputs are created with the given
             # parameters
@@ -672,11 +781,62 @@ class Analysis(object):
         """
         Called after a pipeline is run against the analysis to force an update
         of the derivatives that are now present in the repository if a
-        subsequent pipeline is run.
+        subsequent pipeline is run. Cached pipelines are reset so they can be
+        reused (see 'clear_pipelines' to regenerate them)
         """
         self.dataset.clear_cache()
         self._bound_specs = {}
-        self._pipelines_cache = {}
+        for pipeline in self._pipelines_cache.values():
+            pipeline.reset()
+
+    def clear_pipelines(self, *getter_names):
+        """
+        Removes pipelines from the cache so they are regenerated by their
+        constructors the next time they are requested
+
+        Parameters
+        ----------
+        getter_names : str
+            Names of the pipeline constructor methods to remove the pipelines
+            of. If none are provided all cached pipelines are removed
+        """
+        for key in list(self._pipelines_cache):
+            if not getter_names or key[0] in getter_names:
+                self._uncache_pipeline(key)
+
+    def pipeline_key(self, pipeline):
+        """
+        Returns the key a pipeline is cached under by 'pipeline', which can be
+        used to regenerate it (e.g. in a separate workflow or process)
+
+        Parameters
+        ----------
+        pipeline : Pipeline
+            A pipeline returned by 'pipeline'
+
+        Returns
+        -------
+        key : tuple(str, tuple[tuple[str, *]]) | None
+            The name of the constructor method and the arguments passed to it,
+            or None if the pipeline wasn't created by 'pipeline' (or has been
+            removed from the cache)
+        """
+        try:
+            return next(k for k, p in self._pipelines_cache.items()
+                        if p is pipeline)
+        except StopIteration:
+            return None
+
+    def _uncache_pipeline(self, key):
+        "Removes a pipeline from the cache and the index of its outputs"
+        pipeline = self._pipelines_cache.pop(key)
+        del self._pipeline_deps[key]
+        # Equivalent pipelines returned by different constructors are cached
+        # under each of their keys
+        if not any(p is pipeline for p in self._pipelines_cache.values()):
+            for output_name in pipeline.output_names:
+                if self._output_pipelines.get(output_name) is pipeline:
+                    del self._output_pipelines[output_name]
 
     @property
     def dataset(self):
@@ -692,15 +852,18 @@ class Analysis(object):
 
     @property
     def inputs(self):
-        return list(self._inputs.values())
+        self._bind_inputs()
+        return [self._inputs[n] for n in self._input_selectors
+                if n in self._inputs]
 
     @property
     def input_names(self):
-        return list(self._inputs.keys())
+        self._bind_inputs()
+        return [n for n in self._input_selectors if n in self._inputs]
 
     def input(self, name):
         try:
-            return self._inputs[name]
+            return self._bound_input(name)
         except KeyError:
             raise ArcanaNameError(
                 name,
@@ -709,6 +872,7 @@ class Analysis(object):
 
     @property
     def missing_inputs(self):
+        self._bind_inputs()
         return (n for n in self.acquired_data_spec_names()
                 if n not in self._inputs)
 
@@ -826,6 +990,8 @@ class Analysis(object):
                     .format(
                         name, self._param_error_location,
                         "', '".join(self.param_spec_names())))
+        if self._params_read is not None:
+            self._params_read[name] = parameter.value
         return parameter
 
     def parameter(self, name):
@@ -988,7 +1154,7 @@ class Analysis(object):
         if isinstance(name, BaseData):
             name = name.name
         try:
-            bound = self._inputs[name]
+            bound = self._bound_input(name)
         except KeyError:
             # Get the spec from the class
             spec = self.data_spec(name)
@@ -1090,28 +1256,30 @@ class Analysis(object):
         "Lists the names of acquired data_specs defined in the analysis"
         return (c.name for c in cls.acquired_data_specs())
 
-    def cache_inputs(self):
+    def cache_inputs(self, num_threads=4, show_progress=True):
         """
-        Runs the Analysis's repository source node for each of the inputs
-        of the analysis, thereby caching any data required from remote
+        Retrieves the filesets matched by each of the inputs of the analysis
+        into the local cache, thereby caching any data required from remote
         repositorys. Useful when launching many parallel jobs that will
         all try to concurrently access the remote repository, and probably
         lead to timeout errors.
+
+        Parameters
+        ----------
+        num_threads : int
+            The maximum number of filesets to retrieve concurrently
+        show_progress : bool
+            Whether to display a progress bar
+
+        Returns
+        -------
+        failed : list[tuple[Fileset, Exception]]
+            The filesets that couldn't be retrieved and the exception that
+            was raised for each
         """
-        workflow = pe.Workflow(name='cache_download',
-                               base_dir=self.processor.work_dir)
-        subjects = pe.Node(IdentityInterface(['subject_id']), name='subjects',
-                           environment=self.environment)
-        sessions = pe.Node(IdentityInterface(['subject_id', 'visit_id']),
-                           name='sessions', environment=self.environment)
-        subjects.iterables = ('subject_id', tuple(self.subject_ids))
-        sessions.iterables = ('visit_id', tuple(self.visit_ids))
-        source = pe.Node(RepositorySource(
-            self.bound_spec(i).slice for i in self.inputs), name='source')
-        workflow.connect(subjects, 'subject_id', sessions, 'subject_id')
-        workflow.connect(sessions, 'subject_id', source, 'subject_id')
-        workflow.connect(sessions, 'visit_id', source, 'visit_id')
-        workflow.run()
+        return self.dataset.cache_filesets(
+            unique_fileset_matches(self.bound_spec(i) for i in self.inputs),
+            num_threads=num_threads, show_progress=show_progress)
 
     @classmethod
     def print_specs(cls):
@@ -95,8 +95,11 @@ class MultiAnalysis(Analysis):
             mapped_inputs = {}
             for data_name in subcomp_cls.data_spec_names():
                 mapped_name = subcomp_spec.map(data_name)
-                if mapped_name in self.input_names:
-                    mapped_inputs[data_name] = self.input(mapped_name)
+                if mapped_name in self._input_selectors:
+                    # Passed unbound so they are only matched against the
+                    # repository when accessed by the sub-analysis
+                    mapped_inputs[data_name] = self._input_selectors[
+                        mapped_name]
                 else:
                     try:
                         inpt = self.spec(mapped_name)
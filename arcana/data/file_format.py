@@ -7,7 +7,8 @@ from arcana.exceptions import (
     ArcanaNameError)
 from nipype.interfaces.utility import IdentityInterface
 from arcana.utils.interfaces import (
-    ZipDir, UnzipDir, TarGzDir, UnTarGzDir)
+    InProcessZipDir, InProcessUnzipDir, InProcessTarGzDir,
+    InProcessUnTarGzDir)
 from arcana.utils import split_extension
 import logging
 
@@ -441,7 +442,7 @@ class IdentityConverter(Converter):
 
 class UnzipConverter(Converter):
 
-    interface = UnzipDir()
+    interface = InProcessUnzipDir()
     mem_gb = 12
     input = 'zipped'
     output = 'unzipped'
@@ -449,7 +450,7 @@ class UnzipConverter(Converter):
 
 class ZipConverter(Converter):
 
-    interface = ZipDir()
+    interface = InProcessZipDir()
     mem_gb = 12
     input = 'dirname'
     output = 'zipped'
@@ -457,7 +458,7 @@ class ZipConverter(Converter):
 
 class TarGzConverter(Converter):
 
-    interface = TarGzDir()
+    interface = InProcessTarGzDir()
     mem_gb = 12
     input = 'dirname'
     output = 'zipped'
@@ -465,7 +466,7 @@ class TarGzConverter(Converter):
 
 class UnTarGzConverter(Converter):
 
-    interface = UnTarGzDir()
+    interface = InProcessUnTarGzDir()
     mem_gb = 12
     input = 'gzipped'
     output = 'gunzipped'
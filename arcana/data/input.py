@@ -3,6 +3,13 @@ from past.builtins import basestring
 import re
 from copy import copy
 from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import re._parser as sre_parse
+    import re._constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_constants
 from arcana.exceptions import (
     ArcanaUsageError, ArcanaInputError,
     ArcanaInputMissingMatchError, ArcanaNotBoundToAnalysisError)
@@ -11,6 +18,39 @@ from .item import Fileset, Field
 from .slice import FilesetSlice, FieldSlice
 
 
+def unique_fileset_matches(inputs):
+    """
+    Collects the existing filesets matched by each of the bound fileset
+    inputs, dropping duplicates that are matched by more than one input so
+    each is only retrieved once
+
+    Parameters
+    ----------
+    inputs : iterable[FilesetFilter | FieldFilter]
+        Bound inputs of an analysis. Non-fileset inputs are ignored
+
+    Returns
+    -------
+    filesets : list[Fileset]
+        The unique filesets matched by the inputs
+    """
+    filesets = []
+    keys = set()
+    for inpt in inputs:
+        if not inpt.is_fileset:
+            continue
+        for fileset in inpt.slice:
+            if not fileset.exists:
+                continue
+            key = (fileset.dataset, fileset.frequency, fileset.subject_id,
+                   fileset.visit_id, fileset.from_analysis, fileset.id,
+                   fileset.format_name)
+            if key not in keys:
+                keys.add(key)
+                filesets.append(fileset)
+    return filesets
+
+
 class BaseInputMixin(object):
     """
     Base class for Fileset and Field Input classes
@@ -39,6 +79,11 @@ class BaseInputMixin(object):
         # except when recreating when using initkwargs
         self._analysis = analysis_
         self._slice = slice_
+        # The compiled pattern and the results of matching it against each
+        # name in the tree, which are shared across all nodes
+        self._pattern_re = None
+        self._pattern_prefix = None
+        self._name_matches = {}
 
     def __eq__(self, other):
         return (self.from_analysis == other.from_analysis
@@ -149,6 +194,61 @@ class BaseInputMixin(object):
     def order(self):
         return self._order
 
+    @property
+    def pattern_re(self):
+        "The pattern compiled into a regular expression"
+        if self._pattern_re is None:
+            self._pattern_re = re.compile(self.pattern)
+        return self._pattern_re
+
+    @property
+    def pattern_prefix(self):
+        """
+        The literal prefix that all names matching the pattern must start
+        with, which is used to narrow down the candidate names in each node
+        before the regular expression is applied. Empty if the pattern doesn't
+        start with a literal or is case-insensitive
+        """
+        if self._pattern_prefix is None:
+            prefix = ''
+            if not self.is_regex:
+                prefix = self.pattern
+            elif not self.pattern_re.flags & re.IGNORECASE:
+                for op, arg in sre_parse.parse(self.pattern,
+                                               self.pattern_re.flags):
+                    if op != sre_constants.LITERAL:
+                        break
+                    prefix += chr(arg)
+            self._pattern_prefix = prefix
+        return self._pattern_prefix
+
+    def matching_names(self, names):
+        """
+        Selects the names of the items in a node that match the pattern
+
+        Parameters
+        ----------
+        names : iterable[str]
+            The distinct names of the items in the node
+
+        Returns
+        -------
+        matching : list[str]
+            The names that match the pattern
+        """
+        if not self.is_regex:
+            return [self.pattern] if self.pattern in names else []
+        matching = []
+        for name in names:
+            try:
+                is_match = self._name_matches[name]
+            except KeyError:
+                is_match = self._name_matches[name] = bool(
+                    self.pattern_re.match(name))
+            if is_match:
+                matching.append(name)
+        return matching
+
     def bind(self, analysis, spec_name=None, **kwargs):
         if spec_name is None:
             spec_name = self.spec_name
@@ -209,13 +309,46 @@ class BaseInputMixin(object):
             assert False, "Unrecognised frequency '{}'".format(self.frequency)
         return nodes
 
-    def _match(self, tree, item_cls, **kwargs):
+    def _match(self, tree, item_cls, num_threads=None, **kwargs):
+        """
+        Matches the input against each node of the tree. As matching file
+        formats can involve checking the file-system (or downloading headers)
+        the nodes are matched in a pool of threads, and the results are
+        collated in the order of the nodes
+
+        Parameters
+        ----------
+        tree : Tree
+            The tree to match against
+        item_cls : type
+            The class of the placeholder items for missing matches
+        num_threads : int | None
+            The number of threads to match the nodes with. If None the
+            default of ThreadPoolExecutor is used, if 1 the nodes are matched
+            serially
+        """
+        nodes = list(self.nodes(tree))
+
+        def match_node(node):
+            try:
+                return self.match_node(node, **kwargs)
+            except ArcanaInputError as e:
+                return e
+
+        if len(nodes) > 1 and num_threads != 1:
+            with ThreadPoolExecutor(num_threads) as executor:
+                results = list(executor.map(match_node, nodes))
+        else:
+            results = [match_node(n) for n in nodes]
         matches = []
         errors = []
-        for node in self.nodes(tree):
+        # Fallbacks are resolved serially as they bind the default spec
+        for node, result in zip(nodes, results):
             try:
                 try:
-                    matches.append(self.match_node(node, **kwargs))
+                    if isinstance(result, ArcanaInputError):
+                        raise result
+                    matches.append(result)
                 except ArcanaInputMissingMatchError as e:
                     if self._fallback is not None:
                         matches.append(self._fallback.slice.item(
@@ -446,15 +579,23 @@ class FilesetFilter(BaseInputMixin, BaseFileset):
     def dicom_tags(self):
         return self._dicom_tags
 
-    def _filtered_matches(self, node, valid_formats=None, **kwargs):  # noqa: E501 @UnusedVariable
+    def match_node(self, node, **kwargs):
+        # The formats detected while filtering the matches are recorded so
+        # they don't need to be detected again when the slice is created
+        detected_formats = {}
+        match = BaseInputMixin.match_node(
+            self, node, detected_formats=detected_formats, **kwargs)
+        format = detected_formats.get(id(match))
+        if match.format is None and format is not None:
+            match = copy(match)
+            match.format = format
+        return match
+
+    def _filtered_matches(self, node, valid_formats=None,
+                          detected_formats=None, **kwargs):  # noqa: E501 @UnusedVariable
         if self.pattern is not None:
-            if self.is_regex:
-                pattern_re = re.compile(self.pattern)
-                matches = [f for f in node.filesets
-                           if pattern_re.match(f.basename)]
-            else:
-                matches = [f for f in node.filesets
-                           if f.basename == self.pattern]
+            matches = node.filesets_named(self.matching_names(
+                node.fileset_names_with_prefix(self.pattern_prefix)))
         else:
             matches = list(node.filesets)
         if not matches:
@@ -483,8 +624,14 @@ class FilesetFilter(BaseInputMixin, BaseFileset):
                         '\n    '.join(str(m) for m in matches), node))
             matches = filtered
         if valid_formats is not None:
-            format_matches = [
-                m for m in matches if any(f.matches(m) for f in valid_formats)]
+            format_matches = []
+            for m in matches:
+                # The first matching format is the one the slice would detect
+                format = next((f for f in valid_formats if f.matches(m)), None)
+                if format is not None:
+                    format_matches.append(m)
+                    if detected_formats is not None:
+                        detected_formats[id(m)] = format
             if not format_matches:
                 for f in matches:
                     self.format.matches(f)
@@ -628,13 +775,8 @@ class FieldFilter(BaseInputMixin, BaseField):
         return dct
 
     def _filtered_matches(self, node, **kwargs):
-        if self.is_regex:
-            pattern_re = re.compile(self.pattern)
-            matches = [f for f in node.fields
-                       if pattern_re.match(f.name)]
-        else:
-            matches = [f for f in node.fields
-                       if f.name == self.pattern]
+        matches = node.fields_named(self.matching_names(
+            node.field_names_with_prefix(self.pattern_prefix)))
         if self.from_analysis is not None:
             matches = [f for f in matches
                        if f.from_analysis == self.from_analysis]
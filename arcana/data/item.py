@@ -2,8 +2,7 @@ from past.builtins import basestring
 import os
 from itertools import chain
 import os.path as op
-import hashlib
-from arcana.utils import split_extension, parse_value
+from arcana.utils import split_extension, parse_value, file_md5
 from arcana.exceptions import (
     ArcanaError, ArcanaFileFormatError, ArcanaUsageError, ArcanaNameError,
     ArcanaDataNotDerivedYetError)
@@ -370,8 +369,13 @@ class Fileset(BaseItemMixin, BaseFileset):
                     "('{}')".format("', '".join(aux_files.keys()),
                                     "', '".join(self.format.aux_files.keys())))
             self._aux_files = aux_files
-        self._checksums = self.calculate_checksums()
-        self.put()  # Push to dataset
+        self._checksums = None
+        # Push to dataset. Repositories that read the files while storing them
+        # return the checksums so they don't need to be read again
+        checksums = self.put()
+        if checksums is None:
+            checksums = self.calculate_checksums()
+        self._checksums = checksums
 
     @path.setter
     def path(self, path):
@@ -487,13 +491,10 @@ class Fileset(BaseItemMixin, BaseFileset):
     def calculate_checksums(self):
         checksums = {}
         for fpath in self.paths:
-            fhash = hashlib.md5()
-            with open(fpath, 'rb') as f:
-                # Calculate hash in chunks so we don't run out of memory for
-                # large files.
-                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
-                    fhash.update(chunk)
-            checksums[op.relpath(fpath, self.path)] = fhash.hexdigest()
+            # Calculate hash in chunks so we don't run out of memory for
+            # large files.
+            checksums[op.relpath(fpath, self.path)] = file_md5(
+                fpath, chunk_size=HASH_CHUNK_SIZE)
         return checksums
 
     @classmethod
@@ -556,7 +557,7 @@ class Fileset(BaseItemMixin, BaseFileset):
 
     def put(self):
         if self.dataset is not None and self._path is not None:
-            self.dataset.put_fileset(self)
+            return self.dataset.put_fileset(self)
 
     def contents_equal(self, other, **kwargs):
         """
@@ -733,12 +734,27 @@ class Field(BaseItemMixin, BaseField):
 
     @value.setter
     def value(self, value):
+        self.set_value(value)
+
+    def set_value(self, value, put=True):
+        """
+        Sets the value of the field
+
+        Parameters
+        ----------
+        value : int | float | str | list[int] | list[float] | list[str]
+            The value to set
+        put : bool
+            Whether to push the value to the dataset. Can be set to False
+            when putting multiple fields in bulk with Dataset.put_fields
+        """
         if self.array:
             self._value = [self.dtype(v) for v in value]
         else:
             self._value = self.dtype(value)
         self._exists = True
-        self.put()
+        if put:
+            self.put()
 
     @property
     def checksums(self):
@@ -3,7 +3,7 @@ from arcana.exceptions import (
     ArcanaError, ArcanaUsageError, ArcanaIndexError)
 from .base import BaseFileset, BaseField
 from .item import Fileset, Field
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 from operator import itemgetter
 from itertools import chain
 
@@ -35,12 +35,14 @@ class BaseSliceMixin(object):
                 slce = list(slce)
             self._slice = slce
         elif frequency == 'per_session':
-            self._slice = OrderedDict()
-            for subj_id in sorted(set(c.subject_id for c in slce)):
-                self._slice[subj_id] = OrderedDict(
-                    sorted(((c.visit_id, c) for c in slce
-                            if c.subject_id == subj_id),
-                           key=itemgetter(0)))
+            # Bucket the items by subject and visit in a single pass
+            by_subject = defaultdict(dict)
+            for c in slce:
+                by_subject[c.subject_id][c.visit_id] = c
+            self._slice = OrderedDict(
+                (subj_id, OrderedDict(sorted(by_subject[subj_id].items(),
+                                             key=itemgetter(0))))
+                for subj_id in sorted(by_subject))
         elif frequency == 'per_subject':
             self._slice = OrderedDict(
                 sorted(((c.subject_id, c) for c in slce),
@@ -266,8 +268,9 @@ class FilesetSlice(BaseSliceMixin, BaseFileset):
                     .format(implicit_frequency, frequency, name))
             formatted_slice = []
             for fileset in slce:
-                fileset = copy(fileset)
+                # Filesets are only copied if their format needs to be set
                 if fileset.exists and fileset.format is None:
+                    fileset = copy(fileset)
                     fileset.format = (fileset.detect_format(candidate_formats)
                                       if format is None else format)
                 formatted_slice.append(fileset)
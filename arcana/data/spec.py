@@ -220,15 +220,18 @@ class BaseSpecMixin(object):
                     "{} does not have a method named '{}' required to "
                     "derive {}".format(analysis, self.pipeline_getter,
                                        self))
-            bound._bind_tree(analysis.dataset.tree)
         return bound
 
     @property
     def slice(self):
         if self._slice is None:
-            raise ArcanaUsageError(
-                "{} needs to be bound to a analysis before accessing "
-                "the corresponding slice".format(self))
+            if self._analysis is None:
+                raise ArcanaUsageError(
+                    "{} needs to be bound to a analysis before accessing "
+                    "the corresponding slice".format(self))
+            # The slice is matched against the tree on first access so that
+            # binding the spec doesn't require the repository to be queried
+            self._bind_tree(self._analysis.dataset.tree)
         return self._slice
 
     def nodes(self, tree):
@@ -1,9 +1,12 @@
 from __future__ import division
 from builtins import str  # @UnusedImports
 from builtins import object
+import os.path as op
 import time
+import json
 import logging
-from nipype.interfaces.base import isdefined
+from nipype.interfaces.base import isdefined, InterfaceResult, Bunch
+from nipype.pipeline.engine.utils import save_resultfile
 from nipype.pipeline.engine import (
     Node as NipypeNode, JoinNode as NipypeJoinNode,
     MapNode as NipypeMapNode)
@@ -34,6 +37,15 @@ class NodeMixin(object):
         executed by the processor (e.g. whether GPU cards are required)
     """
 
+    # Set by the processor to record the resources used by the node (see
+    # arcana.processor.history and arcana.processor.metrics)
+    _resource_history = None
+    _input_sizes_path = None
+    _metrics_path = None
+    # Set by the processor on format conversion nodes to reuse the outputs of
+    # previous conversions (see arcana.processor.conversion)
+    _conversion_cache = None
+
     def __init__(self, environment, *args, **kwargs):
         self._environment = environment
         # Get versions of software in the environment that satisfy the given
@@ -47,10 +59,28 @@ class NodeMixin(object):
     def _run_command(self, *args, **kwargs):
         # Detect run time and compare against specified wall_time
         start_time = time.time()
-        result = self.nipype_cls._run_command(self, *args, **kwargs)
+        if self._metrics_path is not None:
+            from arcana.processor.metrics import resource_usage
+            usage = resource_usage()
+        if self._conversion_cache is not None:
+            result = self._run_cached_command(*args, **kwargs)
+        else:
+            result = self.nipype_cls._run_command(self, *args, **kwargs)
         end_time = time.time()
+        if self._metrics_path is not None:
+            try:
+                self._record_metrics(usage)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.warning("Could not record metrics of '{}' node: {}"
+                               .format(self.name, e))
+        if self._resource_history is not None:
+            try:
+                self._record_resources(result, (end_time - start_time) / 60)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.warning("Could not record resources used by '{}' "
+                               "node: {}".format(self.name, e))
         run_time = (end_time - start_time) // 60
-        if run_time > self._wall_time:
+        if self._wall_time is not None and run_time > self._wall_time:
             logger.warning("Executed '{}' node in {} minutes, which is longer "
                            "than specified wall time ({} minutes)"
                            .format(self.name, run_time,
@@ -60,6 +90,110 @@ class NodeMixin(object):
                         .format(self.name, run_time))
         return result
 
+    def _run_cached_command(self, execute, copyfiles=True):
+        """
+        Copies the outputs of a previous run of the same conversion from the
+        conversion cache into the working directory of the node if present,
+        otherwise runs the node and adds its outputs to the cache
+        """
+        if not execute:  # Nipype's own cached results are loaded
+            return self.nipype_cls._run_command(self, execute,
+                                                copyfiles=copyfiles)
+        cache = self._conversion_cache
+        out_dir = self.output_dir()
+        try:
+            key = cache.key(self._interface, self._versions)
+            outputs = cache.get(key, out_dir)
+        except (IOError, OSError) as e:
+            logger.warning("Could not access conversion cache for '{}' node: "
+                           "{}".format(self.name, e))
+            return self.nipype_cls._run_command(self, execute,
+                                                copyfiles=copyfiles)
+        if outputs is None:
+            result = self.nipype_cls._run_command(self, execute,
+                                                  copyfiles=copyfiles)
+            try:
+                cache.put(key, {
+                    n: v for n, v in result.outputs.trait_get().items()
+                    if isdefined(v)}, out_dir)
+            except (IOError, OSError) as e:
+                logger.warning("Could not add outputs of '{}' node to "
+                               "conversion cache: {}".format(self.name, e))
+            return result
+        logger.info("Copied outputs of '{}' node from conversion cache at {}"
+                    .format(self.name, cache.path))
+        result_outputs = self._interface._outputs()
+        for name, value in outputs.items():
+            setattr(result_outputs, name, value)
+        result = InterfaceResult(
+            type(self._interface),
+            Bunch(cwd=out_dir, hostname=HOSTNAME, duration=0.0,
+                  returncode=0, environ={}),
+            inputs=self._interface.inputs.get_traitsfree(),
+            outputs=result_outputs)
+        save_resultfile(result, out_dir, self.name)
+        return result
+
+    def _run_session(self):
+        """
+        Returns the pipeline the node belongs to, the subject and visit IDs it
+        was run for and the total size of the pipeline's input filesets for
+        the session (where they were saved by the processor)
+        """
+        from arcana.processor.history import (
+            session_from_parameterization, session_input_size)
+        hierarchy = (self._hierarchy or '').split('.')
+        pipeline_name = hierarchy[-1] if len(hierarchy) > 1 else None
+        subject_id = visit_id = input_size = None
+        if self._input_sizes_path is not None and op.exists(
+                self._input_sizes_path):
+            with open(self._input_sizes_path) as f:
+                input_sizes = json.load(f)
+            subject_id, visit_id = session_from_parameterization(
+                self.parameterization, input_sizes['subject_id'],
+                input_sizes['visit_id'])
+            try:
+                pipeline_sizes = input_sizes['pipelines'][pipeline_name]
+            except KeyError:
+                pass
+            else:
+                input_size = session_input_size(pipeline_sizes, subject_id,
+                                                visit_id)
+        return pipeline_name, subject_id, visit_id, input_size
+
+    def _record_resources(self, result, wall_time):
+        """
+        Records the wall time and peak memory used by the node in the
+        resource history set by the processor
+        """
+        from arcana.processor.history import interface_name
+        # The peak memory of the node is only measured by NiPype's resource
+        # monitor (when enabled). The peak RSS reported by getrusage covers
+        # the whole life of the worker process and its children, so would
+        # ratchet up the estimates of all nodes run in the same process
+        mem_gb = getattr(getattr(result, 'runtime', None), 'mem_peak_gb',
+                         None)
+        pipeline_name, _, _, input_size = self._run_session()
+        self._resource_history.record(
+            pipeline_name, self.name, interface_name(self), wall_time,
+            mem_gb, input_size=input_size)
+
+    def _record_metrics(self, usage):
+        """
+        Appends the resources used by the node since the 'usage' snapshot
+        was taken to the metrics file of the run set by the processor
+        """
+        from arcana.processor.history import interface_name
+        from arcana.processor.metrics import (
+            MetricsLog, resource_usage, usage_between)
+        from arcana.repository.interfaces import RepositoryInterface
+        metrics = usage_between(usage, resource_usage())
+        pipeline_name, subject_id, visit_id, _ = self._run_session()
+        MetricsLog(self._metrics_path).append(
+            pipeline_name, self.name, interface_name(self), metrics,
+            subject_id=subject_id, visit_id=visit_id,
+            repository_io=isinstance(self.interface, RepositoryInterface))
+
     @property
     def annotations(self):
         return self._annotations
@@ -120,6 +254,9 @@ class MapNode(NodeMixin, NipypeMapNode):
             node._versions = self._versions
             node._wall_time = self._wall_time
             node._annotations = self._annotations
+            node._resource_history = self._resource_history
+            node._input_sizes_path = self._input_sizes_path
+            node._metrics_path = self._metrics_path
             yield i, node
 
 
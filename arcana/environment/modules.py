@@ -3,10 +3,15 @@ from __future__ import division
 from future.utils import PY3
 from builtins import str  # @UnusedImport
 import os
+import os.path as op
 import re
+import json
+import time
+import hashlib
 import logging
 import subprocess as sp
 from collections import defaultdict
+from fasteners import InterProcessLock
 from arcana.exceptions import (
     ArcanaError, ArcanaModulesNotInstalledException,
     ArcanaRequirementNotFoundError, ArcanaVersionNotDetectableError,
@@ -52,6 +57,110 @@ class ModulesMapNode(ModulesNodeMixin, MapNode):
     base_cls = MapNode  # Not req. in Py3 where super() in mixin works
 
 
+class ModulesCache(object):
+    """
+    A cache on disk of the modules available in the environment and the exact
+    versions detected for the modules loaded to satisfy requirements, which
+    can be shared between processes (and the nodes of a cluster if stored on
+    a shared file-system) to avoid rerunning slow module commands.
+
+    Each cache file is named after a digest of the directories in the
+    MODULEPATH, the names of the modules in them and their modification
+    times, so adding or removing modules (or versions of them) invalidates
+    the cache.
+
+    Parameters
+    ----------
+    path : str
+        Path to the directory to store the cache files in
+    ttl : float | None
+        The time (in seconds) after which a cache file is considered stale
+        and regenerated. If None cache files don't expire
+    """
+
+    LOCK_SUFFIX = '.lock'
+
+    def __init__(self, path, ttl=None):
+        self._path = path
+        self._ttl = ttl
+        self._fpath = op.join(
+            path, 'modules-{}.json'.format(self.modulepath_digest()))
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def ttl(self):
+        return self._ttl
+
+    def load(self):
+        """
+        Loads the contents of the cache
+
+        Returns
+        -------
+        cache : dict | None
+            The available modules ('available') and detected versions
+            ('versions') stored in the cache, or None if the cache doesn't
+            exist or has expired
+        """
+        try:
+            with open(self._fpath) as f:
+                cache = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if self.ttl is not None and time.time() - cache['time'] > self.ttl:
+            return None
+        return cache
+
+    def update(self, available=None, versions=None):
+        """
+        Updates the cache, locking it so that concurrent updates from other
+        processes aren't lost
+
+        Parameters
+        ----------
+        available : dict[str, list[str]] | None
+            The versions of each available module
+        versions : dict[str, str] | None
+            Detected exact versions to add to the cache
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with InterProcessLock(self._fpath + self.LOCK_SUFFIX, logger=logger):
+            cache = self.load()
+            if cache is None:
+                cache = {'time': time.time(), 'available': None,
+                         'versions': {}}
+            if available is not None:
+                cache['available'] = available
+            if versions is not None:
+                cache['versions'].update(versions)
+            tmp_fpath = self._fpath + '.tmp'
+            with open(tmp_fpath, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp_fpath, self._fpath)
+
+    @classmethod
+    def modulepath_digest(cls):
+        """
+        A digest of the directories in the MODULEPATH, the names of the
+        modules in them and their modification times
+        """
+        state = []
+        for dpath in os.environ.get('MODULEPATH', '').split(os.pathsep):
+            if not dpath:
+                continue
+            try:
+                modules = sorted((e.name, e.stat().st_mtime)
+                                 for e in os.scandir(dpath))
+                mtime = os.stat(dpath).st_mtime
+            except OSError:
+                modules = mtime = None
+            state.append((dpath, mtime, modules))
+        return hashlib.sha1(json.dumps(state).encode()).hexdigest()
+
+
 class ModulesEnv(Environment):
     """
     An environment in which software requirements (e.g. FSL, matlab,
@@ -80,6 +189,13 @@ class ModulesEnv(Environment):
     detect_exact_versions : bool
         Actively detect the version of the software the version of the module
         loads
+    cache_dir : str | None
+        Path to a directory in which to cache the available modules and the
+        detected exact versions across processes (see ModulesCache). If None
+        they are only cached within the environment object
+    cache_ttl : float | None
+        The time (in seconds) after which the cache is regenerated. If None
+        it is only regenerated when the modules in the MODULEPATH change
     """
 
     node_types = {'base': ModulesNode, 'map': ModulesMapNode,
@@ -87,7 +203,8 @@ class ModulesEnv(Environment):
 
     def __init__(self, packages_map=None, versions_map=None,
                  fallback_to_static=True, ignore_unrecognised=True,
-                 detect_exact_versions=True):
+                 detect_exact_versions=True, cache_dir=None,
+                 cache_ttl=86400):
         if packages_map is None:
             packages_map = {}
         if versions_map is None:
@@ -97,8 +214,17 @@ class ModulesEnv(Environment):
         self._fallback_to_static = fallback_to_static
         self._ignore_unrecog = ignore_unrecognised
         self._detect_exact_versions = detect_exact_versions
-        self._detected_cache = None
-        self._available = self.available()
+        self._cache = (ModulesCache(cache_dir, ttl=cache_ttl)
+                       if cache_dir is not None else None)
+        cached = self._cache.load() if self._cache is not None else None
+        if cached is not None and cached['available'] is not None:
+            self._available = cached['available']
+        else:
+            self._available = self.available()
+            if self._cache is not None:
+                self._cache.update(available=self._available)
+        # Maps requirements and module versions to the detected exact version
+        self._detected_cache = cached['versions'] if cached else {}
 
     def __eq__(self, other):
         return (
@@ -115,6 +241,9 @@ class ModulesEnv(Environment):
     def satisfy(self, *requirements):
         versions = []
         loaded_versions = []
+        # Versions that have been selected but not loaded because their exact
+        # version was cached
+        unloaded_versions = []
         try:
             for req_range in requirements:
                 req = req_range.requirement
@@ -153,28 +282,46 @@ class ModulesEnv(Environment):
                     # modules administrator has called it) we load the module
                     # detect the version and unload it again
                     if self._detect_exact_versions:
-                        # Note that the versions are unloaded after the outer
-                        # loop so that subsequent requirements can use
-                        # previously loaded requirements to detect their
-                        # version (matlab packages in particular)
-                        self.load(version)
-                        loaded_versions.append(version)
-                        exact_version = req.detect_version(
-                            local_name=local_name,
-                            local_version=local_ver_name)
+                        cache_key = '{}:{}'.format(req.name,
+                                                   self._module_id(version))
+                        try:
+                            exact_version = req.v(
+                                self._detected_cache[cache_key],
+                                local_name=local_name,
+                                local_version=version.local_version)
+                        except KeyError:
+                            # Note that the versions are unloaded after the
+                            # outer loop so that subsequent requirements can
+                            # use previously loaded requirements to detect
+                            # their version (matlab packages in particular)
+                            self.load(*unloaded_versions)
+                            loaded_versions.extend(unloaded_versions)
+                            unloaded_versions = []
+                            self.load(version)
+                            loaded_versions.append(version)
+                            exact_version = req.detect_version(
+                                local_name=local_name,
+                                local_version=version.local_version)
+                            self._detected_cache[cache_key] = str(
+                                exact_version)
+                            if self._cache is not None:
+                                self._cache.update(versions={
+                                    cache_key: str(exact_version)})
+                        else:
+                            unloaded_versions.append(version)
                         if not req_range.within(exact_version):
                             raise ArcanaVersionError(
                                 "Version of {} specified by module {} ({}) "
                                 "does not match expected {} and is outside the"
                                 " acceptable range [{}]"
-                                .format(req.name, local_ver_name,
+                                .format(req.name, version.local_version,
                                         exact_version, str(version),
                                         str(req_range)))
                         if exact_version < version:
                             raise ArcanaVersionError(
                                 "Version of {} specified by module {} ({}) is "
                                 "less than the expected {}".format(
-                                    req.name, local_ver_name,
+                                    req.name, version.local_version,
                                     exact_version, str(version)))
                         version = exact_version
                 versions.append(version)
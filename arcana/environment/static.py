@@ -23,6 +23,10 @@ class StaticEnv(Environment):
         Raise an error if the version of a requirement cannot be detected
     """
 
+    # Versions detected by any static environment in the current process,
+    # which are shared between instances as the environment doesn't change
+    _process_versions = {}
+
     def __init__(self, fail_on_missing=True, fail_on_undetectable=True):
         self._fail_on_missing = fail_on_missing
         self._fail_on_undetectable = fail_on_undetectable
@@ -47,7 +51,7 @@ class StaticEnv(Environment):
                 version = self._detected_versions[req_range.name]
             except KeyError:
                 try:
-                    version = req_range.requirement.detect_version()
+                    version = self._detect_version(req_range.requirement)
                 except ArcanaRequirementNotFoundError as e:
                     if self._fail_on_missing:
                         raise
@@ -70,3 +74,13 @@ class StaticEnv(Environment):
                     .format(req_range.requirement, version, req_range))
             versions.append(version)
         return versions
+
+    @classmethod
+    def _detect_version(cls, requirement):
+        "Detects the version of the requirement, reusing previous detections"
+        try:
+            version = cls._process_versions[requirement]
+        except KeyError:
+            version = cls._process_versions[requirement] = (
+                requirement.detect_version())
+        return version
@@ -129,6 +129,17 @@ class ArcanaJobSubmittedException(ArcanaException):
     """
 
 
+class ArcanaShardFailedError(ArcanaError):
+    """
+    Raised when one or more shards of a sharded run fail. The indices of the
+    failed shards and the exceptions they raised are stored in 'failed'
+    """
+
+    def __init__(self, msg, failed):
+        super(ArcanaShardFailedError, self).__init__(msg)
+        self.failed = failed
+
+
 class ArcanaNoRunRequiredException(ArcanaException):
     """
     Used to signify when a pipeline doesn't need to be run as all
@@ -114,6 +114,12 @@ class Pipeline(object):
         self._prov = None
         self._inputnodes = None
         self._outputnodes = None
+        # The nodes and joins of the pipeline when it is capped, which it is
+        # restored to by 'reset'
+        self._constructed = None
+        # The serialised workflow graph saved in the provenance along with
+        # the signature of the graph it was generated from
+        self._workflow_prov = None
 
     def __repr__(self):
         return "{}(name='{}')".format(self.__class__.__name__,
@@ -738,6 +744,8 @@ class Pipeline(object):
         """
         to_cap = (self._inputnodes, self._outputnodes, self._prov)
         if to_cap == (None, None, None):
+            self._constructed = (set(self._workflow._graph.nodes()),
+                                 set(self._iterator_joins))
             self._inputnodes = {
                 f: self._make_inputnode(f) for f in self.input_frequencies}
             self._outputnodes = {
@@ -748,6 +756,25 @@ class Pipeline(object):
                 "If one of _inputnodes, _outputnodes or _prov is not None then"
                 " they all should be in {}".format(self))
 
+    def reset(self):
+        """
+        Restores the pipeline to the state it was in before it was capped,
+        removing the input and output nodes and any nodes added when it was
+        connected to a workflow by the processor, so that it can be reused
+        in subsequent runs instead of being regenerated
+        """
+        if self._constructed is None:
+            return
+        constructed_nodes, iterator_joins = self._constructed
+        self._workflow.remove_nodes(
+            [n for n in self._workflow._graph.nodes()
+             if n not in constructed_nodes])
+        # Reset the hierarchy set when it was added to the outer workflow
+        self._workflow._hierarchy = None
+        self._iterator_joins = iterator_joins
+        self._inputnodes = self._outputnodes = self._prov = None
+        self._constructed = None
+
     def _make_inputnode(self, frequency):
         """
         Generates an input node for the given frequency. It also adds implicit
@@ -809,7 +836,8 @@ class Pipeline(object):
                             inputs={conv.input: (inputnode, input.name)},
                             requirements=conv.requirements,
                             mem_gb=conv.mem_gb,
-                            wall_time=conv.wall_time)
+                            wall_time=conv.wall_time,
+                            annotations={'format_conversion': True})
                     try:
                         in_node_out = conv.output_aux(format.aux_name)
                     except AttributeError:  # Not an auxiliary pointer
@@ -875,7 +903,8 @@ class Pipeline(object):
                     inputs={conv.input: (node, node_out)},
                     requirements=conv.requirements,
                     mem_gb=conv.mem_gb,
-                    wall_time=conv.wall_time)
+                    wall_time=conv.wall_time,
+                    annotations={'format_conversion': True})
                 node_out = conv.output
             self.connect(node, node_out, outputnode, output.name)
         return outputnode
@@ -891,6 +920,36 @@ class Pipeline(object):
             A dictionary containing the provenance information to record
             for the pipeline
         """
+        # The serialisation of the workflow graph is reused if the nodes and
+        # connections of the pipeline haven't changed since it was generated
+        # (e.g. when the pipeline is capped again after being reset)
+        signature = self._workflow_signature()
+        if self._workflow_prov is not None and (
+                self._workflow_prov[0] == signature):
+            wf_dict = self._workflow_prov[1]
+        else:
+            wf_dict = self._serialise_workflow()
+            self._workflow_prov = (signature, wf_dict)
+        dependency_versions = {d: extract_package_version(d)
+                               for d in ARCANA_DEPENDENCIES}
+        pkg_versions = {'arcana': __version__}
+        pkg_versions.update((k, v) for k, v in dependency_versions.items()
+                            if v is not None)
+        prov = {
+            '__prov_version__': PROVENANCE_VERSION,
+            'name': self.name,
+            'workflow': wf_dict,
+            'analysis': self.analysis.prov,
+            'pkg_versions': pkg_versions,
+            'python_version': sys.version,
+            'joined_ids': self._joined_ids()}
+        return prov
+
+    def _serialise_workflow(self):
+        """
+        Serialises the workflow graph of the pipeline into a dictionary of
+        node provenance and links that can be saved in the provenance
+        """
         # Export worfklow graph to node-link data format
         wf_dict = nx_json.node_link_data(self.workflow._graph)  # noqa pylint disable=protected-member
         # Replace references to Node objects with the node's provenance
@@ -910,21 +969,21 @@ class Pipeline(object):
                             for n in wf_dict['nodes']}
         # Roundtrip to JSON to convert any tuples into lists so dictionaries
         # can be compared directly
-        wf_dict = json.loads(json.dumps(wf_dict))
-        dependency_versions = {d: extract_package_version(d)
-                               for d in ARCANA_DEPENDENCIES}
-        pkg_versions = {'arcana': __version__}
-        pkg_versions.update((k, v) for k, v in dependency_versions.items()
-                            if v is not None)
-        prov = {
-            '__prov_version__': PROVENANCE_VERSION,
-            'name': self.name,
-            'workflow': wf_dict,
-            'analysis': self.analysis.prov,
-            'pkg_versions': pkg_versions,
-            'python_version': sys.version,
-            'joined_ids': self._joined_ids()}
-        return prov
+        return json.loads(json.dumps(wf_dict))
+
+    def _workflow_signature(self):
+        """
+        A cheap summary of the nodes (and their interfaces) and connections
+        of the workflow graph, used to detect whether it has changed since it
+        was last serialised. NB: changes to the parameters of the analysis
+        cause the pipeline to be regenerated (see Analysis.pipeline) so they
+        don't need to be detected here
+        """
+        graph = self.workflow._graph
+        return (
+            frozenset((n.name, type(n.interface)) for n in graph.nodes()),
+            frozenset((u.name, v.name, repr(d.get('connect')))
+                      for u, v, d in graph.edges(data=True)))
 
     def expected_record(self, node):
         """
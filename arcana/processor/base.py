@@ -1,5 +1,8 @@
 from builtins import object
 import os  # @UnusedImport
+import re
+import json
+from datetime import datetime
 from pprint import pformat
 import os.path as op
 from collections import defaultdict, OrderedDict
@@ -11,13 +14,24 @@ import numpy as np
 from nipype.pipeline import engine as pe
 from nipype.interfaces.utility import IdentityInterface, Merge
 from arcana.repository.interfaces import RepositorySource, RepositorySink
+from .prefetch import InputPrefetcher
+from .history import (
+    ResourceHistory, interface_name, session_from_parameterization,
+    session_input_size)
+from .metrics import MetricsLog
+from .optimise import optimise_workflow
+from .conversion import ConversionCache
+from .plan import (
+    ExecutionPlan, PipelinePlan, PlannedNode, MISSING_OUTPUT, PROV_MISMATCH,
+    MISSING_PROV_INPUT, FORCED, PREREQUISITE, JOINED)
 from arcana.utils import get_class_info
 from arcana.exceptions import (
     ArcanaMissingDataException,
     ArcanaNoRunRequiredException, ArcanaUsageError, ArcanaDesignError,
     ArcanaReprocessException, ArcanaProtectedOutputConflictError,
     ArcanaOutputNotProducedException, ArcanaDataNotDerivedYetError,
-    ArcanaNameError)
+    ArcanaNameError, ArcanaIndexError, ArcanaJobSubmittedException,
+    ArcanaShardFailedError)
 
 
 logger = getLogger('arcana')
@@ -60,6 +74,59 @@ class Processor(object):
     default_mem_gb : float
         The default memory assumed to be required for nodes where it isn't
         specified
+    prefetch : int
+        The number of sessions ahead of those sourced by the workflow for
+        which to retrieve the inputs in background threads while the workflow
+        runs (in the order the sessions are processed). Useful for remote
+        repositories (e.g. XNAT) to overlap downloads with computation. If 0,
+        inputs are only retrieved when the source nodes are run
+    prefetch_workers : int
+        The maximum number of concurrent retrievals used when prefetching
+    prefetch_bandwidth : float | None
+        The maximum average rate (in MB/s) at which to prefetch inputs. If
+        None the rate is unrestricted
+    shard_size : int | None
+        If provided, the sessions to process are partitioned into shards of
+        approximately this many sessions (see 'shards'), which are run in
+        independent workflows. Limits the size of the workflow graph for
+        very large datasets and allows failed shards to be rerun without
+        rerunning the successful ones
+    iteration : str
+        How the subject/visit pairs to process are iterated over by pipelines
+        that iterate over both subjects and visits
+
+            'product' -> (default) independent subject and visit iterators if
+                         the pairs to process can be factorized into their
+                         product, otherwise the visit (or subject) iterator
+                         is made dependent on the other
+            'sessions' -> a single iterator over the exact list of pairs to
+                          process, for pipelines that don't join over
+                          subjects or visits ('product' is used otherwise)
+            'auto' -> 'sessions' if the pairs can't be factorized, otherwise
+                      'product'
+    resource_history : ResourceHistory | str | None
+        A store of the resources used by nodes in previous runs (or the path
+        to one), which is added to as nodes are run and used to estimate the
+        wall time and memory to request for them in place of the static
+        hints. If None, no history is recorded
+    collect_metrics : bool
+        Whether to record the wall time, CPU time, peak RSS and bytes
+        read/written by every node executed in each run in a JSON-lines file
+        in the 'metrics' sub-directory of the work directory (see
+        'metrics_log')
+    metrics_in_prov : bool
+        Whether to summarise the metrics of the nodes of a pipeline in the
+        provenance records saved with its outputs (implies 'collect_metrics')
+    optimise_graph : bool
+        Whether to flatten the workflow before it is run and remove the
+        pass-through, duplicated and redundant bookkeeping nodes from it (see
+        arcana.processor.optimise.optimise_workflow). The number of nodes
+        before and after the optimisation is logged
+    conversion_cache : ConversionCache | str | None
+        A store of the outputs of previous format conversions (or the path to
+        one), which converter nodes link their outputs from instead of
+        rerunning the conversion when their inputs, parameters and software
+        versions match. If None, conversions are always rerun
 
     NB: Other keyword wargs are passed to the wrapped Nipype plugin. Some
     useful ones for debugging are 'remove_unnecessary_outputs=False' and
@@ -70,6 +137,20 @@ class Processor(object):
     DEFAULT_MEM_GB = 4
 
     WORKFLOW_MAX_NAME_LEN = 100
+    SHARD_LEDGER_SUFFIX = '_shards.json'
+    ITERATION_MODES = ('product', 'sessions', 'auto')
+    # Name of the iterator node used to iterate over explicit lists of
+    # subject/visit pairs
+    SESSIONS_ITERATOR = 'sessions'
+    # Name of the file in the workflow directory the sizes of the input
+    # filesets of each session are saved to when recording resource usage
+    INPUT_SIZES_FNAME = 'input_sizes.json'
+    # Sub-directory of the work directory the metrics files of each run are
+    # saved in
+    METRICS_DIR = 'metrics'
+    # Sub-directory of the work directory the source nodes of each run mark
+    # the sessions they have sourced in when prefetching
+    PREFETCH_PROGRESS_DIR = 'prefetch'
 
     # The default paths in the provenance JSON to check for mismatches that
     # would require the derivative to be reprocessed
@@ -88,7 +169,11 @@ class Processor(object):
                  max_process_time=None,
                  clean_work_dir_between_runs=True,
                  default_wall_time=DEFAULT_WALL_TIME,
-                 default_mem_gb=DEFAULT_MEM_GB, **kwargs):
+                 default_mem_gb=DEFAULT_MEM_GB, prefetch=0,
+                 prefetch_workers=2, prefetch_bandwidth=None, shard_size=None,
+                 iteration='product', resource_history=None,
+                 collect_metrics=False, metrics_in_prov=False,
+                 optimise_graph=False, conversion_cache=None, **kwargs):
         self._work_dir = work_dir
         self._max_process_time = max_process_time
         self._reprocess = reprocess
@@ -101,6 +186,27 @@ class Processor(object):
         self._init_plugin()
         self._analysis = None
         self._clean_work_dir_between_runs = clean_work_dir_between_runs
+        self._prefetch = prefetch
+        self._prefetch_workers = prefetch_workers
+        self._prefetch_bandwidth = prefetch_bandwidth
+        self._prefetch_progress_dir = None
+        self._shard_size = shard_size
+        if iteration not in self.ITERATION_MODES:
+            raise ArcanaUsageError(
+                "Unrecognised iteration mode '{}', can be one of '{}'"
+                .format(iteration, "', '".join(self.ITERATION_MODES)))
+        self._iteration = iteration
+        if isinstance(resource_history, str):
+            resource_history = ResourceHistory(resource_history)
+        self._resource_history = resource_history
+        self._input_sizes = {}
+        self._collect_metrics = collect_metrics or metrics_in_prov
+        self._metrics_in_prov = metrics_in_prov
+        self._metrics_path = None
+        self._optimise_graph = optimise_graph
+        if isinstance(conversion_cache, str):
+            conversion_cache = ConversionCache(conversion_cache)
+        self._conversion_cache = conversion_cache
 
     def __repr__(self):
         return "{}(work_dir='{}')".format(
@@ -147,6 +253,16 @@ class Processor(object):
     def default_wall_time(self):
         return self._default_wall_time
 
+    @property
+    def metrics_log(self):
+        """
+        The metrics recorded for the nodes executed in the last run (None if
+        metrics aren't collected or nothing has been run)
+        """
+        if self._metrics_path is None:
+            return None
+        return MetricsLog(self._metrics_path)
+
     def bind(self, analysis):
         cpy = deepcopy(self)
         cpy._analysis = analysis
@@ -185,12 +301,15 @@ class Processor(object):
             final pipeline will be reprocessed (prerequisite pipelines won't
             run unless they don't match provenance). To process all
             prerequisite pipelines 'all' should be passed to force.
+        shard_size : int | None
+            Overrides the 'shard_size' of the processor for this run
 
         Returns
         -------
         report : ReportNode
             The final report node, which can be connected to subsequent
-            pipelines
+            pipelines. If the run is sharded, a list of the results of the
+            workflow of each shard is returned instead
         """
         if not pipelines:
             raise ArcanaUsageError("No pipelines provided to {}.run"
@@ -202,8 +321,22 @@ class Processor(object):
         clean_work_dir = kwargs.pop('clean_work_dir',
                                     self._clean_work_dir_between_runs)
         required_outputs = kwargs.pop('required_outputs', repeat(None))
+        shard_size = kwargs.pop('shard_size', self._shard_size)
         # Create name by combining pipelines
         name = '_'.join(p.name for p in pipelines)
+        if shard_size:
+            return self._run_shards(name, pipelines, required_outputs,
+                                    subject_ids, visit_ids, session_ids,
+                                    shard_size, clean_work_dir, **kwargs)
+        return self._run_workflow(name, pipelines, required_outputs,
+                                  subject_ids, visit_ids, session_ids,
+                                  clean_work_dir, **kwargs)
+
+    def _run_workflow(self, name, pipelines, required_outputs, subject_ids,
+                      visit_ids, session_ids, clean_work_dir, **kwargs):
+        """
+        Connects the pipelines into a single workflow and runs it (see 'run')
+        """
         # Clean work dir if required
         if clean_work_dir:
             workflow_work_dir = op.join(self.work_dir, name)
@@ -213,9 +346,331 @@ class Processor(object):
         # workflow names exceeding system limits.
         name = name[:self.WORKFLOW_MAX_NAME_LEN]
         workflow = pe.Workflow(name=name, base_dir=self.work_dir)
+        self._input_sizes = {}
+        if self._collect_metrics:
+            self._metrics_path = op.join(
+                self.work_dir, self.METRICS_DIR, '{}_{}.jsonl'.format(
+                    name, datetime.now().strftime('%Y%m%d%H%M%S%f')))
+        subject_inds, visit_inds, filter_array = self._filter_array(
+            subject_ids, visit_ids, session_ids)
+        stack = self._pipeline_stack(pipelines, required_outputs,
+                                     filter_array, subject_inds, visit_inds)
+        if self._prefetch:
+            # Directory in which the source nodes mark the sessions they have
+            # sourced so the prefetcher can keep just ahead of the workflow
+            self._prefetch_progress_dir = op.join(
+                self.work_dir, self.PREFETCH_PROGRESS_DIR, name)
+            if op.exists(self._prefetch_progress_dir):
+                shutil.rmtree(self._prefetch_progress_dir)
+            os.makedirs(self._prefetch_progress_dir)
+        else:
+            self._prefetch_progress_dir = None
+        # Iterate through stack of required pipelines from upstream to
+        # downstream
+        with self.analysis.repository:
+            for pipeline, req_outputs, flt_array in stack:
+                try:
+                    self._connect_pipeline(
+                        pipeline, req_outputs, workflow, subject_inds,
+                        visit_inds, flt_array, **kwargs)
+                except ArcanaNoRunRequiredException:
+                    logger.info("Not running '{}' pipeline as its outputs "
+                                "are already present in the repository"
+                                .format(pipeline.name))
+        # Save complete graph for debugging purposes
+#         workflow.write_graph(graph2use='flat', format='svg')
+#         print('Graph saved in {} directory'.format(os.getcwd()))
+        # Actually run the generated workflow
+        if workflow._get_all_nodes():  # Check if workflow has any nodes to run
+            if (self._resource_history is not None
+                    or self._collect_metrics):
+                self._write_input_sizes(workflow)
+            if self._optimise_graph:
+                workflow, stats = optimise_workflow(workflow)
+                logger.info(
+                    "Optimised '{}' workflow from {} to {} nodes ({})".format(
+                        name, stats['nodes_before'], stats['nodes_after'],
+                        ', '.join('{}={}'.format(k, v)
+                                  for k, v in stats.items()
+                                  if k not in ('nodes_before',
+                                               'nodes_after'))))
+            prefetcher = self._prefetcher([p for p, _, _ in stack],
+                                          subject_inds, visit_inds)
+            try:
+                result = workflow.run(plugin=self._plugin)
+            finally:
+                if prefetcher is not None:
+                    prefetcher.stop()
+        else:
+            result = None
+        # Reset the cached tree of filesets in the repository as it will
+        # change after the pipeline has run.
+        self.analysis.clear_caches()
+        return result
+
+    def shards(self, *pipelines, **kwargs):
+        """
+        Partitions the sessions that would be considered for processing by
+        'run' into shards of approximately 'shard_size' sessions, which can
+        be processed by independent workflows. Sessions that are joined by
+        a pipeline (e.g. all visits of a subject for pipelines with
+        'per_subject' outputs) are always kept in the same shard. Takes the
+        same arguments as 'run'.
+
+        The returned shards can be passed to the 'session_ids' argument of
+        'run' in separate processes (or jobs) to process them in parallel.
+
+        Parameters
+        ----------
+        pipeline(s) : Pipeline, ...
+            The pipelines to partition the sessions of
+        shard_size : int
+            The number of sessions per shard. Defaults to the 'shard_size' of
+            the processor
+
+        Returns
+        -------
+        shards : list[list[tuple[str, str]]]
+            Lists of the (subject ID, visit ID) pairs in each shard
+        """
+        shard_size = kwargs.pop('shard_size', self._shard_size)
+        if not shard_size or shard_size < 1:
+            raise ArcanaUsageError(
+                "Shard size needs to be a positive integer (provided {})"
+                .format(shard_size))
+        subject_inds, visit_inds, filter_array = self._filter_array(
+            kwargs.pop('subject_ids', None), kwargs.pop('visit_ids', None),
+            kwargs.pop('session_ids', None))
+        stack = self._pipeline_stack(
+            pipelines, kwargs.pop('required_outputs', repeat(None)),
+            filter_array, subject_inds, visit_inds)
+        # Combine the (dialated) filter arrays of all pipelines in the stack
+        # along with the iterators they join over
+        session_array = np.zeros(filter_array.shape, dtype=bool)
+        joins = set()
+        for pipeline, _, flt_array in stack:
+            session_array |= flt_array
+            joins.update(pipeline.joins)
+        inv_subj_inds = {v: k for k, v in subject_inds.items()}
+        inv_visit_inds = {v: k for k, v in visit_inds.items()}
+        # Divide the sessions into groups that can't be split between shards
+        if (self.analysis.SUBJECT_ID in joins
+                and self.analysis.VISIT_ID in joins):
+            logger.warning(
+                "Cannot shard sessions as pipelines join over both subjects "
+                "and visits")
+            groups = [np.nonzero(session_array)]
+        elif self.analysis.VISIT_ID in joins:
+            groups = [(np.full(len(r.nonzero()[0]), i), r.nonzero()[0])
+                      for i, r in enumerate(session_array) if r.any()]
+        elif self.analysis.SUBJECT_ID in joins:
+            groups = [(c.nonzero()[0], np.full(len(c.nonzero()[0]), i))
+                      for i, c in enumerate(session_array.T) if c.any()]
+        else:
+            groups = [([s], [v]) for s, v in zip(*np.nonzero(session_array))]
+        shards = []
+        shard = []
+        for subj_inds, vis_inds in groups:
+            if shard and len(shard) + len(subj_inds) > shard_size:
+                shards.append(shard)
+                shard = []
+            shard.extend((inv_subj_inds[s], inv_visit_inds[v])
+                         for s, v in zip(subj_inds, vis_inds))
+        if shard:
+            shards.append(shard)
+        return shards
+
+    def _run_shards(self, name, pipelines, required_outputs, subject_ids,
+                    visit_ids, session_ids, shard_size, clean_work_dir,
+                    **kwargs):
+        """
+        Runs the pipelines over shards of the sessions in independent
+        workflows. Failures of a shard don't stop the remaining shards being
+        run, and the shards that completed successfully are recorded in a
+        ledger in the work directory so they are skipped if the run is
+        repeated (until all shards have completed successfully)
+
+        Returns
+        -------
+        results : list
+            The results of the workflows of each shard that was run
+        """
+        shards = self.shards(
+            *pipelines, subject_ids=subject_ids, visit_ids=visit_ids,
+            session_ids=session_ids, required_outputs=required_outputs,
+            shard_size=shard_size)
+        # Pipelines can only be connected to a single workflow so they need to
+        # be regenerated for each shard from their constructor methods
+        pipeline_keys = []
+        for pipeline in pipelines:
+            key = self.analysis.pipeline_key(pipeline)
+            if key is None:
+                raise ArcanaUsageError(
+                    "Cannot shard the processing of {} as it wasn't created "
+                    "by the 'pipeline' method of {}".format(pipeline,
+                                                            self.analysis))
+            pipeline_keys.append(key)
+        name = name[:self.WORKFLOW_MAX_NAME_LEN]
+        ledger_path = op.join(self.work_dir, name + self.SHARD_LEDGER_SUFFIX)
+        completed = set()
+        try:
+            with open(ledger_path) as f:
+                ledger = json.load(f)
+        except (IOError, ValueError):
+            pass
+        else:
+            # Only resume if the sessions have been partitioned in the same
+            # way as the previous run
+            if ledger['shards'] == [[list(s) for s in h] for h in shards]:
+                completed.update(ledger['completed'])
+                logger.info("Resuming sharded run of '{}', skipping {} "
+                            "completed shards".format(name, len(completed)))
+        results = []
+        failed = []
+        for i, shard in enumerate(shards):
+            if i in completed:
+                continue
+            logger.info("Running shard {} of {} ({} sessions) of '{}'"
+                        .format(i + 1, len(shards), len(shard), name))
+            self.analysis.clear_caches()
+            try:
+                shard_pipelines = [
+                    self.analysis.pipeline(g, pipeline_args=a)
+                    for g, a in pipeline_keys]
+                results.append(self._run_workflow(
+                    '{}_shard{}'.format(name, i), shard_pipelines,
+                    required_outputs, None, None, shard, clean_work_dir,
+                    **kwargs))
+            except ArcanaJobSubmittedException:
+                raise
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("Shard {} of '{}' failed: {}".format(i, name, e))
+                failed.append((i, e))
+            else:
+                completed.add(i)
+                tmp_path = '{}.{}.tmp'.format(ledger_path, os.getpid())
+                with open(tmp_path, 'w') as f:
+                    json.dump({'shards': shards,
+                               'completed': sorted(completed)}, f)
+                os.replace(tmp_path, ledger_path)
+        if failed:
+            raise ArcanaShardFailedError(
+                "{} of {} shards of '{}' failed ({}), rerun to process the "
+                "failed shards only".format(
+                    len(failed), len(shards), name,
+                    ', '.join('{}: {}'.format(i, e) for i, e in failed)),
+                failed)
+        if op.exists(ledger_path):
+            os.remove(ledger_path)
+        return results
+
+    def plan(self, *pipelines, **kwargs):
+        """
+        Determines which subject/visit nodes of the given pipelines, and
+        their prerequisites, would be processed by 'run' and why, without
+        building or running the workflow. Takes the same arguments as 'run'
+        (with the exception of 'clean_work_dir'). As with 'run', an exception
+        is raised if there are provenance mismatches and the 'reprocess' flag
+        isn't set.
+
+        Parameters
+        ----------
+        pipeline(s) : Pipeline, ...
+            The pipelines to plan the processing of
+
+        Returns
+        -------
+        plan : ExecutionPlan
+            The pipelines to run in order of execution along with the nodes
+            to process for each of them. Print the plan to display it as a
+            table
+        """
+        if not pipelines:
+            raise ArcanaUsageError("No pipelines provided to {}.plan"
+                                   .format(self))
+        subject_ids = kwargs.pop('subject_ids', None)
+        visit_ids = kwargs.pop('visit_ids', None)
+        session_ids = kwargs.pop('session_ids', None)
+        kwargs.pop('clean_work_dir', None)
+        required_outputs = kwargs.pop('required_outputs', repeat(None))
+        subject_inds, visit_inds, filter_array = self._filter_array(
+            subject_ids, visit_ids, session_ids)
+        stack = self._pipeline_stack(pipelines, required_outputs,
+                                     filter_array, subject_inds, visit_inds)
+        inv_subj_inds = {v: k for k, v in subject_inds.items()}
+        inv_visit_inds = {v: k for k, v in visit_inds.items()}
+
+        def inds_to_ids(array):
+            return [(inv_subj_inds[s], inv_visit_inds[v])
+                    for s, v in zip(*np.nonzero(array))]
+
+        execution_plan = ExecutionPlan()
+        with self.analysis.repository:
+            for pipeline, req_outputs, flt_array in stack:
+                reasons = defaultdict(list)
+                self._set_to_process(pipeline, req_outputs, subject_inds,
+                                     visit_inds, flt_array, reasons=reasons,
+                                     **kwargs)
+                nodes = []
+                for subj_i, visit_i in zip(
+                        *np.nonzero(pipeline.to_process_array)):
+                    node_reasons = reasons.get((subj_i, visit_i))
+                    if not node_reasons:
+                        # Included because the pipeline joins over the
+                        # subjects and/or visits of another node to process
+                        node_reasons = [(JOINED, ', '.join(
+                            sorted(pipeline.joins)))]
+                    nodes.append(PlannedNode(inv_subj_inds[subj_i],
+                                             inv_visit_inds[visit_i],
+                                             node_reasons))
+                execution_plan.append(PipelinePlan(
+                    pipeline.name, nodes,
+                    skipped=inds_to_ids(pipeline.to_skip_array * flt_array),
+                    protected=inds_to_ids(pipeline.to_protect_array
+                                          * flt_array),
+                    wall_time=self._estimate_wall_time(pipeline)))
+        return execution_plan
+
+    def _estimate_wall_time(self, pipeline):
+        """
+        Estimates the wall time (in minutes) required to process a single
+        subject/visit node of the pipeline from the resource history or the
+        wall times specified for its nodes
+
+        Parameters
+        ----------
+        pipeline : Pipeline
+            The pipeline to estimate the wall time of
+
+        Returns
+        -------
+        wall_time : float | None
+            The estimated wall time or None if it can't be estimated
+        """
+        wall_times = []
+        for node in pipeline.nodes:
+            wall_time, _ = self.node_resources(node,
+                                               pipeline_name=pipeline.name)
+            if wall_time is not None:
+                wall_times.append(wall_time)
+        if not wall_times:
+            return None
+        return float(sum(wall_times))
 
-        # Generate filter array to optionally restrict the run to certain
-        # subject and visit IDs.
+    def _filter_array(self, subject_ids, visit_ids, session_ids):
+        """
+        Generates a filter array to optionally restrict processing to certain
+        subject and visit IDs
+
+        Returns
+        -------
+        subject_inds : dct[str, int]
+            A mapping of subject ID to row index in the filter array
+        visit_inds : dct[str, int]
+            A mapping of visit ID to column index in the filter array
+        filter_array : 2-D numpy.array[bool]
+            The sessions to include in the current round of processing
+        """
         tree = self.analysis.dataset.tree
         # Create maps from the subject|visit IDs to an index used to represent
         # them in the filter array
@@ -231,15 +686,12 @@ class Processor(object):
             filter_array = np.zeros((len(subject_inds), len(visit_inds)),
                                     dtype=bool)
             if subject_ids is not None:
-                for subj_id in subject_ids:
-                    filter_array[subject_inds[subj_id], :] = True
+                filter_array[[subject_inds[i] for i in subject_ids], :] = True
             if visit_ids is not None:
-                for visit_id in visit_ids:
-                    filter_array[:, visit_inds[visit_id]] = True
+                filter_array[:, [visit_inds[i] for i in visit_ids]] = True
             if session_ids is not None:
-                for subj_id, visit_id in session_ids:
-                    filter_array[subject_inds[subj_id],
-                                 visit_inds[visit_id]] = True
+                filter_array[[subject_inds[s] for s, _ in session_ids],
+                             [visit_inds[v] for _, v in session_ids]] = True
             if not filter_array.any():
                 raise ArcanaUsageError(
                     "Provided filters:\n"
@@ -252,7 +704,21 @@ class Processor(object):
                     + "Did not match any sessions in the project:\n"
                     + "  subject_ids: {}\n".format(', '.join(subject_inds))
                     + "  visit_ids: {}\n".format(', '.join(visit_inds)))
+        return subject_inds, visit_inds, filter_array
+
+    def _pipeline_stack(self, pipelines, required_outputs, filter_array,
+                        subject_inds, visit_inds):
+        """
+        Resolves the pipelines and their prerequisites that need to be
+        considered for processing, merging the required outputs and filter
+        arrays of pipelines that are referenced multiple times
 
+        Returns
+        -------
+        stack : list[tuple[Pipeline, set[str], 2-D numpy.array[bool]]]
+            The pipelines in order of execution along with their required
+            outputs and filter arrays
+        """
         # Stack of pipelines to process in reverse order of required execution
         stack = OrderedDict()
 
@@ -345,32 +811,65 @@ class Processor(object):
         # Add all primary pipelines to the stack along with their prereqs
         for pipeline, req_outputs in zip(pipelines, required_outputs):
             push_on_stack(pipeline, filter_array, req_outputs)
+        return list(reversed(list(stack.values())))
 
-        # Iterate through stack of required pipelines from upstream to
-        # downstream
-        with self.analysis.repository:
-            for (pipeline, req_outputs,
-                    flt_array) in reversed(list(stack.values())):
-                try:
-                    self._connect_pipeline(
-                        pipeline, req_outputs, workflow, subject_inds,
-                        visit_inds, flt_array, **kwargs)
-                except ArcanaNoRunRequiredException:
-                    logger.info("Not running '{}' pipeline as its outputs "
-                                "are already present in the repository"
-                                .format(pipeline.name))
-        # Save complete graph for debugging purposes
-#         workflow.write_graph(graph2use='flat', format='svg')
-#         print('Graph saved in {} directory'.format(os.getcwd()))
-        # Actually run the generated workflow
-        if workflow._get_all_nodes():  # Check if workflow has any nodes to run
-            result = workflow.run(plugin=self._plugin)
-        else:
-            result = None
-        # Reset the cached tree of filesets in the repository as it will
-        # change after the pipeline has run.
-        self.analysis.clear_caches()
-        return result
+    def _prefetcher(self, pipelines, subject_inds, visit_inds):
+        """
+        Starts a prefetcher to retrieve the acquired inputs of the sessions
+        to be processed by the given pipelines in background threads
+
+        Parameters
+        ----------
+        pipelines : list[Pipeline]
+            The connected pipelines in order of execution
+        subject_inds : dct[str, int]
+            A mapping of subject ID to row index in the filter array
+        visit_inds : dct[str, int]
+            A mapping of visit ID to column index in the filter array
+
+        Returns
+        -------
+        prefetcher : InputPrefetcher | None
+            The started prefetcher or None if prefetching is disabled or there
+            is nothing to prefetch
+        """
+        if not self._prefetch:
+            return None
+        inv_subj_inds = {v: k for k, v in subject_inds.items()}
+        inv_visit_inds = {v: k for k, v in visit_inds.items()}
+        sessions = OrderedDict()
+        seen = set()
+        for pipeline in pipelines:
+            to_process_array = getattr(pipeline, 'to_process_array', None)
+            if to_process_array is None or not to_process_array.any():
+                continue
+            inputs = [i for i in pipeline.inputs
+                      if i.is_fileset and not i.derived]
+            for subj_i, visit_i in zip(*np.nonzero(to_process_array)):
+                subj_id = inv_subj_inds[subj_i]
+                visit_id = inv_visit_inds[visit_i]
+                session_filesets = sessions.setdefault((subj_id, visit_id),
+                                                       [])
+                for inpt in inputs:
+                    try:
+                        fileset = inpt.slice.item(subject_id=subj_id,
+                                                  visit_id=visit_id)
+                    except ArcanaIndexError:
+                        continue
+                    if not fileset.exists or id(fileset) in seen:
+                        continue
+                    seen.add(id(fileset))
+                    session_filesets.append(fileset)
+        sessions = [(k, v) for k, v in sessions.items() if v]
+        if not sessions:
+            return None
+        prefetcher = InputPrefetcher(
+            sessions, lookahead=self._prefetch,
+            max_workers=self._prefetch_workers,
+            max_bandwidth=self._prefetch_bandwidth,
+            progress_dir=self._prefetch_progress_dir)
+        prefetcher.start()
+        return prefetcher
 
     def _connect_pipeline(self, pipeline, required_outputs, workflow,
                           subject_inds, visit_inds, filter_array, force=False):
@@ -404,41 +903,11 @@ class Processor(object):
             array, regardless of whether the parameters|pipeline used
             to generate existing data matches the given pipeline
         """
-        if self.reprocess == 'force':
-            force = True
-        # Close-off construction of the pipeline and created, input and output
-        # nodes and provenance dictionary
-        pipeline.cap()
-        # Prepend prerequisite pipelines to complete workflow if they need
-        # to be (re)processed
-        final_nodes = []
-        # The array that represents the subject/visit pairs for which any
-        # prerequisite pipeline will be (re)processed, and which therefore
-        # needs to be included in the processing of the current pipeline. Row
-        # indices correspond to subjects and column indices visits
-        prqs_to_process_array = np.zeros((len(subject_inds), len(visit_inds)),
-                                         dtype=bool)
-        # The array that represents the subject/visit pairs for which any
-        # prerequisite pipeline will be skipped due to missing inputs. Row
-        # indices correspond to subjects and column indices visits
-        prqs_to_skip_array = np.zeros((len(subject_inds), len(visit_inds)),
-                                      dtype=bool)
-        for getter_name in pipeline.prerequisites:
-            prereq = pipeline.analysis.pipeline(getter_name)
-            if prereq.to_process_array.any():
-                final_nodes.append(prereq.node('final'))
-                prqs_to_process_array |= prereq.to_process_array
-            prqs_to_skip_array |= prereq.to_skip_array
-        # Get list of sessions that need to be processed (i.e. if
-        # they don't contain the outputs of this pipeline)
-        to_process_array, to_protect_array, to_skip_array = self._to_process(
-            pipeline, required_outputs, prqs_to_process_array,
-            prqs_to_skip_array, filter_array, subject_inds, visit_inds, force)
-        # Store the arrays signifying which nodes to process, protect or skip
-        # so they can be passed to downstream pipelines
-        pipeline.to_process_array = to_process_array
-        pipeline.to_protect_array = to_protect_array
-        pipeline.to_skip_array = to_skip_array
+        prereqs_to_process = self._set_to_process(
+            pipeline, required_outputs, subject_inds, visit_inds,
+            filter_array, force=force)
+        final_nodes = [p.node('final') for p in prereqs_to_process]
+        to_process_array = pipeline.to_process_array
         # Check to see if there are any sessions to process
         if not to_process_array.any():
             raise ArcanaNoRunRequiredException(
@@ -458,8 +927,8 @@ class Processor(object):
             prereqs = None
         # Construct iterator structure over subjects and sessions to be
         # processed
-        iter_nodes = self._iterate(pipeline, to_process_array, subject_inds,
-                                   visit_inds)
+        iter_nodes, iter_names = self._iterate(pipeline, to_process_array,
+                                               subject_inds, visit_inds)
         sources = {}
         # Loop through each frequency present in the pipeline inputs and
         # create a corresponding source node
@@ -477,6 +946,9 @@ class Processor(object):
                     i.slice for i in inputs),
                 inputs=({'prereqs': (prereqs, 'out')}
                         if prereqs is not None else {}))
+            if (freq == 'per_session'
+                    and self._prefetch_progress_dir is not None):
+                source.inputs.progress_dir = self._prefetch_progress_dir
             # Connect iter_nodes to source and input nodes
             for iterator in pipeline.iterators(freq):
                 pipeline.connect(iter_nodes[iterator], iterator, source,
@@ -549,7 +1021,9 @@ class Processor(object):
                 '{}_sink'.format(freq),
                 RepositorySink(
                     (o.slice for o in outputs), pipeline,
-                    required_outputs),
+                    required_outputs, metrics_path=(
+                        self._metrics_path if self._metrics_in_prov
+                        else None)),
                 inputs=to_connect)
             # "De-iterate" (join) over iterators to get back to single child
             # node by the time we connect to the final node of the pipeline Set
@@ -557,19 +1031,27 @@ class Processor(object):
             # deiterates (i.e. per_dataset) or to use as the upstream node to
             # connect the first deiterator for every frequency
             deiter_nodes[freq] = sink  # for per_dataset the "deiter" == sink
+            # Get the names of the iterator nodes to join over (NB: both
+            # iterators are provided by the same node when iterating over
+            # explicit lists of subject/visit pairs)
+            joinsources = []
             for iterator in sorted(pipeline.iterators(freq),
                                    key=deiter_node_sort_key):
+                joinsource = iter_names[iterator]
+                if joinsource not in joinsources:
+                    joinsources.append(joinsource)
+            for joinsource in joinsources:
                 # Connect to previous deiterator or sink
                 # NB: we only need to keep a reference to the last one in the
                 # chain in order to connect with the "final" node, so we can
                 # overwrite the entry in the 'deiter_nodes' dict
                 deiter_nodes[freq] = pipeline.add(
-                    '{}_{}_deiter'.format(freq, iterator),
+                    '{}_{}_deiter'.format(freq, joinsource),
                     IdentityInterface(
                         ['checksums']),
                     inputs={
                         'checksums': (deiter_nodes[freq], 'checksums')},
-                    joinsource=iterator,
+                    joinsource=joinsource,
                     joinfield='checksums')
         # Create a final node, which is used to connect with downstream
         # pipelines
@@ -580,6 +1062,222 @@ class Processor(object):
             inputs={
                 'in{}'.format(i): (di, 'checksums')
                 for i, di in enumerate(deiter_nodes.values(), start=1)})
+        if self._resource_history is not None or self._collect_metrics:
+            self._track_resources(pipeline, workflow)
+        if self._conversion_cache is not None:
+            for node in pipeline.nodes:
+                if node.annotations.get('format_conversion'):
+                    node._conversion_cache = self._conversion_cache
+
+    def _track_resources(self, pipeline, workflow):
+        """
+        Sets the nodes of the pipeline to record the resources they use in
+        the resource history and/or metrics file and saves the sizes of the
+        pipeline's input filesets, which are used to scale the measurements
+        between sessions
+        """
+        self._input_sizes[pipeline.name] = self._pipeline_input_sizes(
+            pipeline)
+        input_sizes_path = op.join(workflow.base_dir, workflow.name,
+                                   self.INPUT_SIZES_FNAME)
+        for node in pipeline.nodes:
+            node._resource_history = self._resource_history
+            node._input_sizes_path = input_sizes_path
+            node._metrics_path = (self._metrics_path if self._collect_metrics
+                                  else None)
+
+    def _pipeline_input_sizes(self, pipeline):
+        """
+        Returns the sizes of the input filesets of a pipeline that are
+        present locally
+
+        Returns
+        -------
+        input_sizes : list[tuple[str | None, str | None, int]]
+            (subject ID, visit ID, size in bytes) tuples for each input
+            fileset
+        """
+        input_sizes = []
+        for input in pipeline.inputs:
+            if not input.is_fileset:
+                continue
+            for item in input.slice:
+                # Only use local paths so remote filesets aren't downloaded
+                path = item._path
+                if path is None or not op.exists(path):
+                    continue
+                if op.isdir(path):
+                    size = sum(op.getsize(op.join(d, f))
+                               for d, _, fnames in os.walk(path)
+                               for f in fnames)
+                else:
+                    size = op.getsize(path)
+                input_sizes.append((item.subject_id, item.visit_id, size))
+        return input_sizes
+
+    def _write_input_sizes(self, workflow):
+        "Saves the input sizes to the workflow directory for the nodes"
+        workflow_dir = op.join(workflow.base_dir, workflow.name)
+        if not op.exists(workflow_dir):
+            os.makedirs(workflow_dir)
+        with open(op.join(workflow_dir, self.INPUT_SIZES_FNAME), 'w') as f:
+            json.dump({'subject_id': self.analysis.SUBJECT_ID,
+                       'visit_id': self.analysis.VISIT_ID,
+                       'pipelines': self._input_sizes}, f)
+
+    def node_session(self, node):
+        """
+        Returns the pipeline and session a node of an expanded workflow graph
+        belongs to from its hierarchy and iterable values
+
+        Parameters
+        ----------
+        node : Node
+            A node of the expanded workflow graph
+
+        Returns
+        -------
+        pipeline_name : str | None
+            The name of the pipeline the node belongs to
+        subject_id : str | None
+            The subject ID the node is run for (None if the node isn't
+            iterated over subjects)
+        visit_id : str | None
+            The visit ID the node is run for (None if the node isn't iterated
+            over visits)
+        """
+        hierarchy = (node._hierarchy or '').split('.')
+        pipeline_name = hierarchy[-1] if len(hierarchy) > 1 else None
+        if not node.parameterization:
+            return pipeline_name, None, None
+        return (pipeline_name,) + session_from_parameterization(
+            node.parameterization, self.analysis.SUBJECT_ID,
+            self.analysis.VISIT_ID)
+
+    def node_resources(self, node, pipeline_name=None, subject_id=None,
+                       visit_id=None):
+        """
+        Returns the wall time and memory to request for a node, estimated
+        from the resource history if possible and otherwise from the static
+        hints of the node
+
+        Parameters
+        ----------
+        node : Node
+            The node to estimate the resources of
+        pipeline_name : str | None
+            The name of the pipeline the node belongs to. If None it is
+            determined from the hierarchy of the (expanded) node
+        subject_id : str | None
+            The subject ID the node will be run for. If None it is determined
+            from the iterable values of the node
+        visit_id : str | None
+            The visit ID the node will be run for. If None it is determined
+            from the iterable values of the node
+
+        Returns
+        -------
+        wall_time : float | None
+            The wall time in minutes
+        mem_gb : float
+            The memory in GB
+        """
+        wall_time = getattr(node, 'wall_time', None)
+        mem_gb = node.mem_gb
+        if self._resource_history is None:
+            return wall_time, mem_gb
+        if pipeline_name is None:
+            pipeline_name, subject_id, visit_id = self.node_session(node)
+        input_size = None
+        if pipeline_name in self._input_sizes and (
+                subject_id is not None or visit_id is not None):
+            input_size = session_input_size(self._input_sizes[pipeline_name],
+                                            subject_id, visit_id)
+        est_wall_time, est_mem_gb = self._resource_history.estimate(
+            pipeline_name, node.name, interface_name(node),
+            input_size=input_size)
+        if est_wall_time is not None:
+            wall_time = est_wall_time
+        if est_mem_gb is not None:
+            mem_gb = est_mem_gb
+        return wall_time, mem_gb
+
+    def _set_to_process(self, pipeline, required_outputs, subject_inds,
+                        visit_inds, filter_array, force=False, reasons=None):
+        """
+        Determines the subject/visit nodes of the pipeline to process, protect
+        and skip given the state of the repository and its prerequisite
+        pipelines (which need to have been set previously), and stores them
+        in the 'to_process_array', 'to_protect_array' and 'to_skip_array'
+        attributes of the pipeline so they can be passed to downstream
+        pipelines
+
+        Parameters
+        ----------
+        pipeline : Pipeline
+            The pipeline to determine the nodes to process for
+        required_outputs : set[str] | None
+            The outputs required to be produced by this pipeline. If None all
+            are deemed to be required
+        subject_inds : dct[str, int]
+            A mapping of subject ID to row index in the filter array
+        visit_inds : dct[str, int]
+            A mapping of visit ID to column index in the filter array
+        filter_array : 2-D numpy.array[bool]
+            The subject/visit pairs to include in the current round of
+            processing
+        force : bool | 'all'
+            A flag to force the processing of all sessions in the filter
+            array
+        reasons : dict[tuple[int, int], list[tuple[str, str]]] | None
+            If provided, the reasons each node needs to be processed are
+            appended to it (see _to_process)
+
+        Returns
+        -------
+        prereqs_to_process : list[Pipeline]
+            The prerequisite pipelines that will be (re)processed
+        """
+        if self.reprocess == 'force':
+            force = True
+        # Close-off construction of the pipeline and created, input and output
+        # nodes and provenance dictionary
+        pipeline.cap()
+        prereqs_to_process = []
+        # The array that represents the subject/visit pairs for which any
+        # prerequisite pipeline will be (re)processed, and which therefore
+        # needs to be included in the processing of the current pipeline. Row
+        # indices correspond to subjects and column indices visits
+        prqs_to_process_array = np.zeros((len(subject_inds), len(visit_inds)),
+                                         dtype=bool)
+        # The array that represents the subject/visit pairs for which any
+        # prerequisite pipeline will be skipped due to missing inputs. Row
+        # indices correspond to subjects and column indices visits
+        prqs_to_skip_array = np.zeros((len(subject_inds), len(visit_inds)),
+                                      dtype=bool)
+        for getter_name in pipeline.prerequisites:
+            prereq = pipeline.analysis.pipeline(getter_name)
+            if prereq.to_process_array.any():
+                prereqs_to_process.append(prereq)
+                prqs_to_process_array |= prereq.to_process_array
+            prqs_to_skip_array |= prereq.to_skip_array
+        # Get list of sessions that need to be processed (i.e. if
+        # they don't contain the outputs of this pipeline)
+        to_process_array, to_protect_array, to_skip_array = self._to_process(
+            pipeline, required_outputs, prqs_to_process_array,
+            prqs_to_skip_array, filter_array, subject_inds, visit_inds, force,
+            reasons=reasons)
+        if reasons is not None:
+            for prereq in prereqs_to_process:
+                for inds in zip(*np.nonzero(prereq.to_process_array
+                                            * to_process_array)):
+                    reasons[inds].append((PREREQUISITE, prereq.name))
+        # Store the arrays signifying which nodes to process, protect or skip
+        # so they can be passed to downstream pipelines
+        pipeline.to_process_array = to_process_array
+        pipeline.to_protect_array = to_protect_array
+        pipeline.to_skip_array = to_skip_array
+        return prereqs_to_process
 
     def _iterate(self, pipeline, to_process_array, subject_inds, visit_inds):
         """
@@ -605,6 +1303,10 @@ class Processor(object):
         iter_nodes : dict[str, Node]
             A dictionary containing the nodes to iterate over all subject/visit
             IDs to process for each input frequency
+        iter_names : dict[str, str]
+            The names the iterator nodes were added to the pipeline with
+            (i.e. without the pipeline prefix) for each iterator, which are
+            used as the join sources of the nodes that join over them
         """
         # Check to see whether the subject/visit IDs to process (as specified
         # by the 'to_process' array) can be factorized into indepdent nodes,
@@ -615,6 +1317,15 @@ class Processor(object):
             nz_rows = to_process_array[to_process_array.any(axis=1), :]
             ref_row = nz_rows[0, :]
             factorizable = all((r == ref_row).all() for r in nz_rows)
+            # Iterate over the exact list of subject/visit pairs to process
+            # if the pipeline doesn't need to group them by subject or visit
+            # (i.e. it only has 'per_session' outputs and no joins)
+            if (self._iteration == 'sessions'
+                    or (self._iteration == 'auto' and not factorizable)):
+                if (not pipeline.joins
+                        and pipeline.output_frequencies == {'per_session'}):
+                    return self._iterate_sessions(pipeline, to_process_array,
+                                                  subject_inds, visit_inds)
         # If the subject/visit IDs to process cannot be factorized into
         # indepedent iterators, determine which to make make dependent on the
         # other in order to avoid/minimise duplicatation of download attempts
@@ -648,6 +1359,7 @@ class Processor(object):
         inv_visit_inds = {v: k for k, v in visit_inds.items()}
         # Create iterator for subjects
         iter_nodes = {}
+        iter_names = {}
         if self.analysis.SUBJECT_ID in pipeline.iterators():
             fields = [self.analysis.SUBJECT_ID]
             if dependent == self.analysis.SUBJECT_ID:
@@ -672,6 +1384,7 @@ class Processor(object):
                     [inv_subj_inds[n]
                      for n in to_process_array.any(axis=1).nonzero()[0]])
             iter_nodes[self.analysis.SUBJECT_ID] = subj_it
+            iter_names[self.analysis.SUBJECT_ID] = self.analysis.SUBJECT_ID
         # Create iterator for visits
         if self.analysis.VISIT_ID in pipeline.iterators():
             fields = [self.analysis.VISIT_ID]
@@ -695,17 +1408,62 @@ class Processor(object):
                     [inv_visit_inds[n]
                      for n in to_process_array.any(axis=0).nonzero()[0]])
             iter_nodes[self.analysis.VISIT_ID] = visit_it
+            iter_names[self.analysis.VISIT_ID] = self.analysis.VISIT_ID
         if dependent == self.analysis.SUBJECT_ID:
             pipeline.connect(visit_it, self.analysis.VISIT_ID,
                              subj_it, self.analysis.VISIT_ID)
         if dependent == self.analysis.VISIT_ID:
             pipeline.connect(subj_it, self.analysis.SUBJECT_ID,
                              visit_it, self.analysis.SUBJECT_ID)
-        return iter_nodes
+        return iter_nodes, iter_names
+
+    def _iterate_sessions(self, pipeline, to_process_array, subject_inds,
+                          visit_inds):
+        """
+        Generates a single node that iterates over the exact list of
+        subject/visit pairs to process, instead of separate subject and visit
+        iterators, which avoids the expansion of sparse subject x visit
+        matrices into large numbers of dependent iterations
+
+        Parameters
+        ----------
+        pipeline : Pipeline
+            The pipeline to add the iterator node for
+        to_process_array : 2-D numpy.array[bool]
+            The subject/visit pairs to process
+        subject_inds : dct[str, int]
+            A mapping of subject ID to row index in the 'to_process' array
+        visit_inds : dct[str, int]
+            A mapping of visit ID to column index in the 'to_process' array
+
+        Returns
+        -------
+        iter_nodes : dict[str, Node]
+            The iterator node keyed by both the subject and visit iterators
+        iter_names : dict[str, str]
+            The name the iterator node was added to the pipeline with, keyed
+            by both the subject and visit iterators
+        """
+        inv_subj_inds = {v: k for k, v in subject_inds.items()}
+        inv_visit_inds = {v: k for k, v in visit_inds.items()}
+        subj_inds, vis_inds = np.nonzero(to_process_array)
+        sessions_it = pipeline.add(
+            self.SESSIONS_ITERATOR,
+            IdentityInterface([self.analysis.SUBJECT_ID,
+                               self.analysis.VISIT_ID]))
+        # Synchronize the iterables so they are iterated over in pairs rather
+        # than their product
+        sessions_it.iterables = [
+            (self.analysis.SUBJECT_ID, [inv_subj_inds[i] for i in subj_inds]),
+            (self.analysis.VISIT_ID, [inv_visit_inds[i] for i in vis_inds])]
+        sessions_it.synchronize = True
+        iterators = (self.analysis.SUBJECT_ID, self.analysis.VISIT_ID)
+        return ({i: sessions_it for i in iterators},
+                {i: self.SESSIONS_ITERATOR for i in iterators})
 
     def _to_process(self, pipeline, required_outputs, prqs_to_process_array,
                     to_skip_array, filter_array, subject_inds, visit_inds,
-                    force):
+                    force, reasons=None):
         """
         Check whether the outputs of the pipeline are present in all sessions
         in the project repository and were generated with matching provenance.
@@ -746,6 +1504,11 @@ class Processor(object):
             as it might be dilated by summary outputs (i.e. of frequency
             'per_visit', 'per_subject' or 'per_dataset'). So we still loop
             through all outputs and treat them like they don't exist
+        reasons : dict[tuple[int, int], list[tuple[str, str]]] | None
+            If provided, (kind, detail) pairs describing why each node needs
+            to be processed are appended to the list for its array indices,
+            where kind is one of 'missing output', 'forced', 'provenance
+            mismatch' or 'missing input'
 
         Returns
         -------
@@ -815,12 +1578,31 @@ class Processor(object):
                         to_skip[array_inds(item)].append(item)
         # Dialate array over all iterators that are joined by the pipeline
         to_skip_array = self._dialate_array(to_skip_array, pipeline.joins)
+        subject_ids = {i: s for s, i in subject_inds.items()}
+        visit_ids = {i: v for v, i in visit_inds.items()}
         # Check data tree for missing required outputs
         for output in pipeline.outputs:
             # Check to see if output is required by downstream processing
             required = (required_outputs is None
                         or output.name in required_outputs)
-            for item in output.slice:
+            # Outputs that aren't in the tree are missing from the nodes of
+            # the output's frequency, so only the nodes they are found in need
+            # to be checked item by item
+            nodes = self._summary_array(tree.nodes_array(output.frequency),
+                                        output.frequency)
+            in_tree = self._summary_array(
+                tree.exists_array(output.name, output.analysis.name,
+                                  output.frequency),
+                output.frequency)
+            if required:
+                missing = nodes & ~in_tree
+                to_process_array |= missing
+                if reasons is not None:
+                    for inds in zip(*np.nonzero(missing)):
+                        reasons[inds].append((MISSING_OUTPUT, output.name))
+            for inds in zip(*np.nonzero(in_tree)):
+                item = output.slice.item(subject_id=subject_ids[inds[0]],
+                                         visit_id=visit_ids[inds[1]])
                 if item.exists:
                     # Check to see if checksums recorded when derivative
                     # was generated by previous run match those of current file
@@ -838,10 +1620,16 @@ class Processor(object):
                     elif required:
                         if force:
                             to_process_array[array_inds(item)] = True
+                            if reasons is not None:
+                                reasons[array_inds(item)].append(
+                                    (FORCED, item.name))
                         else:
                             to_check_array[array_inds(item)] = True
                 elif required:
                     to_process_array[array_inds(item)] = True
+                    if reasons is not None:
+                        reasons[array_inds(item)].append(
+                            (MISSING_OUTPUT, item.name))
         # Filter sessions to process by those requested
         to_process_array *= filter_array
         to_check_array *= (filter_array * np.invert(to_process_array))
@@ -886,6 +1674,8 @@ class Processor(object):
                                .format(
                                    pformat(mismatches)))
                         requires_reprocess = True
+                        reason = [(PROV_MISMATCH, p)
+                                  for p in self._mismatch_paths(mismatches)]
                 except ArcanaNameError:
                     msg = "missing provenance record"
                     requires_reprocess = False
@@ -894,9 +1684,12 @@ class Processor(object):
                     msg = ("missing input '{}' and therefore cannot check "
                            "provenance".format(e.name))
                     requires_reprocess = True
+                    reason = [(MISSING_PROV_INPUT, e.name)]
                 if requires_reprocess:
                     if self.reprocess:
                         to_process_array[array_inds(node)] = True
+                        if reasons is not None:
+                            reasons[array_inds(node)].extend(reason)
                         logger.info(
                             "Reprocessing {} with '{}' due to {}"
                             .format(node, pipeline.name, msg))
@@ -978,6 +1771,55 @@ class Processor(object):
                                                pipeline.joins)
         return to_process_array, to_protect_array, to_skip_array
 
+    @classmethod
+    def _mismatch_paths(cls, mismatches):
+        """
+        Converts the paths of provenance mismatches (as returned by
+        Record.mismatches) into '/'-delimited paths
+        """
+        paths = []
+        for changes in mismatches.values():
+            for change in changes:
+                path = re.sub(r"\[(?:'([^']*)'|(\d+))\]",
+                              lambda m: '/' + (m.group(1) or m.group(2)),
+                              str(change))
+                if path.startswith('root/'):
+                    path = path[len('root/'):]
+                if path not in paths:
+                    paths.append(path)
+        return paths
+
+    @classmethod
+    def _summary_array(cls, array, frequency):
+        """
+        Restricts an array of the nodes of a summary frequency (as generated
+        by Tree.exists_array) to its first row and/or column, which is where
+        the summary nodes are marked in the to_process arrays (before they
+        are dialated over their joins)
+
+        Parameters
+        ----------
+        array : np.array[M, N]
+            The array with summary nodes broadcast across rows/columns
+        frequency : str
+            The frequency of the nodes
+
+        Returns
+        -------
+        restricted : np.array[M, N]
+            The restricted array
+        """
+        if frequency == 'per_session' or not array.size:
+            return array
+        restricted = np.zeros_like(array)
+        if frequency == 'per_subject':
+            restricted[:, 0] = array[:, 0]
+        elif frequency == 'per_visit':
+            restricted[0, :] = array[0, :]
+        else:
+            restricted[0, 0] = array[0, 0]
+        return restricted
+
     def _dialate_array(self, array, iterators):
         """
         'Dialates' a to_process/to_protect array to include all subject and/or
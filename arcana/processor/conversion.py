@@ -0,0 +1,357 @@
+from builtins import object
+import os
+import os.path as op
+import stat
+import json
+import time
+import errno
+import shutil
+import hashlib
+import tempfile
+from logging import getLogger
+from nipype.interfaces.base import isdefined
+from arcana.utils import get_class_info, file_md5, reflink
+
+
+logger = getLogger('arcana')
+
+
+class ConversionCache(object):
+    """
+    A local store of the outputs of format conversion nodes (e.g. unzipping
+    a directory or converting a DICOM series to NiFTI), which is used to skip
+    conversions that have already been performed in previous runs or by
+    other pipelines
+
+    Each entry is stored in a sub-directory named after a digest of the
+    checksums of the files passed to the converter, the converter's interface
+    class, its other parameters and the versions of the software it requires.
+    On a cache hit the cached files are cloned (copy-on-write where the
+    file-system supports it, otherwise copied) into the working directory of
+    the node instead of rerunning the conversion, and their checksums are
+    checked against those recorded when they were stored. Cached files are
+    made read-only, and are never linked, so nodes that modify their inputs
+    in place can't corrupt the cache.
+
+    Parameters
+    ----------
+    path : str
+        Path to the directory to store the cache in
+    max_size_gb : float | None
+        The maximum total size of the cached outputs. When it is exceeded, the
+        least recently used entries are evicted. If None the cache isn't
+        bounded
+    """
+
+    META_FNAME = 'meta.json'
+    FILES_DIR = 'files'
+
+    def __init__(self, path, max_size_gb=None):
+        self._path = path
+        self._max_size_gb = max_size_gb
+
+    def __repr__(self):
+        return "{}(path='{}', max_size_gb={})".format(
+            type(self).__name__, self.path, self.max_size_gb)
+
+    def __eq__(self, other):
+        try:
+            return (self.path == other.path
+                    and self.max_size_gb == other.max_size_gb)
+        except AttributeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def max_size_gb(self):
+        return self._max_size_gb
+
+    def key(self, interface, versions=()):
+        """
+        Generates the key of the conversion performed by an interface from
+        the checksums of its input files, its class and parameters and the
+        versions of the software it requires
+
+        Parameters
+        ----------
+        interface : nipype.interfaces.base.Interface
+            The interface of the converter node with its inputs set
+        versions : list[Version]
+            The versions of the software requirements of the node
+
+        Returns
+        -------
+        key : str
+            The hex digest identifying the conversion
+        """
+        inputs = {}
+        for name, value in interface.inputs.trait_get().items():
+            if isdefined(value):
+                inputs[name] = self._input_key(value)
+        key = json.dumps({
+            'interface': get_class_info(type(interface)),
+            'inputs': inputs,
+            'versions': sorted(str(v) for v in versions)},
+            sort_keys=True, default=str)
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def get(self, key, out_dir):
+        """
+        Copies the cached outputs of a conversion into the given directory
+
+        Parameters
+        ----------
+        key : str
+            The key of the conversion (see 'key')
+        out_dir : str
+            The working directory of the node the outputs are copied into
+
+        Returns
+        -------
+        outputs : dict[str, *] | None
+            The values of the outputs of the node, with paths within the
+            cache entry replaced by their copied paths in 'out_dir', or None
+            if the conversion isn't in the cache (or the cached files are
+            corrupted)
+        """
+        entry_dir = op.join(self.path, key)
+        try:
+            with open(op.join(entry_dir, self.META_FNAME)) as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if 'checksums' not in meta:
+            return None  # Stored without checksums so can't be verified
+        files_dir = op.join(entry_dir, self.FILES_DIR)
+        os.makedirs(out_dir, exist_ok=True)
+        for fname in os.listdir(files_dir):
+            checksums = _copy_tree(op.join(files_dir, fname),
+                                   op.join(out_dir, fname))
+            if checksums != meta['checksums'].get(fname):
+                logger.warning(
+                    "Checksums of '{}' in conversion cache entry {} don't "
+                    "match those recorded when it was stored, removing the "
+                    "entry".format(fname, entry_dir))
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                return None
+        # Mark the entry as recently used so it is evicted last
+        os.utime(op.join(entry_dir, self.META_FNAME), None)
+        return {n: _rebase(v, out_dir) for n, v in meta['outputs'].items()}
+
+    def put(self, key, outputs, out_dir):
+        """
+        Stores the outputs of a conversion in the cache, evicting the least
+        recently used entries if the cache exceeds its maximum size
+
+        Parameters
+        ----------
+        key : str
+            The key of the conversion (see 'key')
+        outputs : dict[str, *]
+            The values of the outputs of the node
+        out_dir : str
+            The working directory of the node. Output files within it are
+            copied into the cache
+        """
+        entry_dir = op.join(self.path, key)
+        if op.exists(entry_dir):
+            return
+        os.makedirs(self.path, exist_ok=True)
+        # The entry is assembled in a temporary directory and moved into place
+        # in a single step so that concurrent nodes don't see partial entries
+        tmp_dir = tempfile.mkdtemp(dir=self.path, prefix='.tmp_')
+        try:
+            files_dir = op.join(tmp_dir, self.FILES_DIR)
+            os.mkdir(files_dir)
+            out_dir = op.realpath(out_dir)
+            relative = {}
+            for name, value in outputs.items():
+                relative[name] = _relative(value, out_dir)
+            checksums = {}
+            for fname in _top_level_paths(relative.values()):
+                checksums[fname] = _copy_tree(op.join(out_dir, fname),
+                                              op.join(files_dir, fname),
+                                              read_only=True)
+            meta = {'outputs': relative, 'size': _tree_size(files_dir),
+                    'checksums': checksums, 'time': time.time()}
+            with open(op.join(tmp_dir, self.META_FNAME), 'w') as f:
+                json.dump(meta, f)
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError as e:
+                # Stored by a concurrent node in the meantime
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+        finally:
+            if op.exists(tmp_dir):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        """
+        Lists the entries in the cache
+
+        Returns
+        -------
+        entries : list[(str, int, float)]
+            The key, size (in bytes) and last time each entry was used, sorted
+            from least to most recently used
+        """
+        entries = []
+        if not op.exists(self.path):
+            return entries
+        for key in os.listdir(self.path):
+            meta_path = op.join(self.path, key, self.META_FNAME)
+            try:
+                with open(meta_path) as f:
+                    size = json.load(f)['size']
+                last_used = op.getmtime(meta_path)
+            except (IOError, OSError, ValueError, KeyError):
+                continue  # Temporary directory or partially removed entry
+            entries.append((key, size, last_used))
+        return sorted(entries, key=lambda e: e[2])
+
+    def size(self):
+        "The total size (in bytes) of the entries in the cache"
+        return sum(s for _, s, _ in self.entries())
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits within
+        its maximum size
+        """
+        if self.max_size_gb is None:
+            return
+        max_size = self.max_size_gb * 1024 ** 3
+        entries = self.entries()
+        total = sum(s for _, s, _ in entries)
+        for key, size, _ in entries:
+            if total <= max_size:
+                break
+            logger.debug("Evicting '{}' from conversion cache at {}"
+                         .format(key, self.path))
+            shutil.rmtree(op.join(self.path, key), ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        "Removes all entries from the cache"
+        if op.exists(self.path):
+            shutil.rmtree(self.path)
+
+    @classmethod
+    def _input_key(cls, value):
+        """
+        Replaces paths to existing files and directories in an input value
+        with the checksums of their contents, so the key doesn't depend on
+        where the inputs are located. The base name of the path is kept as
+        converters may use it to name their outputs
+        """
+        if isinstance(value, (list, tuple)):
+            return [cls._input_key(v) for v in value]
+        elif isinstance(value, dict):
+            return {k: cls._input_key(v) for k, v in value.items()}
+        elif isinstance(value, str) and op.exists(value):
+            if op.isdir(value):
+                checksums = {op.relpath(p, value): file_md5(p)
+                             for p in _tree_files(value)}
+            else:
+                checksums = file_md5(value)
+            return {'name': op.basename(value), 'checksums': checksums}
+        return value
+
+
+def _tree_files(path):
+    for dpath, _, fnames in sorted(os.walk(path)):
+        for fname in sorted(fnames):
+            yield op.join(dpath, fname)
+
+
+def _tree_size(path):
+    return sum(op.getsize(p) for p in _tree_files(path))
+
+
+def _relative(value, out_dir):
+    """
+    Replaces paths within the working directory of a node with dictionaries
+    that mark them as relative paths so they can be rebased when the entry is
+    retrieved
+    """
+    if isinstance(value, (list, tuple)):
+        return [_relative(v, out_dir) for v in value]
+    elif isinstance(value, dict):
+        return {k: _relative(v, out_dir) for k, v in value.items()}
+    elif isinstance(value, str) and op.exists(value):
+        path = op.realpath(value)
+        if path.startswith(out_dir + op.sep):
+            return {'relpath': op.relpath(path, out_dir)}
+    return value
+
+
+def _rebase(value, out_dir):
+    "The inverse of '_relative'"
+    if isinstance(value, list):
+        return [_rebase(v, out_dir) for v in value]
+    elif isinstance(value, dict):
+        if set(value) == {'relpath'}:
+            return op.join(out_dir, value['relpath'])
+        return {k: _rebase(v, out_dir) for k, v in value.items()}
+    return value
+
+
+def _top_level_paths(values):
+    "The top-level file or directory names of the relative output paths"
+    names = set()
+    for value in values:
+        if isinstance(value, list):
+            names.update(_top_level_paths(value))
+        elif isinstance(value, dict):
+            if set(value) == {'relpath'}:
+                names.add(value['relpath'].split(op.sep)[0])
+            else:
+                names.update(_top_level_paths(value.values()))
+    return names
+
+
+def _copy_file(src, dst, read_only=False):
+    """
+    Copies a file, as a copy-on-write clone if possible, and returns its MD5
+    digest. The copy is made read-only (for cache entries) or writable by
+    the user (for the working directories of nodes)
+    """
+    if reflink(src, dst):
+        digest = file_md5(dst)
+    else:
+        digest = file_md5(src, copy_to=dst)
+    mode = stat.S_IMODE(os.stat(dst).st_mode)
+    if read_only:
+        mode &= ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+    else:
+        mode |= stat.S_IWUSR
+    os.chmod(dst, mode)
+    return digest
+
+
+def _copy_tree(src, dst, read_only=False):
+    """
+    Copies a file or directory, merging it into the destination directory if
+    it already exists, and returns the MD5 digests of the copied files by
+    their paths relative to 'src'
+    """
+    if not op.isdir(src):
+        return {'.': _copy_file(src, dst, read_only=read_only)}
+    checksums = {}
+    for dpath, _, fnames in os.walk(src):
+        rel_dpath = op.relpath(dpath, src)
+        dst_dpath = op.normpath(op.join(dst, rel_dpath))
+        os.makedirs(dst_dpath, exist_ok=True)
+        for fname in fnames:
+            checksums[op.normpath(op.join(rel_dpath, fname))] = _copy_file(
+                op.join(dpath, fname), op.join(dst_dpath, fname),
+                read_only=read_only)
+    return checksums
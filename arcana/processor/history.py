@@ -0,0 +1,257 @@
+from builtins import object
+import os
+import os.path as op
+import re
+import json
+import time
+from logging import getLogger
+from collections import defaultdict
+import numpy as np
+from arcana.utils import HOSTNAME
+
+
+logger = getLogger('arcana')
+
+
+class ResourceHistory(object):
+    """
+    A local store of the wall times and peak memory measured when running
+    the nodes of pipelines, which is used to estimate the resources to
+    request for future runs of the same nodes in place of the static
+    'wall_time' and 'mem_gb' hints provided to Pipeline.add.
+
+    Measurements are appended to a JSON-lines file, one line per node
+    execution, keyed by the pipeline name, node name and interface class. They
+    are scaled by the size of the input filesets of the session (or
+    subject/visit) the node was run for to estimate the resources required
+    for sessions of a different size. Peak memory is only recorded when
+    NiPype's resource monitor is enabled, otherwise only wall times are.
+
+    Parameters
+    ----------
+    path : str
+        Path to the JSON-lines file to store the history in
+    percentile : float
+        The percentile of the (scaled) past measurements to use as the
+        estimate
+    min_samples : int
+        The minimum number of past measurements required before they are
+        used in place of the static hints
+    padding : float
+        Factor the estimates are multiplied by to allow for variation not
+        accounted for by the input size
+    """
+
+    def __init__(self, path, percentile=90, min_samples=3, padding=1.1):
+        self._path = path
+        self._percentile = percentile
+        self._min_samples = min_samples
+        self._padding = padding
+        self._cache = None
+        self._cache_mtime = None
+
+    def __repr__(self):
+        return "{}(path='{}', percentile={})".format(
+            type(self).__name__, self.path, self.percentile)
+
+    def __eq__(self, other):
+        try:
+            return (self.path == other.path
+                    and self.percentile == other.percentile
+                    and self.min_samples == other.min_samples
+                    and self.padding == other.padding)
+        except AttributeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getstate__(self):
+        dct = dict(self.__dict__)
+        # The cache can be reloaded from the file
+        dct['_cache'] = dct['_cache_mtime'] = None
+        return dct
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def percentile(self):
+        return self._percentile
+
+    @property
+    def min_samples(self):
+        return self._min_samples
+
+    @property
+    def padding(self):
+        return self._padding
+
+    def record(self, pipeline_name, node_name, interface, wall_time, mem_gb,
+               input_size=None):
+        """
+        Appends the resources measured when running a node to the history
+
+        Parameters
+        ----------
+        pipeline_name : str
+            Name of the pipeline the node belongs to
+        node_name : str
+            Name of the node
+        interface : str
+            The module path and name of the class of the node's interface
+        wall_time : float
+            The measured wall time in minutes
+        mem_gb : float | None
+            The measured peak memory usage in GB
+        input_size : int | None
+            The total size (in bytes) of the input filesets of the session the
+            node was run for
+        """
+        line = json.dumps({
+            'pipeline': pipeline_name, 'node': node_name,
+            'interface': interface, 'wall_time': wall_time,
+            'mem_gb': mem_gb, 'input_size': input_size,
+            'host': HOSTNAME, 'time': time.time()}) + '\n'
+        dirname = op.dirname(self.path)
+        if dirname and not op.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        # Each record is written in a single append so concurrent jobs don't
+        # need to lock the file
+        with open(self.path, 'a') as f:
+            f.write(line)
+
+    def estimate(self, pipeline_name, node_name, interface, input_size=None):
+        """
+        Estimates the wall time and memory required to run a node from past
+        measurements
+
+        Parameters
+        ----------
+        pipeline_name : str
+            Name of the pipeline the node belongs to
+        node_name : str
+            Name of the node
+        interface : str
+            The module path and name of the class of the node's interface
+        input_size : int | None
+            The total size (in bytes) of the input filesets of the session
+            the node will be run for. If provided, past measurements are
+            scaled by the ratio of the sizes
+
+        Returns
+        -------
+        wall_time : float | None
+            The estimated wall time in minutes, None if there are not enough
+            past measurements
+        mem_gb : float | None
+            The estimated memory in GB, None if there are not enough past
+            measurements
+        """
+        records = self._records().get((pipeline_name, node_name, interface),
+                                      [])
+        estimates = []
+        for key in ('wall_time', 'mem_gb'):
+            values = []
+            for record in records:
+                value = record.get(key)
+                if value is None:
+                    continue
+                if input_size and record.get('input_size'):
+                    value *= float(input_size) / record['input_size']
+                values.append(value)
+            if len(values) < self.min_samples:
+                estimates.append(None)
+            else:
+                estimates.append(float(np.percentile(values, self.percentile))
+                                 * self.padding)
+        return tuple(estimates)
+
+    def _records(self):
+        "Loads the records from the history file, if it has changed"
+        try:
+            mtime = op.getmtime(self.path)
+        except OSError:
+            return {}
+        if self._cache is None or mtime != self._cache_mtime:
+            records = defaultdict(list)
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Partially written line
+                    records[(record['pipeline'], record['node'],
+                             record['interface'])].append(record)
+            self._cache = dict(records)
+            self._cache_mtime = mtime
+        return self._cache
+
+
+def interface_name(node):
+    "The module path and name of the class of a node's interface"
+    cls = type(node.interface)
+    return '{}.{}'.format(cls.__module__, cls.__name__)
+
+
+def session_from_parameterization(parameterization, subject_id_name,
+                                  visit_id_name):
+    """
+    Extracts the subject and visit IDs a node of an expanded workflow graph
+    is run for from its iterable values
+
+    Parameters
+    ----------
+    parameterization : list[str]
+        The iterable values of the node (i.e. Node.parameterization)
+    subject_id_name : str
+        The name of the subject ID iterator
+    visit_id_name : str
+        The name of the visit ID iterator
+
+    Returns
+    -------
+    subject_id : str | None
+        The subject ID the node is run for (None if the node isn't iterated
+        over subjects or its iterable values couldn't be interpreted)
+    visit_id : str | None
+        The visit ID the node is run for (None if the node isn't iterated
+        over visits or its iterable values couldn't be interpreted)
+    """
+    match = re.match(
+        r'^(?:_{}_(?P<subject_id>.*?))?(?:_{}_(?P<visit_id>.*))?$'.format(
+            subject_id_name, visit_id_name),
+        ''.join(parameterization or ()))
+    if match is None:
+        return None, None
+    return match.group('subject_id'), match.group('visit_id')
+
+
+def session_input_size(input_sizes, subject_id, visit_id):
+    """
+    Sums the sizes of the input filesets that belong to a session, or all
+    sessions of a subject/visit if the visit/subject ID is None
+
+    Parameters
+    ----------
+    input_sizes : list[tuple[str | None, str | None, int]]
+        The sizes of the input filesets of a pipeline as (subject ID, visit ID,
+        size) tuples, where the IDs are None for filesets of lower frequency
+    subject_id : str | None
+        The subject ID of the session
+    visit_id : str | None
+        The visit ID of the session
+
+    Returns
+    -------
+    size : int | None
+        The total size of the inputs, None if the sizes of no inputs were
+        recorded
+    """
+    sizes = [s for subj_id, vis_id, s in input_sizes
+             if (subject_id is None or subj_id is None
+                 or subj_id == subject_id)
+             and (visit_id is None or vis_id is None
+                  or vis_id == visit_id)]
+    return sum(sizes) if sizes else None
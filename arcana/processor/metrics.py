@@ -0,0 +1,328 @@
+from builtins import object
+import os
+import os.path as op
+import sys
+import json
+import time
+from logging import getLogger
+from collections import OrderedDict
+try:
+    import resource
+except ImportError:
+    resource = None  # Not available on Windows
+try:
+    import psutil
+except ImportError:
+    psutil = None
+from arcana.utils import HOSTNAME
+
+
+logger = getLogger('arcana')
+
+
+PROC_IO_PATH = '/proc/self/io'
+
+
+def resource_usage():
+    """
+    Takes a snapshot of the resources used so far by the current process (and
+    its terminated child processes where available), which can be compared
+    with a later snapshot to measure the resources used in between
+
+    Returns
+    -------
+    usage : dict[str, float | None]
+        The time, CPU time (s), peak RSS (bytes) and bytes read/written via
+        system calls, where values that can't be determined on the platform
+        are None
+    """
+    usage = {'time': time.time(), 'cpu_time': None, 'peak_rss': None,
+             'read_bytes': None, 'write_bytes': None}
+    if resource is not None:
+        self_ru = resource.getrusage(resource.RUSAGE_SELF)
+        child_ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+        usage['cpu_time'] = (self_ru.ru_utime + self_ru.ru_stime
+                             + child_ru.ru_utime + child_ru.ru_stime)
+        # ru_maxrss is in bytes on macOS and KB elsewhere
+        usage['peak_rss'] = max(self_ru.ru_maxrss, child_ru.ru_maxrss) * (
+            1 if sys.platform == 'darwin' else 1024)
+    if op.exists(PROC_IO_PATH):
+        with open(PROC_IO_PATH) as f:
+            counters = dict(l.split(':', 1) for l in f if ':' in l)
+        usage['read_bytes'] = int(counters['rchar'])
+        usage['write_bytes'] = int(counters['wchar'])
+    elif psutil is not None:
+        try:
+            counters = psutil.Process().io_counters()
+        except (AttributeError, psutil.Error):
+            pass  # Not supported on the platform (e.g. macOS)
+        else:
+            usage['read_bytes'] = getattr(counters, 'read_chars',
+                                          counters.read_bytes)
+            usage['write_bytes'] = getattr(counters, 'write_chars',
+                                           counters.write_bytes)
+    return usage
+
+
+def usage_between(before, after):
+    """
+    Calculates the resources used between two snapshots taken by
+    'resource_usage'
+
+    Returns
+    -------
+    metrics : dict[str, float | None]
+        The wall time (s), CPU time (s), peak RSS (GB) and bytes
+        read/written. NB: the peak RSS is the peak of the process over its
+        lifetime, not just between the snapshots
+    """
+    def diff(key):
+        if before[key] is None or after[key] is None:
+            return None
+        return after[key] - before[key]
+
+    return {
+        'wall_time': after['time'] - before['time'],
+        'cpu_time': diff('cpu_time'),
+        'peak_rss_gb': (after['peak_rss'] / 1024 ** 3
+                        if after['peak_rss'] is not None else None),
+        'read_bytes': diff('read_bytes'),
+        'write_bytes': diff('write_bytes')}
+
+
+class MetricsLog(object):
+    """
+    A JSON-lines file that the metrics of each node execution in a run are
+    appended to, and that can be summarised by pipeline and node.
+
+    Each record is also appended to a small file for its pipeline, subject
+    and visit in a directory alongside the log (see 'session_path'), so the
+    metrics of a single session can be summarised without reading the
+    records of the whole run
+
+    Parameters
+    ----------
+    path : str
+        Path to the metrics file
+    """
+
+    # The metrics that are summed when aggregating records
+    SUMMED = ('wall_time', 'cpu_time', 'read_bytes', 'write_bytes')
+    COLUMNS = ('Runs', 'Wall (s)', 'CPU (s)', 'Peak RSS (GB)', 'Read (MB)',
+               'Written (MB)')
+    # Name used in place of the subject/visit ID of records of nodes that
+    # aren't iterated over subjects/visits
+    NO_ID = '__none__'
+
+    def __init__(self, path):
+        self._path = path
+
+    def __repr__(self):
+        return "{}(path='{}')".format(type(self).__name__, self.path)
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def sessions_dir(self):
+        "The directory containing the records split by pipeline and session"
+        return op.splitext(self.path)[0]
+
+    def session_path(self, pipeline_name, subject_id=None, visit_id=None):
+        """
+        The path to the file the records of a pipeline's nodes run for the
+        given subject and visit are appended to
+        """
+        return op.join(self.sessions_dir, pipeline_name,
+                       subject_id if subject_id is not None else self.NO_ID,
+                       (visit_id if visit_id is not None else self.NO_ID)
+                       + '.jsonl')
+
+    def append(self, pipeline_name, node_name, interface, metrics,
+               subject_id=None, visit_id=None, repository_io=False):
+        """
+        Appends the metrics measured for a node execution to the log
+
+        Parameters
+        ----------
+        pipeline_name : str
+            Name of the pipeline the node belongs to
+        node_name : str
+            Name of the node
+        interface : str
+            The module path and name of the class of the node's interface
+        metrics : dict[str, float | None]
+            The metrics returned by 'usage_between'
+        subject_id : str | None
+            The subject ID the node was run for
+        visit_id : str | None
+            The visit ID the node was run for
+        repository_io : bool
+            Whether the node reads from or writes to the repository (i.e.
+            is a source or sink node)
+        """
+        record = OrderedDict([
+            ('pipeline', pipeline_name), ('node', node_name),
+            ('interface', interface), ('subject_id', subject_id),
+            ('visit_id', visit_id), ('repository_io', repository_io),
+            ('host', HOSTNAME), ('pid', os.getpid()),
+            ('time', time.time())])
+        record.update(metrics)
+        line = json.dumps(record) + '\n'
+        for path in (self.path,
+                     self.session_path(pipeline_name, subject_id, visit_id)):
+            dirname = op.dirname(path)
+            if dirname and not op.exists(dirname):
+                os.makedirs(dirname, exist_ok=True)
+            # Each record is written in a single append so concurrent jobs
+            # don't need to lock the file
+            with open(path, 'a') as f:
+                f.write(line)
+
+    def records(self):
+        "Reads the records in the log"
+        return self._read(self.path)
+
+    def session_records(self, pipeline_name, subject_id=None, visit_id=None):
+        """
+        Reads the records of the nodes of a pipeline run for a subject and/or
+        visit, including those of nodes that aren't iterated over subjects
+        and/or visits. If the subject (or visit) ID is None the records of
+        all subjects (or visits) are read.
+        """
+        pipeline_dir = op.join(self.sessions_dir, pipeline_name)
+        if not op.exists(pipeline_dir):
+            return []
+        if subject_id is None:
+            subject_ids = os.listdir(pipeline_dir)
+        else:
+            subject_ids = [subject_id, self.NO_ID]
+        records = []
+        for subj_id in subject_ids:
+            subject_dir = op.join(pipeline_dir, subj_id)
+            if not op.isdir(subject_dir):
+                continue
+            if visit_id is None:
+                fnames = os.listdir(subject_dir)
+            else:
+                fnames = [visit_id + '.jsonl', self.NO_ID + '.jsonl']
+            for fname in fnames:
+                records.extend(self._read(op.join(subject_dir, fname)))
+        return records
+
+    def session_summary(self, pipeline_name, subject_id=None, visit_id=None):
+        """
+        Aggregates the records of the nodes of a pipeline run for a subject
+        and/or visit (see 'session_records') by node
+
+        Returns
+        -------
+        summary : dict[str, dict[str, float]]
+            The aggregated metrics of each node (see 'summary'), with metrics
+            that couldn't be determined omitted
+        """
+        summary = self._aggregate(
+            self.session_records(pipeline_name, subject_id, visit_id),
+            group_by=('node',))
+        return {k[0]: {m: v for m, v in agg.items() if v is not None}
+                for k, agg in summary.items()}
+
+    @classmethod
+    def _read(cls, path):
+        records = []
+        if not op.exists(path):
+            return records
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue  # Partially written line
+        return records
+
+    def summary(self, group_by=('pipeline', 'node')):
+        """
+        Aggregates the records in the log
+
+        Parameters
+        ----------
+        group_by : tuple[str]
+            The record fields to group the records by
+
+        Returns
+        -------
+        summary : OrderedDict[tuple, dict[str, float]]
+            The number of runs, summed wall time, CPU time, bytes read/written
+            and maximum peak RSS of each group, along with the wall time
+            spent in repository I/O (i.e. in source and sink nodes)
+        """
+        return self._aggregate(self.records(), group_by)
+
+    @classmethod
+    def _aggregate(cls, records, group_by):
+        summary = OrderedDict()
+        for record in records:
+            key = tuple(record.get(g) for g in group_by)
+            try:
+                agg = summary[key]
+            except KeyError:
+                agg = summary[key] = dict(
+                    [('runs', 0), ('peak_rss_gb', None),
+                     ('repository_io_time', 0.0)]
+                    + [(m, None) for m in cls.SUMMED])
+            agg['runs'] += 1
+            for metric in cls.SUMMED:
+                if record.get(metric) is not None:
+                    agg[metric] = (agg[metric] or 0) + record[metric]
+            if record.get('peak_rss_gb') is not None:
+                agg['peak_rss_gb'] = max(agg['peak_rss_gb'] or 0,
+                                         record['peak_rss_gb'])
+            if record.get('repository_io'):
+                agg['repository_io_time'] += record.get('wall_time') or 0.0
+        return summary
+
+    def report(self, group_by=('pipeline', 'node')):
+        """
+        Formats the summary of the log as a plain-text table
+
+        Parameters
+        ----------
+        group_by : tuple[str]
+            The record fields to group the records by
+
+        Returns
+        -------
+        report : str
+            The formatted table
+        """
+        def fmt(value, scale=1.0, precision=1):
+            if value is None:
+                return '?'
+            return '{:.{}f}'.format(value / scale, precision)
+
+        summary = self.summary(group_by=group_by)
+        header = tuple(g.replace('_', ' ').capitalize() for g in group_by)
+        header += self.COLUMNS
+        rows = []
+        for key, agg in summary.items():
+            rows.append(tuple(str(k) for k in key) + (
+                str(agg['runs']), fmt(agg['wall_time']),
+                fmt(agg['cpu_time']), fmt(agg['peak_rss_gb'], precision=2),
+                fmt(agg['read_bytes'], 1024 ** 2),
+                fmt(agg['write_bytes'], 1024 ** 2)))
+        widths = [max([len(c)] + [len(r[i]) for r in rows])
+                  for i, c in enumerate(header)]
+        lines = ['  '.join(c.ljust(w) for c, w in zip(row, widths)).rstrip()
+                 for row in [header, tuple('-' * w for w in widths)] + rows]
+        total_wall = sum(a['wall_time'] or 0.0 for a in summary.values())
+        repo_io = sum(a['repository_io_time'] for a in summary.values())
+        lines.append(
+            "{} node run(s), total wall time {:.1f}s of which {:.1f}s was "
+            "spent in repository I/O".format(
+                sum(a['runs'] for a in summary.values()), total_wall,
+                repo_io))
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.report()
@@ -0,0 +1,235 @@
+from collections import OrderedDict
+import networkx as nx
+from nipype.pipeline import engine as pe
+from nipype.pipeline.engine.utils import _remove_nonjoin_identity_nodes
+from nipype.interfaces.base import isdefined
+from nipype.interfaces.utility import IdentityInterface, Merge
+from arcana.repository.interfaces import RepositorySink
+
+
+def optimise_workflow(workflow):
+    """
+    Flattens the workflow that the processor has assembled from the
+    pipelines to run and reduces the number of bookkeeping nodes in it
+    before it is executed
+
+        1. pass-through (non-iterable, non-join) identity nodes, such as the
+           input and output nodes of each pipeline, are removed and their
+           connections are made directly between their neighbours
+        2. nodes that would repeat the same work as another node (i.e.
+           same interface, parameters and upstream connections), such as
+           the sources, iterators and format converters of pipelines that
+           consume the same inputs, are merged into a single node
+        3. identity and merge nodes that nothing depends on, such as the
+           deiterators and 'final' node of the last pipeline, are removed
+        4. merge nodes that only feed into another merge node, such as the
+           'final' node of a pipeline and the 'prereqs' node of the single
+           pipeline that depends on it, are fused into a single merge node
+
+    Parameters
+    ----------
+    workflow : nipype.pipeline.engine.Workflow
+        The workflow assembled by the processor
+
+    Returns
+    -------
+    optimised : nipype.pipeline.engine.Workflow
+        A flat workflow with the same name and base directory as the original
+        (so the working directories of the nodes are the same)
+    stats : OrderedDict[str, int]
+        The number of nodes in the flat workflow before and after the
+        optimisation and the number removed by each of the passes
+    """
+    graph = workflow._create_flat_graph()
+    stats = OrderedDict([('nodes_before', graph.number_of_nodes())])
+    num_nodes = graph.number_of_nodes()
+    _remove_nonjoin_identity_nodes(graph, keep_iterables=True)
+    stats['identity_removed'] = num_nodes - graph.number_of_nodes()
+    stats['deduplicated'] = _deduplicate(graph)
+    stats['dead_ends_removed'] = _remove_dead_ends(graph)
+    stats['fused'] = _fuse_merges(graph)
+    stats['nodes_after'] = graph.number_of_nodes()
+    optimised = pe.Workflow(name=workflow.name, base_dir=workflow.base_dir)
+    optimised.config = workflow.config
+    optimised._graph = graph
+    optimised._update_node_cache()
+    return optimised, stats
+
+
+def _deduplicate(graph):
+    """
+    Merges nodes that would repeat the same work as a node earlier in the
+    graph, redirecting their outgoing connections to the retained node
+    """
+    retained = {}
+    renamed = {}
+    num_merged = 0
+    for node in list(nx.topological_sort(graph)):
+        # Update references to iterator nodes that have been merged
+        joinsource = getattr(node, 'joinsource', None)
+        if joinsource in renamed:
+            node.joinsource = renamed[joinsource]
+        if node.itersource and node.itersource[0] in renamed:
+            node.itersource = ((renamed[node.itersource[0]],)
+                               + tuple(node.itersource[1:]))
+        # Sinks have side-effects (and pipeline-specific provenance)
+        if isinstance(node.interface, RepositorySink):
+            continue
+        signature = _node_signature(graph, node)
+        try:
+            prev_node = retained[signature]
+        except KeyError:
+            retained[signature] = node
+            continue
+        for _, dest, data in list(graph.out_edges(node, data=True)):
+            if graph.has_edge(prev_node, dest):
+                graph[prev_node][dest]['connect'].extend(data['connect'])
+            else:
+                graph.add_edge(prev_node, dest, **data)
+        graph.remove_node(node)
+        renamed[node.name] = prev_node.name
+        num_merged += 1
+    return num_merged
+
+
+def _remove_dead_ends(graph):
+    """
+    Removes identity and merge nodes whose outputs aren't used by any other
+    node (and therefore don't need to be run)
+    """
+    num_removed = 0
+    for node in reversed(list(nx.topological_sort(graph))):
+        if (graph.out_degree(node) == 0 and not node.iterables
+                and isinstance(node.interface, (IdentityInterface, Merge))):
+            graph.remove_node(node)
+            num_removed += 1
+    return num_removed
+
+
+def _fuse_merges(graph):
+    """
+    Fuses merge nodes that only feed into a single input of another merge
+    node into the downstream node, by splicing their inputs in place of the
+    input they were connected to
+    """
+    num_fused = 0
+    fused = True
+    while fused:
+        fused = False
+        for node in list(graph.nodes()):
+            if not _is_plain_merge(graph, node):
+                continue
+            out_edges = list(graph.out_edges(node, data=True))
+            if len(out_edges) != 1 or len(out_edges[0][2]['connect']) != 1:
+                continue
+            _, dest, data = out_edges[0]
+            src_field, dest_field = data['connect'][0]
+            if src_field != 'out' or not _is_plain_merge(graph, dest):
+                continue
+            spliced = int(dest_field[2:])
+            # Determine the new input fields of the connections to both nodes
+            new_fields = {}
+            num_inputs = 0
+            for i in range(1, dest.interface._numinputs + 1):
+                if i == spliced:
+                    in_fields = [(node, 'in{}'.format(j)) for j in range(
+                        1, node.interface._numinputs + 1)]
+                else:
+                    in_fields = [(dest, 'in{}'.format(i))]
+                for in_field in in_fields:
+                    num_inputs += 1
+                    new_fields[in_field] = 'in{}'.format(num_inputs)
+            in_edges = [e for e in _chain_edges(graph, node, dest)]
+            graph.remove_node(node)
+            for src, _, _ in in_edges:
+                if graph.has_edge(src, dest):
+                    graph.remove_edge(src, dest)
+            dest._interface = Merge(num_inputs)
+            for src, orig_dest, edge_data in in_edges:
+                connect = [(s, new_fields[(orig_dest, d)])
+                           for s, d in edge_data['connect']]
+                if graph.has_edge(src, dest):
+                    graph[src][dest]['connect'].extend(connect)
+                else:
+                    graph.add_edge(src, dest, connect=connect)
+            num_fused += 1
+            fused = True
+            break
+    return num_fused
+
+
+def _chain_edges(graph, node, dest):
+    "The incoming edges of two nodes, excluding the edge between them"
+    for edge in graph.in_edges(node, data=True):
+        yield edge
+    for edge in graph.in_edges(dest, data=True):
+        if edge[0] is not node:
+            yield edge
+
+
+def _is_plain_merge(graph, node):
+    """
+    Whether the node is a merge node (with default options) that isn't
+    iterated, joined or mapped and whose inputs are all connected to other
+    nodes
+    """
+    if (type(node) is not pe.Node or not isinstance(node.interface, Merge)
+            or node.iterables):
+        return False
+    inputs = node.inputs
+    if inputs.axis != 'vstack' or inputs.no_flatten or inputs.ravel_inputs:
+        return False
+    connected = set(d for _, _, data in graph.in_edges(node, data=True)
+                    for _, d in data['connect'])
+    return all(
+        'in{}'.format(i) in connected
+        or not isdefined(getattr(inputs, 'in{}'.format(i)))
+        for i in range(1, node.interface._numinputs + 1))
+
+
+def _node_signature(graph, node):
+    """
+    A hashable summary of everything that determines the work done by a
+    node: its type, interface, parameters, iteration and the nodes and fields
+    its inputs are connected to
+    """
+    interface_state = {k: v for k, v in vars(node.interface).items()
+                       if k != 'inputs'}
+    connections = sorted(
+        (id(src), repr(s), d)
+        for src, _, data in graph.in_edges(node, data=True)
+        for s, d in data['connect'])
+    return (
+        type(node), type(node.interface),
+        _state_key(interface_state),
+        _state_key(node.inputs.trait_get()),
+        _state_key(node.iterables), node.synchronize,
+        _state_key(node.itersource),
+        getattr(node, 'joinsource', None),
+        _state_key(getattr(node, 'joinfield', None)),
+        _state_key(getattr(node, 'iterfield', None)),
+        tuple(str(v) for v in getattr(node, '_versions', ())),
+        id(getattr(node, '_environment', None)),
+        node.mem_gb, node.n_procs,
+        tuple(connections))
+
+
+def _state_key(value):
+    """
+    Converts a value into a hashable key. Containers are converted
+    recursively, primitive values are used directly and any other objects are
+    represented by their identity, so objects are only considered equal if
+    they are the same object
+    """
+    if value is None or isinstance(value, (str, bytes, int, float, bool)):
+        return value
+    elif isinstance(value, (list, tuple)):
+        return (type(value).__name__,) + tuple(_state_key(v) for v in value)
+    elif isinstance(value, (set, frozenset)):
+        return frozenset(_state_key(v) for v in value)
+    elif isinstance(value, dict):
+        return ('dict',) + tuple(sorted(
+            ((repr(k), _state_key(v)) for k, v in value.items()),
+            key=lambda i: i[0]))
+    else:
+        return ('id', id(value))
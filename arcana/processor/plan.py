@@ -0,0 +1,183 @@
+from builtins import object
+from logging import getLogger
+
+
+logger = getLogger('arcana')
+
+
+# The reasons a node can be included in an execution plan
+MISSING_OUTPUT = 'missing output'
+PROV_MISMATCH = 'provenance mismatch'
+MISSING_PROV_INPUT = 'missing input'
+FORCED = 'forced'
+PREREQUISITE = 'prerequisite rerun'
+JOINED = 'joined'
+
+
+class PlannedNode(object):
+    """
+    A subject/visit node that a pipeline will be run for
+
+    Parameters
+    ----------
+    subject_id : str
+        The subject ID of the node
+    visit_id : str
+        The visit ID of the node
+    reasons : list[tuple[str, str]]
+        The reasons the node needs to be (re)processed as (kind, detail)
+        pairs, where kind is one of 'missing output', 'provenance mismatch',
+        'missing input', 'forced', 'prerequisite rerun' or 'joined'
+    """
+
+    def __init__(self, subject_id, visit_id, reasons):
+        self.subject_id = subject_id
+        self.visit_id = visit_id
+        self.reasons = list(reasons)
+
+    def __repr__(self):
+        return "{}(subject_id={}, visit_id={}, reasons={})".format(
+            type(self).__name__, self.subject_id, self.visit_id, self.reasons)
+
+    @property
+    def reasons_str(self):
+        """The reasons grouped by kind in a single line"""
+        grouped = {}
+        for kind, detail in self.reasons:
+            details = grouped.setdefault(kind, [])
+            if detail and detail not in details:
+                details.append(detail)
+        return '; '.join(
+            '{} ({})'.format(k, ', '.join(d)) if d else k
+            for k, d in grouped.items())
+
+
+class PipelinePlan(object):
+    """
+    The nodes a pipeline will be run for by Processor.run
+
+    Parameters
+    ----------
+    pipeline_name : str
+        The name of the pipeline
+    nodes : list[PlannedNode]
+        The subject/visit nodes that will be processed
+    skipped : list[tuple[str, str]]
+        The (subject ID, visit ID) pairs that will be skipped due to missing
+        inputs
+    protected : list[tuple[str, str]]
+        The (subject ID, visit ID) pairs containing outputs that were modified
+        outside of Arcana and so will not be overwritten
+    wall_time : float | None
+        The estimated wall time (in minutes) to process a single node
+    """
+
+    def __init__(self, pipeline_name, nodes, skipped=(), protected=(),
+                 wall_time=None):
+        self.pipeline_name = pipeline_name
+        self.nodes = list(nodes)
+        self.skipped = list(skipped)
+        self.protected = list(protected)
+        self.wall_time = wall_time
+
+    def __repr__(self):
+        return "{}(pipeline_name='{}', num_nodes={})".format(
+            type(self).__name__, self.pipeline_name, len(self.nodes))
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @property
+    def total_wall_time(self):
+        "The estimated wall time (in minutes) to process all nodes"
+        if self.wall_time is None:
+            return None
+        return self.wall_time * len(self.nodes)
+
+
+class ExecutionPlan(object):
+    """
+    The pipelines and subject/visit nodes that Processor.run would process,
+    in order of execution
+
+    Parameters
+    ----------
+    pipelines : list[PipelinePlan]
+        The plans for each pipeline in order of execution
+    """
+
+    COLUMNS = ('Pipeline', 'Subject', 'Visit', 'Est. time (min)', 'Reasons')
+
+    def __init__(self, pipelines=()):
+        self.pipelines = list(pipelines)
+
+    def __repr__(self):
+        return "{}(pipelines=[{}])".format(
+            type(self).__name__,
+            ', '.join("'{}'".format(p.pipeline_name) for p in self.pipelines))
+
+    def __iter__(self):
+        return iter(self.pipelines)
+
+    def __len__(self):
+        return len(self.pipelines)
+
+    def __getitem__(self, pipeline_name):
+        try:
+            return next(p for p in self.pipelines
+                        if p.pipeline_name == pipeline_name)
+        except StopIteration:
+            raise KeyError(pipeline_name)
+
+    def append(self, pipeline_plan):
+        self.pipelines.append(pipeline_plan)
+
+    @property
+    def num_nodes(self):
+        return sum(len(p) for p in self.pipelines)
+
+    @property
+    def total_wall_time(self):
+        "The estimated wall time (in minutes) to process all nodes serially"
+        return sum(p.total_wall_time for p in self.pipelines
+                   if p.total_wall_time is not None)
+
+    def table(self):
+        """
+        Formats the plan as a plain-text table with a row for each node to
+        process, followed by a summary line
+
+        Returns
+        -------
+        table : str
+            The formatted table
+        """
+        rows = []
+        for pipeline_plan in self.pipelines:
+            wall_time = ('{:.0f}'.format(pipeline_plan.wall_time)
+                         if pipeline_plan.wall_time is not None else '?')
+            for node in pipeline_plan.nodes:
+                rows.append((pipeline_plan.pipeline_name,
+                             str(node.subject_id), str(node.visit_id),
+                             wall_time, node.reasons_str))
+        widths = [max([len(c)] + [len(r[i]) for r in rows])
+                  for i, c in enumerate(self.COLUMNS)]
+        lines = ['  '.join(c.ljust(w) for c, w in zip(row, widths)).rstrip()
+                 for row in [self.COLUMNS, tuple('-' * w for w in widths)]
+                 + rows]
+        lines.append(
+            "{} node(s) to process in {} pipeline(s), estimated total time "
+            "{:.0f} min".format(self.num_nodes,
+                                len([p for p in self.pipelines if p.nodes]),
+                                self.total_wall_time))
+        skipped = sum(len(p.skipped) for p in self.pipelines)
+        if skipped:
+            lines.append("{} node(s) skipped due to missing inputs"
+                         .format(skipped))
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.table()
@@ -0,0 +1,247 @@
+import os
+import os.path as op
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from arcana.utils import ExitStack
+from arcana.exceptions import ArcanaUsageError
+from arcana.repository.interfaces import sourced_marker
+
+
+logger = getLogger('arcana')
+
+
+class InputPrefetcher(object):
+    """
+    Retrieves the inputs of sessions that are about to be processed in a
+    pool of background threads, so that by the time the RepositorySource node
+    of a session runs its inputs are already present in the local cache.
+    For local repositories this is effectively a no-op but for remote
+    repositories (e.g. XNAT) it overlaps the download of data with the
+    computation of previous sessions.
+
+    Parameters
+    ----------
+    sessions : list[tuple[tuple[str, str], list[Fileset]]]
+        The (subject ID, visit ID) pairs to prefetch in the order that they
+        will be processed, along with the filesets to retrieve for each
+    lookahead : int
+        The number of sessions ahead of those that have been sourced by the
+        workflow to retrieve. If 'progress_dir' isn't provided, the progress
+        of the workflow is unknown so it only limits the number of sessions
+        that are queued for retrieval at any one time
+    max_workers : int
+        The maximum number of concurrent retrievals
+    max_bandwidth : float | None
+        The maximum average rate (in MB/s) at which to retrieve data. Once the
+        limit is exceeded retrievals are delayed until the average rate drops
+        below it. If None the rate is unrestricted
+    progress_dir : str | None
+        The directory in which the RepositorySource nodes of the workflow
+        mark the sessions they have sourced (see their 'progress_dir' input)
+    poll_interval : float
+        The interval (in seconds) at which the progress directory is checked
+        while waiting for the workflow to catch up
+    """
+
+    def __init__(self, sessions, lookahead, max_workers=2,
+                 max_bandwidth=None, progress_dir=None, poll_interval=0.5):
+        if lookahead < 1:
+            raise ArcanaUsageError(
+                "Lookahead of prefetcher needs to be a positive integer "
+                "(provided {})".format(lookahead))
+        if max_workers < 1:
+            raise ArcanaUsageError(
+                "Number of prefetch workers needs to be a positive integer "
+                "(provided {})".format(max_workers))
+        self._sessions = list(sessions)
+        self._lookahead = lookahead
+        self._max_workers = max_workers
+        self._max_bandwidth = max_bandwidth
+        self._progress_dir = progress_dir
+        self._poll_interval = poll_interval
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._start_time = None
+        self._num_bytes = 0
+        self._fetched = []
+        self._failed = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def fetched(self):
+        "The filesets that have been retrieved successfully"
+        return list(self._fetched)
+
+    @property
+    def failed(self):
+        "The filesets that couldn't be retrieved and the exception raised"
+        return list(self._failed)
+
+    @property
+    def num_bytes(self):
+        return self._num_bytes
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        Starts the prefetching of inputs in a background thread
+        """
+        if self._thread is not None:
+            raise ArcanaUsageError(
+                "{} has already been started".format(self))
+        self._start_time = self._clock()
+        self._thread = threading.Thread(target=self._run,
+                                        name='arcana-prefetch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, wait=True):
+        """
+        Stops the prefetching of any sessions that are still queued (sessions
+        that are currently being retrieved are allowed to complete)
+
+        Parameters
+        ----------
+        wait : bool
+            Whether to wait for the current retrievals to complete
+        """
+        self._stopped.set()
+        if wait and self._thread is not None:
+            self._thread.join()
+
+    def join(self, timeout=None):
+        """
+        Waits for all sessions to be prefetched
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    @property
+    def num_sourced(self):
+        "The number of sessions that have been sourced by the workflow"
+        if self._progress_dir is None:
+            return 0
+        try:
+            marked = set(os.listdir(self._progress_dir))
+        except OSError:
+            return 0
+        return sum(op.basename(sourced_marker('', *session_id)) in marked
+                   for session_id, _ in self._sessions)
+
+    def _run(self):
+        pending = deque()
+        # Hold a connection to each repository open while prefetching so the
+        # retrievals in the pool share it instead of each connecting and
+        # disconnecting in turn
+        repositories = {}
+        for _, filesets in self._sessions:
+            for fileset in filesets:
+                dataset = getattr(fileset, 'dataset', None)
+                if dataset is not None:
+                    repositories[id(dataset.repository)] = dataset.repository
+        with ExitStack() as stack:
+            for repository in repositories.values():
+                stack.enter_context(repository)
+            with ThreadPoolExecutor(
+                    max_workers=self._max_workers) as executor:
+                for i, (session_id, filesets) in enumerate(self._sessions):
+                    # Wait until the number of queued sessions drops below
+                    # the lookahead before queuing the next one
+                    while len(pending) >= self._lookahead:
+                        pending.popleft().result()
+                    # Wait until the session is within the lookahead of
+                    # those that have been sourced by the workflow
+                    while (self._progress_dir is not None
+                           and not self._stopped.is_set()
+                           and i >= self.num_sourced + self._lookahead):
+                        self._stopped.wait(self._poll_interval)
+                    if self._stopped.is_set():
+                        break
+                    if (self._progress_dir is not None and op.exists(
+                            sourced_marker(self._progress_dir,
+                                           *session_id))):
+                        continue  # Already sourced by the workflow
+                    pending.append(executor.submit(self._fetch_session,
+                                                   session_id, filesets))
+                for future in pending:
+                    future.result()
+        logger.debug("Prefetched {} filesets ({} bytes) in {:.1f}s".format(
+            len(self._fetched), self._num_bytes,
+            self._clock() - self._start_time))
+
+    def _fetch_session(self, session_id, filesets):
+        for fileset in filesets:
+            if self._stopped.is_set():
+                return
+            self._throttle()
+            try:
+                fileset.get()
+            except Exception as e:  # pylint: disable=broad-except
+                # Failures are not fatal as the RepositorySource node will
+                # attempt to retrieve the fileset again and report the
+                # error in the context of the workflow
+                logger.warning(
+                    "Could not prefetch {} for session {}: {}".format(
+                        fileset, session_id, e))
+                with self._lock:
+                    self._failed.append((fileset, e))
+            else:
+                num_bytes = self._size(fileset)
+                with self._lock:
+                    self._num_bytes += num_bytes
+                    self._fetched.append(fileset)
+
+    def _throttle(self):
+        """
+        Delays the next retrieval until the average retrieval rate drops below
+        the maximum bandwidth
+        """
+        if self._max_bandwidth is None:
+            return
+        while not self._stopped.is_set():
+            with self._lock:
+                elapsed = self._clock() - self._start_time
+                delay = (self._num_bytes / (self._max_bandwidth * 1e6)
+                         - elapsed)
+            if delay <= 0:
+                break
+            self._wait(delay)
+
+    def _clock(self):
+        "The current time (in seconds) used to measure the retrieval rate"
+        return time.time()
+
+    def _wait(self, delay):
+        "Waits for the given delay (in seconds) or until stopped"
+        self._stopped.wait(delay)
+
+    @classmethod
+    def _size(cls, fileset):
+        try:
+            if op.isdir(fileset.path):
+                return sum(op.getsize(op.join(root, f))
+                           for root, _, files in os.walk(fileset.path)
+                           for f in files)
+            return sum(op.getsize(p)
+                       for p in [fileset.path]
+                       + list(fileset.aux_files.values()))
+        except (OSError, AttributeError):
+            return 0
+
+    def __repr__(self):
+        return "{}(num_sessions={}, lookahead={}, max_workers={})".format(
+            type(self).__name__, len(self._sessions), self._lookahead,
+            self._max_workers)
@@ -1,10 +1,28 @@
 from builtins import zip
 import math
 import os
+import os.path as op
+import sys
+import time
+import json
+import runpy
+import shlex
+import subprocess as sp
+from collections import OrderedDict, defaultdict
+from logging import getLogger
+import networkx as nx
 from arcana.exceptions import (
-    ArcanaError, ArcanaJobSubmittedException)
+    ArcanaError, ArcanaUsageError, ArcanaJobSubmittedException)
 from .base import Processor
-from nipype.pipeline.plugins.slurmgraph import SLURMGraphPlugin
+from nipype import config as nipype_config, logging as nipype_logging
+from nipype.utils.filemanip import savepkl, loadpkl
+from nipype.pipeline.plugins.slurmgraph import (
+    SLURMGraphPlugin, node_completed_status)
+from nipype.pipeline.plugins.linear import LinearPlugin
+from nipype.pipeline.plugins.multiproc import MultiProcPlugin
+
+
+logger = getLogger('arcana')
 
 
 class ArcanaSlurmGraphPlugin(SLURMGraphPlugin):
@@ -12,6 +30,57 @@ class ArcanaSlurmGraphPlugin(SLURMGraphPlugin):
     def __init__(self, *args, **kwargs):
         self._processor = kwargs.pop('processor')
         super(ArcanaSlurmGraphPlugin, self).__init__(*args, **kwargs)
+        # The jobs submitted to the scheduler, which are recorded in the
+        # submission ledger by SlurmProc
+        self.submitted = []
+
+    def _submit_graph(self, pyfiles, dependencies, nodes):
+        """
+        Submits a job for each node directly with sbatch (instead of via a
+        generated shell script as in SLURMGraphPlugin) so the IDs of the
+        submitted jobs can be recorded
+        """
+        done = {}
+        if getattr(self, '_dont_resubmit_completed_jobs', False):
+            for idx, node in enumerate(nodes):
+                done[idx] = node_completed_status(node) and all(
+                    done[d] for d in dependencies.get(idx, []))
+        job_ids = {}
+        for idx, (pyscript, node) in enumerate(zip(pyfiles, nodes)):
+            if done.get(idx, False):
+                continue
+            template, sbatch_args = self._get_args(
+                node, ['template', 'sbatch_args'])
+            batch_dir, fname = op.split(pyscript)
+            batchscript = op.join(
+                batch_dir, 'batchscript_{}.sh'.format(op.splitext(fname)[0]))
+            with open(batchscript, 'w') as f:
+                f.write('\n'.join((template, '{} {}\n'.format(
+                    sys.executable, pyscript))))
+            name = 'j{}_{}'.format(idx, node._id)
+            for char in '-.:':
+                name = name.replace(char, '_')
+            upstream = [job_ids[d] for d in dependencies.get(idx, [])
+                        if d in job_ids]
+            job_ids[idx] = self._submit(
+                batchscript, name, sbatch_args,
+                dependency=(':'.join(['afterok'] + upstream)
+                            if upstream else None))
+            self._record(job_ids[idx], name, [node])
+        logger.info("Submitted %s nodes to Slurm", len(job_ids))
+
+    def _record(self, job_id, name, nodes):
+        """
+        Records a submitted job along with the pipelines and sessions of the
+        nodes it runs
+        """
+        sessions = []
+        for node in nodes:
+            session = list(self._processor.node_session(node))
+            if session not in sessions:
+                sessions.append(session)
+        self.submitted.append({'job_id': job_id, 'name': name,
+                               'sessions': sessions})
 
     def _get_args(self, node, keywords):
         """
@@ -29,6 +98,336 @@ class ArcanaSlurmGraphPlugin(SLURMGraphPlugin):
                 new_args.append(arg)
         return tuple(new_args)
 
+    def _submit(self, batchscript, name, sbatch_args, dependency=None,
+                array=None):
+        """
+        Submits a batch script to the scheduler with sbatch
+
+        Parameters
+        ----------
+        batchscript : str
+            Path to the batch script to submit
+        name : str
+            Name of the job
+        sbatch_args : str
+            Additional arguments to pass to sbatch
+        dependency : str | None
+            The dependency specification of the job (e.g. 'afterok:1234')
+        array : str | None
+            The range of task indices if submitting a job array
+
+        Returns
+        -------
+        job_id : str
+            The ID of the submitted job
+        """
+        cmd = ['sbatch', '--parsable', '-J', name]
+        task_suffix = ''
+        if array:
+            cmd.append('--array=' + array)
+            task_suffix = '.%a'
+        if '-o ' not in self._sbatch_args:
+            cmd.extend(['-o', batchscript + task_suffix + '.o'])
+        if '-e ' not in self._sbatch_args:
+            cmd.extend(['-e', batchscript + task_suffix + '.e'])
+        if dependency:
+            cmd.append('--dependency=' + dependency)
+        cmd.extend(shlex.split(sbatch_args))
+        cmd.append(batchscript)
+        try:
+            out = sp.check_output(cmd, stderr=sp.STDOUT,
+                                  universal_newlines=True)
+        except (sp.CalledProcessError, OSError) as e:
+            raise ArcanaError(
+                "Could not submit '{}' job with '{}': {}".format(
+                    name, ' '.join(cmd), getattr(e, 'output', e)))
+        # Output of '--parsable' is '<job-id>[;<cluster>]'
+        return out.strip().splitlines()[-1].split(';')[0]
+
+    @classmethod
+    def _write_manifest(cls, path, manifest):
+        with open(path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+
+class ArcanaSlurmArrayPlugin(ArcanaSlurmGraphPlugin):
+    """
+    Submits the expanded workflow graph as Slurm job arrays instead of a
+    separate job for each node. The copies of a node created when expanding
+    the subject/visit iterables are grouped into a single array, with one
+    task per copy. The node each task runs is recorded in a JSON manifest
+    that is read by the task at runtime, and dependencies are expressed
+    between arrays, per-task ('aftercorr') where the tasks of the two arrays
+    correspond one-to-one and on the whole upstream array ('afterok')
+    otherwise.
+    """
+
+    MANIFEST_PREFIX = 'array_'
+
+    def _submit_graph(self, pyfiles, dependencies, nodes):
+        batch_dir = op.dirname(pyfiles[0])
+        # Group the expanded nodes by the workflow node they were cloned
+        # from. As all copies of a node have the same upstream nodes and
+        # 'nodes' is topologically sorted, the groups are in topological
+        # order too
+        groups = OrderedDict()
+        for idx, node in enumerate(nodes):
+            groups.setdefault(self.array_name(node), []).append(idx)
+        # Sort the tasks of each array by their iterable values so that the
+        # tasks of dependent arrays line up
+        task_of = {}
+        for name, inds in groups.items():
+            inds.sort(key=lambda i: tuple(nodes[i].parameterization or ()))
+            for task_id, idx in enumerate(inds):
+                task_of[idx] = (name, task_id)
+        job_ids = {}
+        for name, inds in groups.items():
+            array_deps = self._array_dependencies(name, inds, dependencies,
+                                                  task_of, groups)
+            manifest_path = op.join(batch_dir,
+                                    self.MANIFEST_PREFIX + name + '.json')
+            manifest = {
+                'name': name,
+                'job_id': None,
+                'tasks': [{'node': nodes[i].fullname,
+                           'parameterization': list(
+                               nodes[i].parameterization or ()),
+                           'pyscript': pyfiles[i]} for i in inds],
+                'dependencies': array_deps}
+            self._write_manifest(manifest_path, manifest)
+            template, sbatch_args = self._get_args(
+                nodes[inds[0]], ['template', 'sbatch_args'])
+            batchscript = op.join(batch_dir,
+                                  'batchscript_' + name + '.sh')
+            with open(batchscript, 'w') as f:
+                f.write('\n'.join((
+                    template,
+                    "{} -c \"from arcana.processor.slurm import "
+                    "run_array_task; run_array_task('{}')\"\n".format(
+                        sys.executable, manifest_path))))
+            job_ids[name] = manifest['job_id'] = self._submit(
+                batchscript, name, sbatch_args,
+                dependency=','.join('{}:{}'.format(kind, job_ids[n])
+                                    for n, kind in array_deps.items()),
+                array='0-{}'.format(len(inds) - 1))
+            for task_id, idx in enumerate(inds):
+                self._record('{}_{}'.format(job_ids[name], task_id), name,
+                             [nodes[idx]])
+            self._write_manifest(manifest_path, manifest)
+        logger.info("Submitted %s nodes to Slurm in %s job arrays",
+                    len(nodes), len(groups))
+
+    @classmethod
+    def array_name(cls, node):
+        """
+        The name of the array the node belongs to, i.e. the full name of the
+        workflow node it was copied from when the iterables were expanded
+        """
+        name = node._id.split('.')[0]
+        if node._hierarchy:
+            name = node._hierarchy + '.' + name
+        return name.replace('.', '_').replace('-', '_').replace(':', '_')
+
+    @classmethod
+    def _array_dependencies(cls, name, inds, dependencies, task_of, groups):
+        "Maps the names of the upstream arrays to the type of dependency"
+        upstream = OrderedDict()
+        for task_id, idx in enumerate(inds):
+            for dep in dependencies.get(idx, []):
+                dep_name, dep_task_id = task_of[dep]
+                upstream.setdefault(dep_name, {}).setdefault(
+                    task_id, set()).add(dep_task_id)
+        array_deps = OrderedDict()
+        for dep_name, task_deps in upstream.items():
+            if (len(groups[dep_name]) == len(inds)
+                    and all(task_deps.get(i) == {i}
+                            for i in range(len(inds)))):
+                array_deps[dep_name] = 'aftercorr'
+            else:
+                array_deps[dep_name] = 'afterok'
+        return array_deps
+
+
+class ArcanaSlurmBundlePlugin(ArcanaSlurmGraphPlugin):
+    """
+    Submits a Slurm job for each pipeline and session (or chunk of sessions)
+    instead of a separate job for each node, which runs the nodes of the
+    bundle in-process with either the Linear or MultiProc NiPype plugins.
+
+    The nodes of each pipeline are bundled by their iterable values, i.e.
+    the subject/visit they are run for, and by the number of times their
+    iterable values change along the paths upstream of them within the
+    pipeline (i.e. at joins). The latter ensures there are no cyclic
+    dependencies between the bundles.
+    """
+
+    BUNDLE_PREFIX = 'bundle_'
+    MANIFEST_NAME = 'bundles.json'
+
+    def run(self, graph, config, updatehash=False):
+        bundles = self.bundles(graph, self._processor.bundle_size)
+        first_node = next(iter(graph.nodes()))
+        batch_dir = op.join(first_node.base_dir,
+                            (first_node._hierarchy or '').split('.')[0],
+                            'batch')
+        if not op.exists(batch_dir):
+            os.makedirs(batch_dir)
+        bundle_of = {}
+        for name, nodes in bundles.items():
+            for node in nodes:
+                bundle_of[node] = name
+        manifest = OrderedDict()
+        job_ids = {}
+        for name, nodes in bundles.items():
+            upstream = []
+            for node in nodes:
+                for pred in graph.predecessors(node):
+                    pred_bundle = bundle_of[pred]
+                    if pred_bundle != name and pred_bundle not in upstream:
+                        upstream.append(pred_bundle)
+            bundle_path = op.join(batch_dir, self.BUNDLE_PREFIX + name
+                                  + '.pklz')
+            plugin_args = {}
+            if self._processor.bundle_plugin == 'MultiProc':
+                plugin_args['n_procs'] = max(n.n_procs for n in nodes)
+                plugin_args['memory_gb'] = max(n.mem_gb for n in nodes)
+            savepkl(bundle_path, {
+                'graph': graph.subgraph(nodes).copy(),
+                'config': config,
+                'updatehash': updatehash,
+                'plugin': self._processor.bundle_plugin,
+                'plugin_args': plugin_args})
+            template, sbatch_args = self._get_args(
+                nodes, ['template', 'sbatch_args'])
+            batchscript = op.join(batch_dir, 'batchscript_' + name + '.sh')
+            with open(batchscript, 'w') as f:
+                f.write('\n'.join((
+                    template,
+                    "{} -c \"from arcana.processor.slurm import "
+                    "run_bundle; run_bundle('{}')\"\n".format(
+                        sys.executable, bundle_path))))
+            job_ids[name] = self._submit(
+                batchscript, name, sbatch_args,
+                dependency=':'.join(['afterok'] + [job_ids[u]
+                                                   for u in upstream])
+                if upstream else None)
+            self._record(job_ids[name], name, nodes)
+            manifest[name] = {
+                'job_id': job_ids[name],
+                'nodes': [n.fullname for n in nodes],
+                'dependencies': upstream}
+        self._write_manifest(op.join(batch_dir, self.MANIFEST_NAME),
+                             manifest)
+        logger.info("Submitted %s nodes to Slurm in %s bundled jobs",
+                    graph.number_of_nodes(), len(bundles))
+
+    def _get_args(self, node, keywords):
+        if isinstance(node, (list, tuple)):
+            # Use the node with the largest requirements for the
+            # node-specific plugin args of a bundle
+            node_args = super(ArcanaSlurmBundlePlugin, self)._get_args(
+                max(node, key=lambda n: (n.mem_gb, n.n_procs)), keywords)
+            return tuple(
+                self._processor.slurm_template(node) if k == 'template'
+                else a for k, a in zip(keywords, node_args))
+        return super(ArcanaSlurmBundlePlugin, self)._get_args(node,
+                                                              keywords)
+
+    @classmethod
+    def bundles(cls, graph, bundle_size=1):
+        """
+        Partitions the nodes of an expanded workflow graph into bundles
+
+        Parameters
+        ----------
+        graph : networkx.DiGraph
+            The expanded workflow graph
+        bundle_size : int
+            The number of sessions (or subjects/visits after joins) to
+            include in each bundle
+
+        Returns
+        -------
+        bundles : OrderedDict[str, list[Node]]
+            The nodes in each bundle (in topological order) keyed by the name
+            of the bundle, in topological order of the bundles
+        """
+        stages = {}
+        keys = OrderedDict()
+        for node in nx.topological_sort(graph):
+            params = tuple(node.parameterization or ())
+            stage = 0
+            for pred in graph.predecessors(node):
+                if pred._hierarchy == node._hierarchy:
+                    stage = max(stage, stages[pred] + int(
+                        tuple(pred.parameterization or ()) != params))
+            stages[node] = stage
+            keys[node] = (node._hierarchy or '', stage, params)
+        # Split the distinct iterable values of each stage of each pipeline
+        # into chunks of the bundle size
+        stage_params = defaultdict(set)
+        for hierarchy, stage, params in keys.values():
+            stage_params[(hierarchy, stage)].add(params)
+        chunk_of = {}
+        for stage_key, params_set in stage_params.items():
+            for i, params in enumerate(sorted(params_set)):
+                chunk_of[stage_key + (params,)] = i // bundle_size
+        bundles = OrderedDict()
+        for node, (hierarchy, stage, params) in keys.items():
+            name = '{}_{}_{}'.format(
+                hierarchy.replace('.', '_'), stage,
+                chunk_of[(hierarchy, stage, params)])
+            bundles.setdefault(name, []).append(node)
+        # Order the bundles so that all their upstream bundles come first
+        bundle_of = {n: b for b, nodes in bundles.items() for n in nodes}
+        bundle_graph = nx.DiGraph()
+        bundle_graph.add_nodes_from(bundles)
+        bundle_graph.add_edges_from(
+            (bundle_of[u], bundle_of[v]) for u, v in graph.edges()
+            if bundle_of[u] != bundle_of[v])
+        return OrderedDict((b, bundles[b])
+                           for b in nx.topological_sort(bundle_graph))
+
+
+def run_bundle(bundle_path):
+    """
+    Runs the nodes of a bundle saved by ArcanaSlurmBundlePlugin in the
+    current process
+
+    Parameters
+    ----------
+    bundle_path : str
+        Path to the pickled bundle
+    """
+    bundle = loadpkl(bundle_path)
+    nipype_config.update_config(bundle['config'])
+    nipype_logging.update_logging(nipype_config)
+    plugin_cls = (MultiProcPlugin if bundle['plugin'] == 'MultiProc'
+                  else LinearPlugin)
+    plugin = plugin_cls(plugin_args=bundle['plugin_args'])
+    plugin.run(bundle['graph'], config=bundle['config'],
+               updatehash=bundle['updatehash'])
+
+
+def run_array_task(manifest_path, task_id=None):
+    """
+    Runs the node corresponding to a task of a Slurm job array
+
+    Parameters
+    ----------
+    manifest_path : str
+        Path to the manifest written by ArcanaSlurmArrayPlugin
+    task_id : int | None
+        The index of the task within the array. If None it is read from the
+        'SLURM_ARRAY_TASK_ID' environment variable
+    """
+    if task_id is None:
+        task_id = os.environ['SLURM_ARRAY_TASK_ID']
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    runpy.run_path(manifest['tasks'][int(task_id)]['pyscript'],
+                   run_name='__main__')
+
 
 class SlurmProc(Processor):
     """
@@ -55,6 +454,17 @@ class SlurmProc(Processor):
         Conditions on which to send mail (default 'FAIL')
     max_process_time : float
         The maximum time allowed for the process
+    job_arrays : bool
+        Whether to submit the copies of each node across subjects/visits as
+        a single Slurm job array (see ArcanaSlurmArrayPlugin) instead of a
+        separate job for each copy
+    bundle_size : int | None
+        If provided, the nodes of each pipeline are bundled into a single
+        job for every 'bundle_size' sessions (see ArcanaSlurmBundlePlugin)
+        instead of submitting a separate job for each node
+    bundle_plugin : str
+        The NiPype plugin used to run the nodes of a bundle within its job,
+        either 'Linear' or 'MultiProc'
     reprocess: True|False|'all'
         A flag which determines whether to rerun the processing for this
         step. If set to 'all' then pre-requisite pipelines will also be
@@ -63,9 +473,19 @@ class SlurmProc(Processor):
 
     nipype_plugin_cls = ArcanaSlurmGraphPlugin
 
+    BUNDLE_PLUGINS = ('Linear', 'MultiProc')
+    SLURM_LEDGER_SUFFIX = '_slurm.json'
+    COMPLETED_STATE = 'COMPLETED'
+    # The states of jobs that haven't finished yet
+    ACTIVE_STATES = ('PENDING', 'CONFIGURING', 'RUNNING', 'COMPLETING',
+                     'REQUEUED', 'RESIZING', 'SUSPENDED')
+    # The state of jobs that can't be found by either squeue or sacct
+    UNKNOWN_STATE = 'UNKNOWN'
+
     def __init__(self, work_dir, partition=None, account=None, email=None,
                  mail_on=('FAIL',), generic_resources=None,
-                 ntasks_per_node=None, cpus_per_task=None, **kwargs):
+                 ntasks_per_node=None, cpus_per_task=None, job_arrays=False,
+                 bundle_size=None, bundle_plugin='Linear', **kwargs):
         if email is None:
             try:
                 email = os.environ['EMAIL']
@@ -80,11 +500,28 @@ class SlurmProc(Processor):
         self._ntasks_per_node = ntasks_per_node
         self._cpus_per_task = cpus_per_task
         self._generic_resources = generic_resources
+        if job_arrays and bundle_size is not None:
+            raise ArcanaUsageError(
+                "'job_arrays' and 'bundle_size' cannot both be provided to "
+                "SlurmProc")
+        if bundle_plugin not in self.BUNDLE_PLUGINS:
+            raise ArcanaUsageError(
+                "Unrecognised bundle plugin '{}', can be one of '{}'".format(
+                    bundle_plugin, "', '".join(self.BUNDLE_PLUGINS)))
+        self._job_arrays = job_arrays
+        self._bundle_size = bundle_size
+        self._bundle_plugin = bundle_plugin
+        self._last_submitted = None
         super(SlurmProc, self).__init__(work_dir, **kwargs)
 
     def _init_plugin(self):
-        self._plugin = self.nipype_plugin_cls(processor=self,
-                                              **self._plugin_args)
+        if self._bundle_size is not None:
+            plugin_cls = ArcanaSlurmBundlePlugin
+        elif self._job_arrays:
+            plugin_cls = ArcanaSlurmArrayPlugin
+        else:
+            plugin_cls = self.nipype_plugin_cls
+        self._plugin = plugin_cls(processor=self, **self._plugin_args)
 
     @property
     def email(self):
@@ -106,17 +543,287 @@ class SlurmProc(Processor):
     def account(self):
         return self._account
 
+    @property
+    def job_arrays(self):
+        return self._job_arrays
+
+    @property
+    def bundle_size(self):
+        return self._bundle_size
+
+    @property
+    def bundle_plugin(self):
+        return self._bundle_plugin
+
     def run(self, *pipelines, **kwargs):
+        self._plugin.submitted = []
+        required_outputs = kwargs.get('required_outputs')
+        # Get the keys to regenerate the pipelines before the analysis caches
+        # are cleared by the run
+        pipeline_keys = [self.analysis.pipeline_key(p) for p in pipelines]
         super(SlurmProc, self).run(*pipelines, **kwargs)
+        name = '_'.join(p.name for p in pipelines)[
+            :self.WORKFLOW_MAX_NAME_LEN]
+        if self._plugin.submitted:
+            self._write_ledger(name, pipeline_keys, required_outputs,
+                               self._plugin.submitted)
         raise ArcanaJobSubmittedException(
             "Pipeline '{}' has been submitted to SLURM scheduler "
-            "for processing. Please run script again after the jobs "
-            "have been successful.")
+            "for processing. Use 'status' or 'wait' to monitor the jobs and "
+            "'resume' to resubmit any that failed.".format(name))
+
+    def ledger_path(self, name):
+        "The path to the ledger of the jobs submitted to run 'name'"
+        return op.join(self.work_dir, name + self.SLURM_LEDGER_SUFFIX)
+
+    def _write_ledger(self, name, pipeline_keys, required_outputs, jobs):
+        pipeline_keys = [[k[0], dict(k[1])] if k is not None else None
+                         for k in pipeline_keys]
+        if isinstance(required_outputs, (list, tuple)):
+            required_outputs = [sorted(r) if r is not None else None
+                                for r in required_outputs]
+        else:
+            required_outputs = None
+        ledger = {'name': name,
+                  'pipelines': pipeline_keys,
+                  'required_outputs': required_outputs,
+                  'jobs': jobs}
+        ledger_path = self.ledger_path(name)
+        tmp_path = '{}.{}.tmp'.format(ledger_path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(ledger, f, indent=2)
+        except TypeError:
+            # The pipeline args can't be serialised so the ledger can only be
+            # used to monitor the jobs
+            logger.warning("Could not save the arguments used to create the "
+                           "pipelines of '{}', so it cannot be resumed"
+                           .format(name))
+            ledger['pipelines'] = None
+            with open(tmp_path, 'w') as f:
+                json.dump(ledger, f, indent=2)
+        os.replace(tmp_path, ledger_path)
+        self._last_submitted = name
+
+    def _load_ledger(self, name):
+        if name is None:
+            name = self._last_submitted
+            if name is None:
+                raise ArcanaUsageError(
+                    "No jobs have been submitted by {}, the name of a "
+                    "previous submission needs to be provided".format(self))
+        try:
+            with open(self.ledger_path(name)) as f:
+                return json.load(f)
+        except IOError:
+            raise ArcanaUsageError(
+                "No ledger of jobs submitted for '{}' found in '{}'".format(
+                    name, self.work_dir))
+
+    def job_states(self, job_ids):
+        """
+        Polls the scheduler for the states of the given jobs, first with
+        squeue for the jobs that haven't finished and then with sacct for
+        the rest
+
+        Parameters
+        ----------
+        job_ids : list[str]
+            The IDs of the jobs, including array tasks ('<job-id>_<task-id>')
+
+        Returns
+        -------
+        states : dict[str, str]
+            The state of each job
+        """
+        states = {}
+        job_ids = set(job_ids)
+        for cmd in (['squeue', '-h', '-r', '-o', '%i|%T'],
+                    ['sacct', '-n', '-P', '-X', '-o', 'JobID,State']):
+            remaining = sorted(set(j.split('_')[0] for j in job_ids
+                                   if j not in states))
+            if not remaining:
+                break
+            try:
+                out = sp.check_output(cmd + ['-j', ','.join(remaining)],
+                                      stderr=sp.STDOUT,
+                                      universal_newlines=True)
+            except (sp.CalledProcessError, OSError) as e:
+                logger.warning("Could not poll Slurm with '{}': {}".format(
+                    cmd[0], getattr(e, 'output', e)))
+                continue
+            for line in out.splitlines():
+                if '|' not in line:
+                    continue
+                job_id, state = line.strip().split('|', 1)
+                if job_id in job_ids and job_id not in states and state:
+                    # Strip details such as 'CANCELLED by <uid>'
+                    states[job_id] = state.split()[0]
+        for job_id in job_ids:
+            states.setdefault(job_id, self.UNKNOWN_STATE)
+        return states
+
+    def status(self, name=None):
+        """
+        Polls the scheduler for the states of the jobs submitted to run a
+        workflow
+
+        Parameters
+        ----------
+        name : str | None
+            The name of the submission (i.e. the names of the pipelines run
+            joined by '_'). If None the last submission by the processor is
+            used
+
+        Returns
+        -------
+        status : dict[tuple[str, str, str], str]
+            The state of the jobs of each (pipeline name, subject ID, visit
+            ID) that was submitted. Where there are several jobs for the same
+            pipeline and session the least successful state is reported
+        """
+        ledger = self._load_ledger(name)
+        states = self.job_states([j['job_id'] for j in ledger['jobs']])
+        status = OrderedDict()
+        for job in ledger['jobs']:
+            state = states[job['job_id']]
+            for session in job['sessions']:
+                key = tuple(session)
+                status[key] = max(status.get(key, state), state,
+                                  key=self._state_rank)
+        return status
+
+    def _state_rank(self, state):
+        "Ranks states from successful to unsuccessful"
+        if state == self.COMPLETED_STATE:
+            return 0
+        if state in self.ACTIVE_STATES:
+            return 1 + self.ACTIVE_STATES.index(state)
+        return len(self.ACTIVE_STATES) + 1
+
+    def wait(self, name=None, poll_interval=60, timeout=None):
+        """
+        Waits until all jobs submitted to run a workflow have finished
+
+        Parameters
+        ----------
+        name : str | None
+            The name of the submission (see 'status')
+        poll_interval : float
+            The number of seconds to wait between polling the scheduler
+        timeout : float | None
+            The maximum number of seconds to wait
+
+        Returns
+        -------
+        status : dict[tuple[str, str, str], str]
+            The final states of the jobs (see 'status')
+        """
+        start = time.time()
+        while True:
+            status = self.status(name)
+            if not any(s in self.ACTIVE_STATES for s in status.values()):
+                return status
+            if timeout is not None and time.time() - start > timeout:
+                raise ArcanaError(
+                    "Timed out after {} seconds waiting for the jobs of {} to "
+                    "complete".format(timeout, name))
+            time.sleep(poll_interval)
+
+    def resume(self, name=None, **kwargs):
+        """
+        Resubmits the parts of a previous submission whose jobs failed or
+        never ran. Only the sessions of those jobs are rechecked for
+        processing, instead of all sessions of the analysis
+
+        Parameters
+        ----------
+        name : str | None
+            The name of the submission (see 'status')
+        **kwargs
+            Passed on to 'run'
+
+        Returns
+        -------
+        status : dict[tuple[str, str, str], str]
+            The states of the jobs if they had all completed successfully,
+            otherwise ArcanaJobSubmittedException is raised after the failed
+            jobs are resubmitted
+        """
+        ledger = self._load_ledger(name)
+        status = self.status(ledger['name'])
+        if any(s in self.ACTIVE_STATES for s in status.values()):
+            raise ArcanaUsageError(
+                "Cannot resume '{}' as some of its jobs are still queued or "
+                "running".format(ledger['name']))
+        failed = [k for k, s in status.items() if s != self.COMPLETED_STATE]
+        if not failed:
+            logger.info("All jobs submitted for '{}' completed successfully"
+                        .format(ledger['name']))
+            os.remove(self.ledger_path(ledger['name']))
+            return status
+        if ledger['pipelines'] is None or None in ledger['pipelines']:
+            raise ArcanaUsageError(
+                "Cannot resume '{}' as its pipelines can't be regenerated, "
+                "please rerun it instead".format(ledger['name']))
+        # Map the failed jobs onto the sessions they were run for. Jobs that
+        # aren't specific to a subject or visit (e.g. joins over both) only
+        # require all sessions to be rechecked if nothing more specific
+        # failed
+        all_sessions = set((s, v) for _, s, v in status
+                           if s is not None and v is not None)
+        to_recheck = set()
+        for _, subj_id, visit_id in failed:
+            to_recheck.update(
+                (s, v) for s, v in all_sessions
+                if (subj_id is None or s == subj_id)
+                and (visit_id is None or v == visit_id)
+                and (subj_id is not None or visit_id is not None))
+        if not to_recheck:
+            to_recheck = all_sessions
+        logger.info("Resuming '{}', rechecking {} of {} sessions".format(
+            ledger['name'], len(to_recheck), len(all_sessions)))
+        self.analysis.clear_caches()
+        pipelines = [self.analysis.pipeline(g, pipeline_args=a)
+                     for g, a in ledger['pipelines']]
+        if ledger['required_outputs'] is not None:
+            kwargs.setdefault('required_outputs', [
+                set(r) if r is not None else None
+                for r in ledger['required_outputs']])
+        return self.run(*pipelines, session_ids=sorted(to_recheck),
+                        **kwargs)
 
     def slurm_template(self, node):
+        """
+        Generates the header of the batch script for a node
+
+        Parameters
+        ----------
+        node : Node | list[Node]
+            The node to generate the template for, or the nodes of a bundle,
+            in which case the maximum CPUs and memory required by the nodes
+            are requested along with the sum of their wall times (as they
+            may be run serially). The wall time and memory of each node are
+            estimated from the resource history of the processor if provided
+            (see Processor.node_resources)
+        """
+        if isinstance(node, (list, tuple)):
+            nodes = node
+            resources = [self.node_resources(n) for n in nodes]
+            wall_time = sum(w if w is not None else self._default_wall_time
+                            for w, _ in resources)
+            n_procs = max(n.n_procs for n in nodes)
+            mem_gb = max(m for _, m in resources)
+            # Use the node with the largest requirements to select the
+            # partition
+            node = max(nodes, key=lambda n: (n.mem_gb, n.n_procs))
+        else:
+            nodes = [node]
+            wall_time, mem_gb = self.node_resources(node)
+            n_procs = node.n_procs
         sbatch = self.sbatch_template.format(
-            wall_time=self.wall_time_str(node.wall_time), ntasks=node.n_procs,
-            memory=int(node.mem_gb * 1000),
+            wall_time=self.wall_time_str(wall_time), ntasks=n_procs,
+            memory=int(mem_gb * 1000),
             email=self.email,
             account=self.account)
         if self.account is not None:
@@ -129,7 +836,12 @@ class SlurmProc(Processor):
                            else self._partition))
         if self._generic_resources is not None:
             sbatch += ("\n# Request generic resources\n")
-            for gres in self._generic_resources(node):
+            gres_list = []
+            for n in nodes:
+                for gres in self._generic_resources(n):
+                    if gres not in gres_list:
+                        gres_list.append(gres)
+            for gres in gres_list:
                 sbatch += '#SBATCH --gres={}\n'.format(gres)
         if self._mail_on:
             sbatch += ("\n# Set mail triggers\n")
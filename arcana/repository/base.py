@@ -1,5 +1,7 @@
 from abc import ABCMeta, abstractmethod
 import logging
+import threading
+from arcana.utils import ExitStack
 from .dataset import Dataset
 
 
@@ -15,6 +17,9 @@ class Repository(metaclass=ABCMeta):
 
     def __init__(self):
         self._connection_depth = 0
+        # Guards the connection depth so the repository can be used from
+        # multiple threads (e.g. when prefetching or caching inputs)
+        self._connection_lock = threading.RLock()
 
     def __enter__(self):
         # This allows the repository to be used within nested contexts
@@ -22,15 +27,28 @@ class Repository(metaclass=ABCMeta):
         # methods that need connections, and therefore control their
         # own connection, in batches using the same connection by
         # placing the batch calls within an outer context.
-        if self._connection_depth == 0:
-            self.connect()
-        self._connection_depth += 1
+        with self._connection_lock:
+            if self._connection_depth == 0:
+                self.connect()
+            self._connection_depth += 1
         return self
 
     def __exit__(self, exception_type, exception_value, traceback):
-        self._connection_depth -= 1
-        if self._connection_depth == 0:
-            self.disconnect()
+        with self._connection_lock:
+            self._connection_depth -= 1
+            if self._connection_depth == 0:
+                self.disconnect()
+
+    def __getstate__(self):
+        dct = self.__dict__.copy()
+        del dct['_connection_lock']
+        dct['_connection_depth'] = 0
+        return dct
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._connection_depth = 0
+        self._connection_lock = threading.RLock()
 
     def standardise_name(self, name):
         return name
@@ -152,6 +170,14 @@ class Repository(metaclass=ABCMeta):
         ----------
         fileset : Fileset
             The fileset to insert into the repository
+
+        Returns
+        -------
+        checksums : dict[str, str] | None
+            If the files are read while they are stored (e.g. copied) the
+            repository can calculate their checksums in the same pass and
+            return them (in the format of Fileset.calculate_checksums) to
+            save them being read again. Otherwise None
         """
 
     @abstractmethod
@@ -165,6 +191,44 @@ class Repository(metaclass=ABCMeta):
             The field to insert into the repository
         """
 
+    def put_fields(self, fields):
+        """
+        Inserts or updates multiple fields into the repository. Repositories
+        that can store multiple fields more efficiently in a single operation
+        should override this method
+
+        Parameters
+        ----------
+        fields : list[Field]
+            The fields to insert into the repository
+        """
+        with self:
+            for field in fields:
+                self.put_field(field)
+
+    def stage(self, dataset, frequency, subject_id, visit_id, from_analysis):
+        """
+        Returns a context manager within which the items put into a session
+        (or subject|visit|dataset summary) are staged and then committed
+        together when the context exits, so that the outputs of a pipeline
+        are never left partially written. Repositories that can't stage
+        their items put them directly (the default)
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The dataset the items are put into
+        frequency : str
+            The frequency of the items
+        subject_id : str | None
+            The subject ID of the items
+        visit_id : str | None
+            The visit ID of the items
+        from_analysis : str | None
+            The name of the analysis the items are derived from
+        """
+        return ExitStack()
+
     @abstractmethod
     def put_record(self, record, dataset):
         """
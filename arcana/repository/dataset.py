@@ -2,6 +2,8 @@ import os
 import os.path as op
 import pickle as pkl
 from logging import getLogger
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
 from arcana.exceptions import ArcanaUsageError
 from .tree import Tree
 
@@ -197,6 +199,44 @@ class Dataset():
         """
         return self.repository.get_checksums(fileset)
 
+    def cache_filesets(self, filesets, num_threads=4, show_progress=True):
+        """
+        Retrieves (i.e. downloads for remote repositories) a collection of
+        filesets into the local cache directly, using a pool of threads to
+        transfer multiple filesets concurrently
+
+        Parameters
+        ----------
+        filesets : list[Fileset]
+            The filesets to cache
+        num_threads : int
+            The maximum number of filesets to retrieve concurrently
+        show_progress : bool
+            Whether to display a progress bar
+
+        Returns
+        -------
+        failed : list[tuple[Fileset, Exception]]
+            The filesets that couldn't be retrieved and the exception that
+            was raised for each
+        """
+        filesets = list(filesets)
+        failed = []
+        with self.repository, ThreadPoolExecutor(
+                max_workers=num_threads) as executor:
+            futures = {executor.submit(f.get): f for f in filesets}
+            for future in tqdm(as_completed(futures), total=len(futures),
+                               desc="Caching filesets from '{}'".format(
+                                   self.name),
+                               disable=not show_progress):
+                try:
+                    future.result()
+                except Exception as e:  # pylint: disable=broad-except
+                    fileset = futures[future]
+                    logger.error("Could not cache {}: {}".format(fileset, e))
+                    failed.append((fileset, e))
+        return failed
+
     def put_fileset(self, fileset):
         """
         Inserts or updates the fileset into the repository
@@ -205,9 +245,16 @@ class Dataset():
         ----------
         fileset : Fileset
             The fileset to insert into the repository
+
+        Returns
+        -------
+        checksums : dict[str, str] | None
+            The checksums of the files in the fileset if they were calculated
+            by the repository as it stored them
         """
-        self.repository.put_fileset(fileset)
+        checksums = self.repository.put_fileset(fileset)
         self.clear_cache()
+        return checksums
 
     def put_field(self, field):
         """
@@ -221,6 +268,28 @@ class Dataset():
         self.repository.put_field(field)
         self.clear_cache()
 
+    def put_fields(self, fields):
+        """
+        Inserts or updates multiple fields into the repository in a single
+        operation where possible
+
+        Parameters
+        ----------
+        fields : list[Field]
+            The fields to insert into the repository
+        """
+        self.repository.put_fields(fields)
+        self.clear_cache()
+
+    def stage(self, frequency, subject_id, visit_id, from_analysis):
+        """
+        Returns a context manager within which items put into a session
+        (or summary) of the dataset are committed together on exit (see
+        Repository.stage)
+        """
+        return self.repository.stage(self, frequency, subject_id, visit_id,
+                                     from_analysis)
+
     def put_record(self, record):
         """
         Inserts a provenance record into a session or subject|visit|analysis
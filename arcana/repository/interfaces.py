@@ -1,8 +1,11 @@
+import os.path as op
+from urllib.parse import quote
 from arcana.utils import ExitStack
 from nipype.interfaces.base import (
     traits, DynamicTraitedSpec, Undefined, File, Directory,
     BaseInterface, isdefined)
 from itertools import chain
+from collections import defaultdict
 from copy import copy
 from arcana.utils import PATH_SUFFIX, FIELD_SUFFIX, CHECKSUM_SUFFIX
 from arcana.pipeline.provenance import Record
@@ -22,6 +25,15 @@ JOINED_CHECKSUM_TRAIT = traits.Either(
     traits.List(traits.List(CHECKSUM_TRAIT)))
 
 
+def sourced_marker(progress_dir, subject_id, visit_id):
+    """
+    The path of the file that a RepositorySource node touches in its
+    'progress_dir' once it has sourced the inputs of a session
+    """
+    return op.join(progress_dir, '{}__{}'.format(
+        quote(str(subject_id), safe=''), quote(str(visit_id), safe='')))
+
+
 class RepositoryInterface(BaseInterface):
     """
     Parameters
@@ -121,6 +133,10 @@ class RepositorySourceInputSpec(RepositorySpec):
               " Only passed here to ensure that prerequisites are processed "
               "before this source is run (so that their outputs exist in the "
               "repository)"))
+    progress_dir = traits.Str(
+        desc=("A directory in which to mark the sessions that have been "
+              "sourced, used to track the progress of the workflow (e.g. by "
+              "the input prefetcher)"))
 
 
 class RepositorySource(RepositoryInterface):
@@ -177,6 +193,9 @@ class RepositorySource(RepositoryInterface):
                 field = field_slice.item(subject_id, visit_id)
                 field.get()
                 outputs[field_slice.name + FIELD_SUFFIX] = field.value
+        if isdefined(self.inputs.progress_dir):
+            open(sourced_marker(self.inputs.progress_dir, subject_id,
+                                visit_id), 'w').close()
         return outputs
 
 
@@ -204,12 +223,17 @@ class RepositorySink(RepositoryInterface):
     required : list[str]
         Names of derivatives that are required by downstream nodes. Any
         undefined required derivatives that are undefined will raise an error.
+    metrics_path : str | None
+        Path to the metrics file of the run (see
+        arcana.processor.metrics.MetricsLog). If provided, the metrics of the
+        upstream nodes of the pipeline are summarised in the provenance record
     """
 
     input_spec = RepositorySpec
     output_spec = RepositorySinkOutputSpec
 
-    def __init__(self, collections, pipeline, required=()):
+    def __init__(self, collections, pipeline, required=(),
+                 metrics_path=None):
         super(RepositorySink, self).__init__(collections)
         # Add traits for filesets to sink
         for fileset_slice in self.fileset_collections:
@@ -242,6 +266,7 @@ class RepositorySink(RepositoryInterface):
         self._pipeline_name = pipeline.name
         self._from_analysis = pipeline.analysis.name
         self._required = required
+        self._metrics_path = metrics_path
 
     def _list_outputs(self):
         outputs = self.output_spec().get()
@@ -261,6 +286,12 @@ class RepositorySink(RepositoryInterface):
             # Connect to set of repositories that the collections come from
             for repository in self.repositories:
                 stack.enter_context(repository)
+            # Stage the outputs so they are committed together with the
+            # provenance record once it has been written
+            for dataset in self.datasets:
+                stack.enter_context(dataset.stage(
+                    self.frequency, subject_id, visit_id,
+                    self._from_analysis))
             for fileset_slice in self.fileset_collections:
                 fileset = fileset_slice.item(subject_id, visit_id)
                 path = getattr(self.inputs, fileset_slice.name + PATH_SUFFIX)
@@ -270,6 +301,8 @@ class RepositorySink(RepositoryInterface):
                     continue  # skip the upload for this fileset
                 fileset.path = path  # Push to repository
                 output_checksums[fileset.name] = fileset.checksums
+            # Group fields by dataset so they can be pushed in bulk
+            fields_to_put = defaultdict(list)
             for field_slice in self.field_collections:
                 field = field_slice.item(
                     subject_id,
@@ -280,13 +313,19 @@ class RepositorySink(RepositoryInterface):
                     if field.name in self._required:
                         missing_inputs.append(field.name)
                     continue  # skip the upload for this field
-                field.value = value  # Push to repository
+                field.set_value(value, put=False)
+                if field.dataset is not None:
+                    fields_to_put[field.dataset].append(field)
                 output_checksums[field.name] = field.value
+            for dataset, fields in fields_to_put.items():
+                dataset.put_fields(fields)  # Push to repository
             # Add input and output checksums to provenance record and sink to
             # all repositories that have received data (typically only one)
             prov = copy(self._prov)
             prov['inputs'] = input_checksums
             prov['outputs'] = output_checksums
+            if self._metrics_path is not None:
+                prov['metrics'] = self._metrics(subject_id, visit_id)
             record = Record(self._pipeline_name, self.frequency, subject_id,
                             visit_id, self._from_analysis, prov)
             for dataset in self.datasets:
@@ -299,3 +338,12 @@ class RepositorySink(RepositoryInterface):
         # Return cache file paths
         outputs['checksums'] = output_checksums
         return outputs
+
+    def _metrics(self, subject_id, visit_id):
+        """
+        Summarises the metrics recorded for the nodes of the pipeline that
+        were run for the subject and/or visit of the sink
+        """
+        from arcana.processor.metrics import MetricsLog
+        return MetricsLog(self._metrics_path).session_summary(
+            self._pipeline_name, subject_id, visit_id)
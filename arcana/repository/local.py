@@ -2,10 +2,16 @@ import os
 import os.path as op
 import errno
 from itertools import chain
+from collections import defaultdict
 import stat
 import shutil
 import logging
 import json
+import time
+import threading
+import tempfile
+from uuid import uuid4
+from contextlib import contextmanager
 from fasteners import InterProcessLock
 from arcana.data import Fileset, Field
 from arcana.pipeline.provenance import Record
@@ -14,7 +20,8 @@ from arcana.exceptions import (
     ArcanaRepositoryError,
     ArcanaMissingDataException,
     ArcanaInsufficientRepoDepthError)
-from arcana.utils import get_class_info, HOSTNAME, split_extension
+from arcana.utils import (
+    get_class_info, HOSTNAME, split_extension, file_md5, reflink)
 from .base import Repository
 
 
@@ -42,6 +49,30 @@ class LocalFileSystemRepo(Repository):
         sub-directories for each subject, and if depth == 2 there is
         an additional layer of sub-directories for each visit of each
         subject.
+    put_strategy : str
+        The strategy used to transfer filesets into the repository when they
+        are put (e.g. by a RepositorySink node). Strategies that don't copy
+        the data fall back to copying if the source and destination are on
+        different devices or the file-system doesn't support them.
+
+            'copy' -> copy the data
+            'reflink' -> create copy-on-write clones of the files (Linux
+                         file-systems that support FICLONE only, e.g. Btrfs,
+                         XFS)
+            'link' -> create hard links to the files. NB: any subsequent
+                      in-place modification of the source files will alter
+                      the files in the repository
+            'move' -> move (rename) the files into the repository. NB: the
+                      source files will no longer exist after they are put
+            'auto' -> 'reflink' if supported otherwise 'copy'
+
+    Outputs of a pipeline for a session are written to a hidden staging
+    directory within the session directory and only moved into place once the
+    provenance record has been written to it (see `stage`). Stages left behind
+    by processes that crashed or were killed mid-sink are rolled forward (if
+    they were committed) or removed (if they weren't) by `find_data`. Stages
+    created on other hosts are only removed once their heartbeat file hasn't
+    been touched for `STALE_STAGE_TIMEOUT` seconds.
     """
 
     type = 'directory'
@@ -49,9 +80,36 @@ class LocalFileSystemRepo(Repository):
     FIELDS_FNAME = 'fields.json'
     PROV_DIR = '__prov__'
     LOCK_SUFFIX = '.lock'
+    STAGING_DIR = '.staging'
+    COMMITTED_SUFFIX = '.committed'
+    HEARTBEAT_FNAME = '.heartbeat'
+    # The interval (in seconds) at which the heartbeat file of an uncommitted
+    # stage is touched by the process that owns it
+    HEARTBEAT_INTERVAL = 60
+    # The time (in seconds) since the last heartbeat after which uncommitted
+    # stages created on other hosts are considered to have been abandoned
+    STALE_STAGE_TIMEOUT = 600
     DEFAULT_SUBJECT_ID = 'SUBJECT'
     DEFAULT_VISIT_ID = 'VISIT'
     MAX_DEPTH = 2
+    PUT_STRATEGIES = ('copy', 'reflink', 'link', 'move', 'auto')
+    # Stages that are in progress within this process, shared between all
+    # instances as sinks hold their own copies of the repository
+    _live_stages = set()
+    _live_stages_lock = threading.Lock()
+
+    def __init__(self, put_strategy='auto'):
+        super(LocalFileSystemRepo, self).__init__()
+        if put_strategy not in self.PUT_STRATEGIES:
+            raise ArcanaUsageError(
+                "Unrecognised put strategy '{}', can be one of '{}'"
+                .format(put_strategy, "', '".join(self.PUT_STRATEGIES)))
+        self._put_strategy = put_strategy
+        self._stages = {}
+
+    @property
+    def put_strategy(self):
+        return self._put_strategy
 
     def __repr__(self):
         return "{}()".format(type(self).__name__)
@@ -130,27 +188,137 @@ class LocalFileSystemRepo(Repository):
 
     def put_fileset(self, fileset):
         """
-        Inserts or updates a fileset in the repository
+        Inserts or updates a fileset in the repository, calculating the
+        checksums of the files as they are transferred so they only need to
+        be read once
+
+        Returns
+        -------
+        checksums : dict[str, str] | None
+            The checksums of the files in the fileset relative to its new
+            location in the repository
         """
         target_path = self.fileset_path(fileset)
+        if op.exists(target_path) and op.samefile(fileset.path, target_path):
+            return None  # Fileset is already in place
+        target_path = self._staged_path(target_path, fileset)
+        digests = {}
         if op.isfile(fileset.path):
-            shutil.copyfile(fileset.path, target_path)
+            digests[target_path] = self._transfer_file(fileset.path,
+                                                       target_path)
             # Copy side car files into repository
-            for aux_name, aux_path in fileset.format.default_aux_file_paths(
-                    target_path).items():
-                shutil.copyfile(fileset.format.aux_files[aux_name], aux_path)
+            aux_files = fileset.format.default_aux_file_paths(target_path)
+            for aux_name, aux_path in aux_files.items():
+                digests[aux_path] = self._transfer_file(
+                    fileset.aux_files[aux_name], aux_path)
         elif op.isdir(fileset.path):
+            aux_files = {}
             if op.exists(target_path):
                 shutil.rmtree(target_path)
-            shutil.copytree(fileset.path, target_path)
+
+            def transfer(src_path, dst_path):
+                digests[dst_path] = self._transfer_file(src_path, dst_path)
+
+            if self._put_strategy == 'move':
+                try:
+                    os.rename(fileset.path, target_path)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    shutil.copytree(fileset.path, target_path,
+                                    copy_function=transfer)
+                else:
+                    digests = {op.join(root, f): file_md5(op.join(root, f))
+                               for root, _, files in os.walk(target_path)
+                               for f in files}
+            else:
+                shutil.copytree(fileset.path, target_path,
+                                copy_function=transfer)
         else:
             assert False
+        if self._put_strategy == 'move' and not op.exists(fileset.path):
+            # Point the fileset to its new location
+            fileset._path = target_path
+            fileset._aux_files = dict(aux_files)
+        return {op.relpath(p, target_path): d for p, d in digests.items()}
+
+    def _transfer_file(self, src_path, dst_path):
+        """
+        Transfers a single file into the repository using the put strategy of
+        the repository, falling back to a plain copy if the strategy isn't
+        supported between the source and destination paths. The MD5 digest
+        of the file is calculated as it is copied, or from the transferred
+        file if it isn't copied.
+
+        Parameters
+        ----------
+        src_path : str
+            The path to the file to transfer
+        dst_path : str
+            The path to transfer the file to (overwritten if present)
+
+        Returns
+        -------
+        digest : str
+            The MD5 hex digest of the file
+        """
+        transferred = False
+        if self._put_strategy in ('reflink', 'auto'):
+            transferred = reflink(src_path, dst_path)
+        elif self._put_strategy == 'link':
+            # Link to a temporary path and then rename over the destination
+            # so an existing file is replaced atomically
+            tmp_path = dst_path + '.link'
+            if op.lexists(tmp_path):
+                os.remove(tmp_path)
+            try:
+                os.link(src_path, tmp_path)
+            except OSError:
+                pass
+            else:
+                os.replace(tmp_path, dst_path)
+                transferred = True
+        elif self._put_strategy == 'move':
+            try:
+                os.replace(src_path, dst_path)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+            else:
+                transferred = True
+        if transferred:
+            return file_md5(dst_path)
+        # Copy the file and calculate its digest in a single pass
+        return file_md5(src_path, copy_to=dst_path)
 
     def put_field(self, field):
         """
         Inserts or updates a field in the repository
         """
-        fpath = self.fields_json_path(field)
+        self.put_fields([field])
+
+    def put_fields(self, fields):
+        """
+        Inserts or updates multiple fields in the repository. Fields stored in
+        the same fields JSON file are written together while holding the lock
+        on the file only once, and the file is replaced atomically so it is
+        never read in a partially written state
+        """
+        fields_by_path = defaultdict(list)
+        for field in fields:
+            fields_by_path[self._staged_path(
+                self.fields_json_path(field))].append(field)
+        for fpath, path_fields in fields_by_path.items():
+            self._update_fields_json(
+                fpath, {f.name: (list(f.value) if f.array else f.value)
+                        for f in path_fields})
+
+    def _update_fields_json(self, fpath, values):
+        """
+        Updates the values stored in a fields JSON file while holding the lock
+        on the file, replacing the file atomically so it is never read in a
+        partially written state
+        """
         # Open fields JSON, locking to prevent other processes
         # reading or writing
         with InterProcessLock(fpath + self.LOCK_SUFFIX, logger=logger):
@@ -162,19 +330,245 @@ class LocalFileSystemRepo(Repository):
                     dct = {}
                 else:
                     raise
-            if field.array:
-                dct[field.name] = list(field.value)
-            else:
-                dct[field.name] = field.value
-            with open(fpath, 'w') as f:
+            dct.update(values)
+            tmp_path = '{}.{}.tmp'.format(fpath, os.getpid())
+            with open(tmp_path, 'w') as f:
                 json.dump(dct, f, indent=2)
+            os.replace(tmp_path, fpath)
 
     def put_record(self, record, dataset):
-        fpath = self.prov_json_path(record, dataset)
+        fpath = self._staged_path(self.prov_json_path(record, dataset))
         if not op.exists(op.dirname(fpath)):
             os.mkdir(op.dirname(fpath))
         record.save(fpath)
 
+    @contextmanager
+    def stage(self, dataset, frequency, subject_id, visit_id, from_analysis):
+        """
+        Stages all filesets, fields and provenance records put into the
+        session within the context in a hidden directory within the session
+        directory. On exit, the stage is committed by renaming it (atomically)
+        after everything, including the provenance record, has been written to
+        it, and then its contents are moved into place. If an exception is
+        raised within the context the stage is discarded.
+
+        If the process is killed before the stage is committed the partially
+        written outputs are never visible and the stage is removed the next
+        time the data is found. If it is killed after the stage is committed
+        but before the outputs are all in place, they are moved into place the
+        next time the data is found.
+        """
+        sess_dir = self._session_dir(dataset, frequency, subject_id, visit_id,
+                                     from_analysis)
+        if sess_dir in self._stages:
+            yield  # Already staging outputs for this session
+            return
+        stage_dir = op.join(sess_dir, self.STAGING_DIR, '{}_{}_{}'.format(
+            HOSTNAME, os.getpid(), uuid4().hex))
+        os.makedirs(stage_dir, stat.S_IRWXU | stat.S_IRWXG)
+        with self._live_stages_lock:
+            self._live_stages.add(stage_dir)
+        stop_heartbeat = self._start_heartbeat(stage_dir)
+        moved = []  # Filesets that have been moved into the stage
+        self._stages[sess_dir] = (stage_dir, moved)
+        try:
+            yield
+        except BaseException:
+            stop_heartbeat.set()
+            shutil.rmtree(stage_dir, ignore_errors=True)
+            with self._live_stages_lock:
+                self._live_stages.discard(stage_dir)
+            # Remove the staging and session directories if they are empty
+            for dpath in (op.dirname(stage_dir), sess_dir):
+                try:
+                    os.rmdir(dpath)
+                except OSError:
+                    break
+            raise
+        finally:
+            del self._stages[sess_dir]
+        stop_heartbeat.set()
+        committed_dir = stage_dir + self.COMMITTED_SUFFIX
+        try:
+            os.remove(op.join(stage_dir, self.HEARTBEAT_FNAME))
+            os.rename(stage_dir, committed_dir)
+        finally:
+            with self._live_stages_lock:
+                self._live_stages.discard(stage_dir)
+        self._apply_stage(committed_dir, sess_dir)
+        # Point filesets that were moved into the stage to their final location
+        for fileset in moved:
+            fileset._path = op.join(sess_dir,
+                                    op.relpath(fileset._path, stage_dir))
+            fileset._aux_files = {
+                n: op.join(sess_dir, op.relpath(p, stage_dir))
+                for n, p in fileset._aux_files.items()}
+        try:
+            os.rmdir(op.dirname(stage_dir))
+        except OSError:
+            pass  # Other stages are present
+
+    def _start_heartbeat(self, stage_dir):
+        """
+        Creates a heartbeat file in the stage and touches it periodically in a
+        background thread, so that processes on other hosts can tell the stage
+        is still in progress however long its outputs take to write
+
+        Returns
+        -------
+        stop : threading.Event
+            Event to set to stop the heartbeat
+        """
+        fpath = op.join(stage_dir, self.HEARTBEAT_FNAME)
+        open(fpath, 'w').close()
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.HEARTBEAT_INTERVAL):
+                try:
+                    os.utime(fpath, None)
+                except OSError:
+                    return  # Stage has been committed or removed
+
+        thread = threading.Thread(target=beat, name='heartbeat')
+        thread.daemon = True
+        thread.start()
+        return stop
+
+    def _staged_path(self, path, fileset=None):
+        """
+        Maps a path within a session directory that is currently being staged
+        to the equivalent path within the stage
+        """
+        sess_dir = op.dirname(path)
+        if op.basename(sess_dir) == self.PROV_DIR:
+            sess_dir = op.dirname(sess_dir)
+        try:
+            stage_dir, moved = self._stages[sess_dir]
+        except KeyError:
+            return path
+        staged_path = op.join(stage_dir, op.relpath(path, sess_dir))
+        if fileset is not None and self._put_strategy == 'move':
+            moved.append(fileset)
+        return staged_path
+
+    def _apply_stage(self, committed_dir, sess_dir):
+        """
+        Moves the contents of a committed stage into the session directory,
+        moving the provenance records last so they are only visible once the
+        data they describe are in place. Safe to rerun if interrupted.
+        """
+        with InterProcessLock(committed_dir + self.LOCK_SUFFIX, logger=logger):
+            if not op.exists(committed_dir):
+                return  # Already applied by another process
+            for fname in os.listdir(committed_dir):
+                if (fname in (self.PROV_DIR, self.FIELDS_FNAME,
+                              self.HEARTBEAT_FNAME)
+                        or fname.endswith(self.LOCK_SUFFIX)):
+                    continue
+                src = op.join(committed_dir, fname)
+                dst = op.join(sess_dir, fname)
+                if op.isdir(dst) and not op.islink(dst):
+                    shutil.rmtree(dst)
+                os.replace(src, dst)
+            staged_fields = op.join(committed_dir, self.FIELDS_FNAME)
+            if op.exists(staged_fields):
+                with open(staged_fields, 'r') as f:
+                    values = json.load(f)
+                self._update_fields_json(op.join(sess_dir, self.FIELDS_FNAME),
+                                         values)
+            staged_prov_dir = op.join(committed_dir, self.PROV_DIR)
+            if op.exists(staged_prov_dir):
+                prov_dir = op.join(sess_dir, self.PROV_DIR)
+                if not op.exists(prov_dir):
+                    os.mkdir(prov_dir)
+                for fname in os.listdir(staged_prov_dir):
+                    os.replace(op.join(staged_prov_dir, fname),
+                               op.join(prov_dir, fname))
+            shutil.rmtree(committed_dir)
+        try:
+            os.remove(committed_dir + self.LOCK_SUFFIX)
+        except OSError:
+            pass
+
+    def _recover_stages(self, sess_dir):
+        """
+        Rolls forward stages in the session directory that were committed but
+        not applied, and removes uncommitted stages that have been abandoned
+
+        Returns
+        -------
+        recovered : bool
+            Whether any committed stages were applied
+        """
+        staging_dir = op.join(sess_dir, self.STAGING_DIR)
+        recovered = False
+        for name in os.listdir(staging_dir):
+            stage_dir = op.join(staging_dir, name)
+            if name.startswith('.') or name.endswith(self.LOCK_SUFFIX):
+                continue  # Lock or clock probe files
+            elif name.endswith(self.COMMITTED_SUFFIX):
+                logger.info("Applying outputs committed to '{}' that were not "
+                            "moved into place".format(stage_dir))
+                self._apply_stage(stage_dir, sess_dir)
+                recovered = True
+            elif self._stage_abandoned(name, stage_dir):
+                logger.warning("Removing incomplete outputs staged in '{}'"
+                               .format(stage_dir))
+                shutil.rmtree(stage_dir, ignore_errors=True)
+        try:
+            os.rmdir(staging_dir)
+        except OSError:
+            pass  # Stages that are still in progress are present
+        return recovered
+
+    def _stage_abandoned(self, name, stage_dir):
+        """
+        Checks whether an uncommitted stage belongs to a process that is no
+        longer running
+        """
+        try:
+            host, pid, _ = name.rsplit('_', 2)
+            pid = int(pid)
+        except ValueError:
+            return True
+        if host != HOSTNAME:
+            # Can't check whether processes on other hosts are still running,
+            # so check when the owner last touched the heartbeat file instead
+            try:
+                last_beat = op.getmtime(op.join(stage_dir,
+                                                self.HEARTBEAT_FNAME))
+            except OSError:
+                try:
+                    last_beat = op.getmtime(stage_dir)
+                except OSError:
+                    return False  # Stage has just been committed
+            now = self._file_system_time(op.dirname(stage_dir))
+            return now - last_beat > self.STALE_STAGE_TIMEOUT
+        if pid == os.getpid():
+            with self._live_stages_lock:
+                return stage_dir not in self._live_stages
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass  # Process exists but belongs to another user
+        return False
+
+    @classmethod
+    def _file_system_time(cls, dpath):
+        """
+        Returns the current time according to the file system the directory
+        is on (by touching a probe file), so that modification times written
+        by other hosts can be compared regardless of any clock skew
+        """
+        try:
+            with tempfile.NamedTemporaryFile(dir=dpath, prefix='.probe') as f:
+                return os.fstat(f.fileno()).st_mtime
+        except OSError:
+            return time.time()
+
     # root_dir=None, all_from_analysis=None,
     def find_data(self, dataset, subject_ids=None, visit_ids=None, **kwargs):
         """
@@ -212,6 +606,16 @@ class LocalFileSystemRepo(Repository):
         # if root_dir is None:
         root_dir = dataset.name
         for session_path, dirs, files in os.walk(root_dir):
+            if self.STAGING_DIR in dirs:
+                # Clean up after sinks that were interrupted, relisting the
+                # directory if committed outputs were moved into it
+                if self._recover_stages(session_path):
+                    entries = os.listdir(session_path)
+                    dirs[:] = [e for e in entries
+                               if op.isdir(op.join(session_path, e))]
+                    files[:] = [e for e in entries if e not in dirs]
+                if self.STAGING_DIR in dirs:
+                    dirs.remove(self.STAGING_DIR)  # Don't descend into stages
             relpath = op.relpath(session_path, root_dir)
             path_parts = relpath.split(op.sep) if relpath != '.' else []
             ids = self._extract_ids_from_path(dataset.depth, path_parts, dirs,
@@ -332,33 +736,41 @@ class LocalFileSystemRepo(Repository):
             fname = item.fname
         if dataset is None:
             dataset = item.dataset
+        sess_dir = self._session_dir(dataset, item.frequency, item.subject_id,
+                                     item.visit_id, item.from_analysis)
+        # Make session dir if required
+        if item.derived and not op.exists(sess_dir):
+            os.makedirs(sess_dir, stat.S_IRWXU | stat.S_IRWXG)
+        return op.join(sess_dir, fname)
+
+    def _session_dir(self, dataset, frequency, subject_id, visit_id,
+                     from_analysis):
         root_dir = dataset.name
         depth = dataset.depth
-        subject_id = dataset.inv_map_subject_id(item.subject_id)
-        visit_id = dataset.inv_map_visit_id(item.visit_id)
-        if item.frequency == 'per_dataset':
+        subject_id = dataset.inv_map_subject_id(subject_id)
+        visit_id = dataset.inv_map_visit_id(visit_id)
+        if frequency == 'per_dataset':
             subj_dir = self.SUMMARY_NAME
             visit_dir = self.SUMMARY_NAME
-        elif item.frequency.startswith('per_subject'):
+        elif frequency.startswith('per_subject'):
             if depth < 2:
                 raise ArcanaInsufficientRepoDepthError(
                     "Basic repo needs to have depth of 2 (i.e. sub-directories"
                     " for subjects and visits) to hold 'per_subject' data")
             subj_dir = str(subject_id)
             visit_dir = self.SUMMARY_NAME
-        elif item.frequency.startswith('per_visit'):
+        elif frequency.startswith('per_visit'):
             if depth < 1:
                 raise ArcanaInsufficientRepoDepthError(
                     "Basic repo needs to have depth of at least 1 (i.e. "
                     "sub-directories for subjects) to hold 'per_visit' data")
             subj_dir = self.SUMMARY_NAME
             visit_dir = str(visit_id)
-        elif item.frequency.startswith('per_session'):
+        elif frequency.startswith('per_session'):
             subj_dir = str(subject_id)
             visit_dir = str(visit_id)
         else:
-            assert False, "Unrecognised frequency '{}'".format(
-                item.frequency)
+            assert False, "Unrecognised frequency '{}'".format(frequency)
         if depth == 2:
             acq_dir = op.join(root_dir, subj_dir, visit_dir)
         elif depth == 1:
@@ -367,16 +779,13 @@ class LocalFileSystemRepo(Repository):
             acq_dir = root_dir
         else:
             assert False
-        if item.from_analysis is None:
+        if from_analysis is None:
             sess_dir = acq_dir
         else:
             # Append analysis-name to path (i.e. make a sub-directory to
             # hold derived products)
-            sess_dir = op.join(acq_dir, item.from_analysis)
-        # Make session dir if required
-        if item.derived and not op.exists(sess_dir):
-            os.makedirs(sess_dir, stat.S_IRWXU | stat.S_IRWXG)
-        return op.join(sess_dir, fname)
+            sess_dir = op.join(acq_dir, from_analysis)
+        return sess_dir
 
     def fields_json_path(self, field, dataset=None):
         return self.fileset_path(field, fname=self.FIELDS_FNAME,
@@ -451,8 +860,9 @@ class LocalFileSystemRepo(Repository):
         # and derived analysis directories from fileset names
         filtered = [
             op.join(base_dir, d) for d in dirs
-            if not (d.startswith('.') or d == cls.PROV_DIR or (
-                cls.PROV_DIR in os.listdir(op.join(base_dir, d))))]
+            if not (d.startswith('.') or d == cls.PROV_DIR or any(
+                n in (cls.PROV_DIR, cls.STAGING_DIR)
+                for n in os.listdir(op.join(base_dir, d))))]
         return filtered
 
     @classmethod
@@ -1,11 +1,13 @@
 from builtins import zip
 from builtins import object
 import weakref
+from bisect import bisect_left
 from itertools import chain, groupby
 from collections import defaultdict
 from operator import attrgetter, itemgetter
 from collections import OrderedDict
 import logging
+import numpy as np
 from arcana.data import BaseFileset, BaseField
 from arcana.utils import split_extension
 from arcana.exceptions import (
@@ -49,6 +51,15 @@ class TreeNode(object):
             ((r.pipeline_name, r.from_analysis), r)
             for r in sorted(records, key=lambda r: (r.subject_id, r.visit_id,
                                                     r.from_analysis)))
+        # Index the positions of the filesets and fields by name so that
+        # inputs can select candidates without scanning every item, and keep
+        # a sorted list of the names to select names by prefix
+        self._fileset_list = list(self.filesets)
+        self._fileset_name_index = self._name_index(self._fileset_list)
+        self._sorted_fileset_names = sorted(self._fileset_name_index)
+        self._field_list = list(self._fields.values())
+        self._field_name_index = self._name_index(self._field_list)
+        self._sorted_field_names = sorted(self._field_name_index)
         self._missing_records = []
         self._duplicate_records = []
         self._tree = None
@@ -91,6 +102,87 @@ class TreeNode(object):
     def records(self):
         return self._records.values()
 
+    @property
+    def fileset_names(self):
+        "The distinct names of the filesets in the node"
+        return self._fileset_name_index.keys()
+
+    @property
+    def field_names(self):
+        "The distinct names of the fields in the node"
+        return self._field_name_index.keys()
+
+    def fileset_names_with_prefix(self, prefix):
+        """
+        The distinct names of the filesets in the node that start with the
+        given prefix, in sorted order
+
+        Parameters
+        ----------
+        prefix : str
+            The prefix of the names to return
+        """
+        return self._with_prefix(self._sorted_fileset_names, prefix)
+
+    def field_names_with_prefix(self, prefix):
+        """
+        The distinct names of the fields in the node that start with the
+        given prefix, in sorted order
+
+        Parameters
+        ----------
+        prefix : str
+            The prefix of the names to return
+        """
+        return self._with_prefix(self._sorted_field_names, prefix)
+
+    def filesets_named(self, names):
+        """
+        Returns the filesets in the node with the given names, in the same
+        order as they are iterated in 'filesets'
+
+        Parameters
+        ----------
+        names : iterable[str]
+            The (base) names of the filesets to return
+        """
+        return self._named(self._fileset_list, self._fileset_name_index, names)
+
+    def fields_named(self, names):
+        """
+        Returns the fields in the node with the given names, in the same
+        order as they are iterated in 'fields'
+
+        Parameters
+        ----------
+        names : iterable[str]
+            The names of the fields to return
+        """
+        return self._named(self._field_list, self._field_name_index, names)
+
+    @classmethod
+    def _name_index(cls, items):
+        index = OrderedDict()
+        for i, item in enumerate(items):
+            index.setdefault(item.basename, []).append(i)
+        return index
+
+    @classmethod
+    def _with_prefix(cls, sorted_names, prefix):
+        if not prefix:
+            return sorted_names
+        names = []
+        for name in sorted_names[bisect_left(sorted_names, prefix):]:
+            if not name.startswith(prefix):
+                break
+            names.append(name)
+        return names
+
+    @classmethod
+    def _named(cls, items, index, names):
+        positions = sorted(chain(*(index.get(n, ()) for n in names)))
+        return [items[i] for i in positions]
+
     @property
     def subject_id(self):
         "To be overridden by subclasses where appropriate"
@@ -394,6 +486,10 @@ class Tree(TreeNode):
         for session in self.sessions:
             session.tree = self
         self._dataset = dataset
+        # Boolean arrays marking the nodes in which each item exists, which
+        # are generated together the first time one is requested
+        self._exists_arrays = None
+        self._nodes_arrays = None
         # Collate missing and duplicates provenance records for single warnings
         missing_records = defaultdict(lambda: defaultdict(list))
         duplicate_records = defaultdict(lambda: defaultdict(list))
@@ -459,6 +555,91 @@ class Tree(TreeNode):
     def session_ids(self):
         return ((s.subject_id, s.visit_id) for s in self.sessions)
 
+    def exists_array(self, name, from_analysis=None,
+                     frequency='per_session'):
+        """
+        Returns a boolean array marking the nodes of the given frequency that
+        contain a fileset (with the given ID) or field (with the given name)
+        generated by the given analysis. Rows and columns correspond to the
+        subjects and visits in the order they are iterated in 'subjects' and
+        'visits', and items of 'per_subject', 'per_visit' and 'per_dataset'
+        frequency are broadcast across the row, column or whole array of the
+        node they belong to. The arrays are read-only.
+
+        Parameters
+        ----------
+        name : str
+            The ID of the fileset or name of the field
+        from_analysis : str | None
+            The name of the analysis that generated the item, None for
+            acquired items
+        frequency : str
+            The frequency of the item
+
+        Returns
+        -------
+        exists : 2-D numpy.array[bool]
+            The nodes in which the item exists
+        """
+        if self._exists_arrays is None:
+            self._generate_arrays()
+        try:
+            return self._exists_arrays[(name, from_analysis, frequency)]
+        except KeyError:
+            return self._empty_array
+
+    def nodes_array(self, frequency='per_session'):
+        """
+        Returns a read-only boolean array marking the nodes of the given
+        frequency that are present in the tree, with the same layout as
+        'exists_array' (i.e. only sessions can be missing)
+
+        Parameters
+        ----------
+        frequency : str
+            The frequency of the nodes
+        """
+        if self._nodes_arrays is None:
+            self._generate_arrays()
+        return self._nodes_arrays[frequency]
+
+    def _generate_arrays(self):
+        "Generates the existence arrays of all items in a single pass"
+        subject_inds = {s.id: i for i, s in enumerate(self.subjects)}
+        visit_inds = {v.id: i for i, v in enumerate(self.visits)}
+        shape = (len(subject_inds), len(visit_inds))
+        arrays = defaultdict(lambda: np.zeros(shape, dtype=bool))
+
+        def keys(node):
+            return chain(node._filesets, node._fields)
+
+        sessions = np.zeros(shape, dtype=bool)
+        for session in self.sessions:
+            inds = (subject_inds[session.subject_id],
+                    visit_inds[session.visit_id])
+            sessions[inds] = True
+            for name, from_analysis in keys(session):
+                arrays[(name, from_analysis, 'per_session')][inds] = True
+        for subject in self.subjects:
+            for name, from_analysis in keys(subject):
+                arrays[(name, from_analysis, 'per_subject')][
+                    subject_inds[subject.id], :] = True
+        for visit in self.visits:
+            for name, from_analysis in keys(visit):
+                arrays[(name, from_analysis, 'per_visit')][
+                    :, visit_inds[visit.id]] = True
+        for name, from_analysis in keys(self):
+            arrays[(name, from_analysis, 'per_dataset')][:, :] = True
+        self._exists_arrays = dict(arrays)
+        self._empty_array = np.zeros(shape, dtype=bool)
+        everywhere = np.ones(shape, dtype=bool)
+        self._nodes_arrays = {
+            'per_session': sessions, 'per_subject': everywhere,
+            'per_visit': everywhere, 'per_dataset': everywhere}
+        for array in chain(self._exists_arrays.values(),
+                           self._nodes_arrays.values(), [self._empty_array]):
+            array.setflags(write=False)
+
     @property
     def complete_subjects(self):
         max_num_sessions = max(len(s) for s in self.subjects)
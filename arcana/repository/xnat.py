@@ -13,7 +13,7 @@ from zipfile import ZipFile, BadZipfile
 import os.path as op
 import shutil
 from arcana.utils import JSON_ENCODING
-from arcana.utils import makedirs
+from arcana.utils import makedirs, file_md5
 from arcana.data import Fileset, Field
 from arcana.repository.base import Repository
 from arcana.exceptions import (
@@ -114,15 +114,13 @@ class XnatRepo(Repository):
             return False  # For comparison with other types
         
     def __getstate__(self):
-        dct = self.__dict__.copy()
+        dct = super().__getstate__()
         del dct['_login']
-        del dct['_connection_depth']
         return dct
-    
+
     def __setstate__(self, state):
-        self.__dict__.update(state)
+        super().__setstate__(state)
         self._login = None
-        self._connection_depth = 0
 
     @property
     def prov(self):
@@ -303,18 +301,29 @@ class XnatRepo(Repository):
             if os.path.exists(cache_path_dir):
                 shutil.rmtree(cache_path_dir)
             os.makedirs(cache_path_dir, stat.S_IRWXU | stat.S_IRWXG)
+            # Copy the files into the cache, calculating their checksums in
+            # the same pass
+            digests = {}
+
+            def copy_to_cache(src_path, dst_path):
+                digests[dst_path] = file_md5(src_path, copy_to=dst_path)
+
             if fileset.format.directory:
-                shutil.copytree(fileset.path, cache_path)
+                shutil.copytree(fileset.path, cache_path,
+                                copy_function=copy_to_cache)
+                primary_cache_path = cache_path
             else:
                 # Copy primary file
-                shutil.copyfile(fileset.path,
-                                op.join(cache_path, fileset.fname))
+                primary_cache_path = op.join(cache_path, fileset.fname)
+                copy_to_cache(fileset.path, primary_cache_path)
                 # Copy auxiliaries
                 for sc_fname, sc_path in fileset.aux_file_fnames_and_paths:
-                    shutil.copyfile(sc_path, op.join(cache_path, sc_fname))
+                    copy_to_cache(sc_path, op.join(cache_path, sc_fname))
+            checksums = {op.relpath(p, primary_cache_path): d
+                         for p, d in digests.items()}
             with open(cache_path + XnatRepo.MD5_SUFFIX, 'w',
                       **JSON_ENCODING) as f:
-                json.dump(fileset.calculate_checksums(), f, indent=2)
+                json.dump(checksums, f, indent=2)
             # Upload to XNAT
             xscan = self._login.classes.MrScanData(
                 id=fileset.id, type=fileset.basename, parent=xsession)
@@ -338,6 +347,7 @@ class XnatRepo(Repository):
                 xresource.upload(fileset.path, fileset.fname)
                 for sc_fname, sc_path in fileset.aux_file_fnames_and_paths:
                     xresource.upload(sc_path, sc_fname)
+        return checksums
 
     def put_field(self, field):
         self._check_repository(field)
@@ -0,0 +1,328 @@
+"""
+In-process implementations of the zip and tar.gz archiving used by the
+format converters, which use parallel threads to read the files to zip ahead
+of the writer, to decompress the members of zip files and to compress the
+blocks of tar.gz streams (zlib releases the GIL while (de)compressing)
+"""
+import os
+import os.path as op
+import sys
+import time
+import gzip
+import tarfile
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from arcana.exceptions import ArcanaUsageError
+
+
+# Extensions of files that are already compressed and are therefore stored
+# without recompressing them when 'store_compressed' is set
+COMPRESSED_EXTS = ('.gz', '.tgz', '.bz2', '.xz', '.zip', '.zst')
+
+# Size of the blocks of the tar stream that are compressed in parallel
+GZIP_BLOCK_SIZE = 2 ** 22  # 4MB
+# Files larger than this are streamed into zip files instead of being read
+# ahead into memory
+MAX_BUFFERED_SIZE = 2 ** 26  # 64MB
+# The compression level of zip members can only be set from Python 3.7
+ZIP_COMPRESSLEVEL = sys.version_info >= (3, 7)
+
+
+def num_threads_or_default(num_threads):
+    """
+    The number of threads to use if 'num_threads' is None or 0, i.e. the
+    number of CPUs the process is allowed to run on (which are restricted to
+    those allocated to the job by schedulers such as SLURM), not the number
+    of CPUs of the host
+    """
+    if num_threads:
+        return num_threads
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on macOS or Windows
+        return os.cpu_count() or 1
+
+
+def zip_dir(dirname, zipped, compress_level=6, store_compressed=True,
+            num_threads=None):
+    """
+    Zips a directory relative to its parent (i.e. the members of the archive
+    are prefixed by the base name of the directory). The files are read
+    ahead of the writer in parallel threads, and compressed by zipfile as
+    they are written
+
+    Parameters
+    ----------
+    dirname : str
+        Path to the directory to zip
+    zipped : str
+        Path to the zip file to create
+    compress_level : int
+        The zlib compression level (0-9), 0 stores all files uncompressed
+    store_compressed : bool
+        Whether to store files that are already compressed (e.g. '.nii.gz')
+        without recompressing them
+    num_threads : int | None
+        The number of threads to read the files with. If None the number of
+        CPUs available to the process is used
+    """
+    num_threads = num_threads_or_default(num_threads)
+    dirname = op.abspath(dirname)
+    parent = op.dirname(dirname)
+    members = []
+    for dpath, dnames, fnames in os.walk(dirname):
+        dnames.sort()
+        members.append(dpath)
+        members.extend(op.join(dpath, f) for f in sorted(fnames))
+
+    def read(path):
+        "Reads small files into memory so they can be written by writestr"
+        if op.isdir(path) or op.getsize(path) > MAX_BUFFERED_SIZE:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def stored(path):
+        return (op.isdir(path) or compress_level == 0
+                or (store_compressed and path.endswith(COMPRESSED_EXTS)))
+
+    level_kwargs = ({'compresslevel': compress_level}
+                    if ZIP_COMPRESSLEVEL else {})
+    to_read = iter(members)
+    with zipfile.ZipFile(zipped, 'w', allowZip64=True) as zf, \
+            ThreadPoolExecutor(num_threads) as executor:
+        # Read a window of files ahead of the one being written so they
+        # don't take up more memory than necessary
+        pending = deque()
+        for path in members:
+            while len(pending) < 2 * num_threads:
+                try:
+                    next_path = next(to_read)
+                except StopIteration:
+                    break
+                pending.append(executor.submit(read, next_path))
+            data = pending.popleft().result()
+            arcname = op.relpath(path, parent)
+            compress_type = (zipfile.ZIP_STORED if stored(path)
+                             else zipfile.ZIP_DEFLATED)
+            if data is None:
+                # Directories and large files are streamed from disk
+                zf.write(path, arcname, compress_type=compress_type,
+                         **level_kwargs)
+            else:
+                zf.writestr(_zip_info(path, arcname), data,
+                            compress_type=compress_type, **level_kwargs)
+
+
+def unzip_dir(zipped, out_dir, num_threads=None):
+    """
+    Extracts a zip file, decompressing its members in parallel threads
+
+    Parameters
+    ----------
+    zipped : str
+        Path to the zip file
+    out_dir : str
+        The directory to extract the members of the zip file into
+    num_threads : int | None
+        The number of threads to decompress the files with. If None the
+        number of CPUs available to the process is used
+
+    Returns
+    -------
+    top_level : set[str]
+        The names of the top-level files and directories extracted
+    """
+    num_threads = num_threads_or_default(num_threads)
+    with zipfile.ZipFile(zipped) as zf:
+        infos = zf.infolist()
+    files = [i for i in infos if not i.filename.endswith('/')]
+    # Create all directories upfront so the threads don't race to create them
+    for dname in set(op.dirname(i.filename) for i in files).union(
+            i.filename for i in infos if i.filename.endswith('/')):
+        os.makedirs(op.join(out_dir, dname), exist_ok=True)
+    # Balance the total size of the files extracted by each thread
+    groups = [[] for _ in range(min(num_threads, len(files)) or 1)]
+    sizes = [0] * len(groups)
+    for info in sorted(files, key=lambda i: i.file_size, reverse=True):
+        i = sizes.index(min(sizes))
+        groups[i].append(info.filename)
+        sizes[i] += info.file_size
+
+    def extract(names):
+        with zipfile.ZipFile(zipped) as zf:
+            for name in names:
+                path = zf.extract(name, out_dir)
+                mode = zf.getinfo(name).external_attr >> 16
+                if mode:
+                    os.chmod(path, mode & 0o7777)
+
+    with ThreadPoolExecutor(len(groups)) as executor:
+        list(executor.map(extract, groups))
+    return _top_level(i.filename for i in infos)
+
+
+def targz_dir(dirname, zipped, compress_level=6, num_threads=None):
+    """
+    Creates a tar.gz archive of a directory relative to its parent,
+    compressing blocks of the tar stream in parallel threads. The blocks are
+    written as consecutive gzip members, which can be read by any gzip
+    implementation
+
+    Parameters
+    ----------
+    dirname : str
+        Path to the directory to archive
+    zipped : str
+        Path to the tar.gz file to create
+    compress_level : int
+        The zlib compression level (0-9), 0 stores the tar stream
+        uncompressed within the gzip members
+    num_threads : int | None
+        The number of threads to compress the blocks with. If None the number
+        of CPUs available to the process is used
+    """
+    dirname = op.abspath(dirname)
+    with open(zipped, 'wb') as f:
+        with ParallelGzipWriter(f, compress_level=compress_level,
+                                num_threads=num_threads) as gz:
+            with tarfile.open(fileobj=gz, mode='w|') as tar:
+                tar.add(dirname, arcname=op.basename(dirname))
+
+
+def untargz_dir(gzipped, out_dir):
+    """
+    Extracts a tar.gz archive. NB: a gzip stream can't be decompressed in
+    parallel so this is single-threaded
+
+    Parameters
+    ----------
+    gzipped : str
+        Path to the tar.gz file
+    out_dir : str
+        The directory to extract the archive into
+
+    Returns
+    -------
+    top_level : set[str]
+        The names of the top-level files and directories extracted
+    """
+    with tarfile.open(gzipped, 'r:gz') as tar:
+        members = tar.getmembers()
+        if hasattr(tarfile, 'data_filter'):
+            tar.extractall(out_dir, members=members, filter='data')
+        else:
+            tar.extractall(out_dir, members=members)
+    return _top_level(m.name for m in members)
+
+
+def single_top_level(top_level, out_dir):
+    """
+    Returns the path to the single directory extracted from an archive,
+    raising an error if the archive contained more than one top-level item
+    """
+    if len(top_level) > 1:
+        raise ArcanaUsageError(
+            "Zip repositorys can only contain a single directory, found "
+            "'{}'".format("', '".join(sorted(top_level))))
+    try:
+        return op.join(out_dir, next(iter(top_level)))
+    except StopIteration:
+        raise ArcanaUsageError(
+            "No files or directories found in unzipped directory")
+
+
+class ParallelGzipWriter(object):
+    """
+    A write-only file-like object that compresses the data written to it in
+    blocks in parallel threads and writes them to the wrapped file as
+    consecutive gzip members (in the same way as pigz)
+
+    Parameters
+    ----------
+    fileobj : file-like
+        The file to write the compressed data to
+    compress_level : int
+        The zlib compression level (0-9)
+    num_threads : int | None
+        The number of threads to compress the blocks with. If None the number
+        of CPUs available to the process is used
+    block_size : int
+        The size of the uncompressed blocks
+    """
+
+    def __init__(self, fileobj, compress_level=6, num_threads=None,
+                 block_size=GZIP_BLOCK_SIZE):
+        self._fileobj = fileobj
+        self._compress_level = compress_level
+        self._num_threads = num_threads_or_default(num_threads)
+        self._block_size = block_size
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(self._num_threads)
+        self._written = False
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def write(self, data):
+        self._buffer.extend(data)
+        while len(self._buffer) >= self._block_size:
+            self._submit(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            # An empty gzip member is written for an empty stream so the
+            # result is still a valid gzip file
+            if self._buffer or not (self._pending or self._written):
+                self._submit(bytes(self._buffer))
+                del self._buffer[:]
+            while self._pending:
+                self._write_next()
+        finally:
+            self._executor.shutdown()
+            self.closed = True
+
+    def _submit(self, block):
+        self._pending.append(self._executor.submit(
+            gzip.compress, block, self._compress_level))
+        # Limit the number of compressed blocks held in memory
+        while len(self._pending) > 2 * self._num_threads:
+            self._write_next()
+
+    def _write_next(self):
+        self._fileobj.write(self._pending.popleft().result())
+        self._written = True
+
+
+def _top_level(names):
+    "The top-level names of the members of an archive"
+    top_level = set(op.normpath(n).split(os.sep)[0] for n in names)
+    top_level.discard('.')
+    return top_level
+
+
+def _zip_info(path, arcname):
+    """
+    Creates the ZipInfo of a file to write with ZipFile.writestr, with the
+    modification time and permissions of the file (like ZipInfo.from_file,
+    which isn't available in Python 3.5)
+    """
+    st = os.stat(path)
+    # Zip files can't store dates before 1980
+    date_time = max(time.localtime(st.st_mtime)[:6], (1980, 1, 1, 0, 0, 0))
+    zinfo = zipfile.ZipInfo(arcname, date_time)
+    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+    return zinfo
@@ -5,9 +5,14 @@ import importlib
 from itertools import zip_longest
 import os.path
 import errno
+import hashlib
 from nipype.interfaces.matlab import MatlabCommand
 import shutil
 import tempfile
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Not available on Windows
 from arcana.exceptions import ArcanaUsageError
 from contextlib import ExitStack
 from collections.abc import Iterable
@@ -16,6 +21,8 @@ from collections.abc import Iterable
 PATH_SUFFIX = '_path'
 FIELD_SUFFIX = '_field'
 CHECKSUM_SUFFIX = '_checksum'
+# From linux/fs.h, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
 
 package_dir = os.path.join(os.path.dirname(__file__), '..')
 
@@ -35,6 +42,57 @@ def dir_modtime(dpath):
     return max(os.path.getmtime(d) for d, _, _ in os.walk(dpath))
 
 
+def file_md5(path, copy_to=None, chunk_size=2 ** 20):
+    """
+    Calculates the MD5 digest of a file, optionally copying it to a new
+    location in the same pass so that the file is only read once
+
+    Parameters
+    ----------
+    path : str
+        Path to the file to calculate the digest of
+    copy_to : str | None
+        Path to copy the file to while it is being read. If None the file
+        isn't copied
+    chunk_size : int
+        The size of the chunks the file is read in so large files don't need
+        to be loaded into memory
+
+    Returns
+    -------
+    digest : str
+        The hex digest of the file
+    """
+    fhash = hashlib.md5()
+    with open(path, 'rb') as f:
+        if copy_to is None:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                fhash.update(chunk)
+        else:
+            with open(copy_to, 'wb') as f_out:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    fhash.update(chunk)
+                    f_out.write(chunk)
+            shutil.copymode(path, copy_to)
+    return fhash.hexdigest()
+
+
+def reflink(src_path, dst_path):
+    """
+    Attempts to create a copy-on-write clone of a file (only supported on
+    Linux file-systems such as Btrfs and XFS), returning whether it was
+    successful or not
+    """
+    if fcntl is None:
+        return False
+    try:
+        with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except (OSError, IOError):
+        return False
+    return True
+
+
 double_exts = ('.tar.gz', '.nii.gz')
 
 
@@ -223,7 +281,16 @@ def find_mismatch(first, second, indent=''):
     return mismatch
 
 
+# Versions of the packages installed in the current process, which don't
+# change once they have been imported
+_package_versions = {}
+
+
 def extract_package_version(package_name):
+    try:
+        return _package_versions[package_name]
+    except KeyError:
+        pass
     version = None
     try:
         module = importlib.import_module(package_name)
@@ -238,6 +305,7 @@ def extract_package_version(package_name):
             version = module.__version__
         except AttributeError:
             pass
+    _package_versions[package_name] = version
     return version
 
 
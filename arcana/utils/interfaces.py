@@ -20,6 +20,8 @@ from nipype.interfaces.base import OutputMultiPath, InputMultiPath
 import numpy as np
 from arcana.exceptions import ArcanaError, ArcanaDesignError
 from .base import split_extension
+from .archive import (
+    zip_dir, unzip_dir, targz_dir, untargz_dir, single_top_level)
 
 
 bash_resources = op.abspath(op.join(op.dirname(__file__), 'resources', 'bash'))
@@ -568,6 +570,153 @@ class UnTarGzDir(CommandLine):
         return outputs
 
 
+class ArchiveInputSpec(BaseInterfaceInputSpec):
+    num_threads = traits.Int(
+        0, usedefault=True,
+        desc=("The number of threads to (de)compress the archive with, 0 "
+              "uses the number of CPUs available to the process (i.e. those "
+              "allocated to the job by the scheduler)"))
+
+
+class CompressInputSpec(ArchiveInputSpec):
+    compress_level = traits.Range(
+        low=0, high=9, value=6, usedefault=True,
+        desc=("The zlib compression level, 0 stores the contents "
+              "uncompressed"))
+
+
+class InProcessZipDirInputSpec(CompressInputSpec):
+    dirname = Directory(exists=True, mandatory=True, desc='directory name')
+    zipped = File(desc=("The zipped zip file"))
+    ext_prefix = traits.Str(
+        mandatory=False, default='', usedefault=True,
+        desc=("Extra extension to prepend before .zip is appended to "
+              "file name"))
+    store_compressed = traits.Bool(
+        True, usedefault=True,
+        desc=("Store files that are already compressed (e.g. '.nii.gz') "
+              "without recompressing them"))
+
+
+class InProcessZipDir(BaseInterface):
+    """
+    Creates a zip repository from a given folder within the Python process,
+    reading its files ahead of the writer in parallel threads (see ZipDir
+    for the command-line version)
+    """
+
+    input_spec = InProcessZipDirInputSpec
+    output_spec = ZipDirOutputSpec
+    zip_ext = '.zip'
+
+    def _run_interface(self, runtime):
+        zip_dir(self.inputs.dirname, self._zipped_path,
+                compress_level=self.inputs.compress_level,
+                store_compressed=self.inputs.store_compressed,
+                num_threads=self.inputs.num_threads)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['zipped'] = self._zipped_path
+        return outputs
+
+    @property
+    def _zipped_path(self):
+        if isdefined(self.inputs.zipped):
+            fname = self.inputs.zipped
+        else:
+            fname = (op.basename(self.inputs.dirname) +
+                     self.inputs.ext_prefix + self.zip_ext)
+        return op.abspath(fname)
+
+
+class InProcessUnzipDirInputSpec(ArchiveInputSpec):
+    zipped = File(exists=True, mandatory=True, desc='zipped file name')
+
+
+class InProcessUnzipDir(BaseInterface):
+    """
+    Unzips a folder that was zipped by ZipDir, decompressing its files in
+    parallel within the Python process (see UnzipDir for the command-line
+    version)
+    """
+
+    input_spec = InProcessUnzipDirInputSpec
+    output_spec = UnzipDirOutputSpec
+
+    def _run_interface(self, runtime):
+        self._unzipped = single_top_level(
+            unzip_dir(self.inputs.zipped, os.getcwd(),
+                      num_threads=self.inputs.num_threads), os.getcwd())
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['unzipped'] = self._unzipped
+        return outputs
+
+
+class InProcessTarGzDirInputSpec(CompressInputSpec):
+    dirname = Directory(exists=True, mandatory=True, desc='directory name')
+    zipped = File(desc=("The tar_gz file"))
+
+
+class InProcessTarGzDir(BaseInterface):
+    """
+    Creates a tar_gzip repository from a given folder, compressing blocks of
+    it in parallel within the Python process (see TarGzDir for the
+    command-line version)
+    """
+
+    input_spec = InProcessTarGzDirInputSpec
+    output_spec = TarGzDirOutputSpec
+    targz_ext = '.tar.gz'
+
+    def _run_interface(self, runtime):
+        targz_dir(self.inputs.dirname, self._zipped_path,
+                  compress_level=self.inputs.compress_level,
+                  num_threads=self.inputs.num_threads)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['zipped'] = self._zipped_path
+        return outputs
+
+    @property
+    def _zipped_path(self):
+        if isdefined(self.inputs.zipped):
+            fname = self.inputs.zipped
+        else:
+            fname = op.basename(self.inputs.dirname) + self.targz_ext
+        return op.abspath(fname)
+
+
+class InProcessUnTarGzDirInputSpec(BaseInterfaceInputSpec):
+    gzipped = File(exists=True, mandatory=True, desc=("The tar_gz file"))
+
+
+class InProcessUnTarGzDir(BaseInterface):
+    """
+    Unzip a folder created using TarGz within the Python process (see
+    UnTarGzDir for the command-line version)
+    """
+
+    input_spec = InProcessUnTarGzDirInputSpec
+    output_spec = UnTarGzDirOutputSpec
+
+    def _run_interface(self, runtime):
+        self._gunzipped = single_top_level(
+            untargz_dir(self.inputs.gzipped, os.getcwd()), os.getcwd())
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['gunzipped'] = self._gunzipped
+        return outputs
+
+
 class SelectOneInputSpec(BaseInterfaceInputSpec):
     inlist = InputMultiPath(
         traits.Any, mandatory=True, desc='list of values to choose from')
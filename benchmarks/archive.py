@@ -0,0 +1,108 @@
+"""
+Benchmarks the in-process (multi-threaded) archive interfaces used by the
+zip and tar.gz format converters against the command-line interfaces that
+shell out to 'zip', 'unzip' and 'tar'. A directory of files that mimics a
+neuroimaging session (some already gzipped NIfTI images and some
+uncompressed files) is archived and extracted by each interface, and the
+time taken and size of the archive are reported.
+
+    $ python benchmarks/archive.py --num_files 20 --file_size 50
+"""
+import os
+import os.path as op
+import time
+import gzip
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from arcana.utils.interfaces import (
+    ZipDir, UnzipDir, TarGzDir, UnTarGzDir, InProcessZipDir,
+    InProcessUnzipDir, InProcessTarGzDir, InProcessUnTarGzDir)
+
+
+def create_dir(dirname, num_files, file_size, compressed_fraction):
+    """
+    Creates files of partially random data (so they are compressible), of
+    which the given fraction are gzipped (like NIfTI images saved as .nii.gz)
+    """
+    os.makedirs(dirname)
+    size = int(file_size * 1024 ** 2)
+    num_compressed = int(round(num_files * compressed_fraction))
+    for i in range(num_files):
+        data = os.urandom(size // 4) + bytes(size - size // 4)
+        if i < num_compressed:
+            fname = 'image{}.nii.gz'.format(i)
+            data = gzip.compress(data, 1)
+        else:
+            fname = 'image{}.nii'.format(i)
+        with open(op.join(dirname, fname), 'wb') as f:
+            f.write(data)
+
+
+def run_interface(interface, work_dir, **inputs):
+    "Runs the interface in a fresh directory and returns the time taken"
+    os.makedirs(work_dir)
+    for name, value in inputs.items():
+        setattr(interface.inputs, name, value)
+    start = time.time()
+    result = interface.run(cwd=work_dir)
+    return time.time() - start, result.outputs
+
+
+def benchmark(dirname, tmp_dir, compress_level, num_threads):
+    timings = []
+    interfaces = [
+        ('zip (cli)', ZipDir(), UnzipDir(), 'unzipped'),
+        ('zip (in-process)',
+         InProcessZipDir(compress_level=compress_level,
+                         num_threads=num_threads),
+         InProcessUnzipDir(num_threads=num_threads), 'unzipped'),
+        ('zip (in-process, no store)',
+         InProcessZipDir(compress_level=compress_level,
+                         num_threads=num_threads, store_compressed=False),
+         InProcessUnzipDir(num_threads=num_threads), 'unzipped'),
+        ('tar.gz (cli)', TarGzDir(), UnTarGzDir(), 'gunzipped'),
+        ('tar.gz (in-process)',
+         InProcessTarGzDir(compress_level=compress_level,
+                           num_threads=num_threads),
+         InProcessUnTarGzDir(), 'gunzipped')]
+    for i, (name, archiver, extractor, out_name) in enumerate(interfaces):
+        archive_time, outputs = run_interface(
+            archiver, op.join(tmp_dir, 'archive{}'.format(i)),
+            dirname=dirname)
+        archive_size = op.getsize(outputs.zipped)
+        in_name = 'gzipped' if out_name == 'gunzipped' else 'zipped'
+        extract_time, outputs = run_interface(
+            extractor, op.join(tmp_dir, 'extract{}'.format(i)),
+            **{in_name: outputs.zipped})
+        assert sorted(os.listdir(getattr(outputs, out_name))) == sorted(
+            os.listdir(dirname))
+        timings.append((name, archive_time, extract_time, archive_size))
+    return timings
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--num_files', type=int, default=20,
+                        help="Number of files in the directory")
+    parser.add_argument('--file_size', type=float, default=50,
+                        help="Size of each file in MB")
+    parser.add_argument('--compressed_fraction', type=float, default=0.5,
+                        help="Fraction of files that are gzipped images")
+    parser.add_argument('--compress_level', type=int, default=6,
+                        help="Compression level of the in-process interfaces")
+    parser.add_argument('--num_threads', type=int, default=0,
+                        help=("Number of threads used by the in-process "
+                              "interfaces (0 = number of CPUs)"))
+    args = parser.parse_args()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        dirname = op.join(tmp_dir, 'session')
+        create_dir(dirname, args.num_files, args.file_size,
+                   args.compressed_fraction)
+        for name, archive_time, extract_time, size in benchmark(
+                dirname, tmp_dir, args.compress_level, args.num_threads):
+            print("{}: archive {:.2f}s, extract {:.2f}s, {:.1f} MB".format(
+                name, archive_time, extract_time, size / 1024 ** 2))
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,111 @@
+"""
+Benchmarks the construction of workflows for sparse longitudinal datasets
+(where each subject only has a few of the possible visits), comparing
+separate (dependent) subject and visit iterators ('product' iteration) with
+a single iterator over the explicit list of sessions to process ('sessions'
+iteration). Reports the time taken to connect the pipeline to the workflow,
+the time taken by NiPype to expand the iterables of the workflow graph and
+the number of nodes in the expanded graph.
+
+    $ python benchmarks/iteration.py --num_subjects 500 --num_visits 8
+"""
+import os
+import os.path as op
+import json
+import time
+import random
+import shutil
+import tempfile
+from copy import deepcopy
+from argparse import ArgumentParser
+from nipype.pipeline import engine as pe
+from nipype.pipeline.engine.utils import generate_expanded_graph
+from arcana.analysis import Analysis, AnalysisMetaClass
+from arcana.data import InputFieldSpec, FieldSpec, FieldFilter
+from arcana.processor import SingleProc
+from arcana.repository import Dataset
+from arcana.utils.testing import TestMath
+
+
+class SparseAnalysis(Analysis, metaclass=AnalysisMetaClass):
+
+    add_data_specs = [
+        InputFieldSpec('acquired', int),
+        FieldSpec('derived', int, 'derive_pipeline')]
+
+    def derive_pipeline(self, **name_maps):
+        pipeline = self.new_pipeline('derive', desc="", citations=[],
+                                     name_maps=name_maps)
+        pipeline.add(
+            'math',
+            TestMath(op='add', as_file=False, y=1),
+            inputs={'x': ('acquired', int)},
+            outputs={'derived': ('z', int)})
+        return pipeline
+
+
+def create_dataset(dataset_dir, num_subjects, num_visits, max_visits, seed):
+    random.seed(seed)
+    for subj_i in range(num_subjects):
+        visits = random.sample(range(num_visits),
+                               random.randint(1, max_visits))
+        for visit_i in visits:
+            sess_dir = op.join(dataset_dir, 'subject{}'.format(subj_i),
+                               'visit{}'.format(visit_i))
+            os.makedirs(sess_dir)
+            with open(op.join(sess_dir, 'fields.json'), 'w') as f:
+                json.dump({'acquired': subj_i + visit_i}, f)
+
+
+def benchmark(dataset_dir, work_dir, iteration):
+    analysis = SparseAnalysis(
+        'sparse', Dataset(dataset_dir, depth=2),
+        processor=SingleProc(work_dir, iteration=iteration),
+        inputs=[FieldFilter('acquired', 'acquired', int)])
+    processor = analysis.processor
+    start = time.time()
+    subject_inds, visit_inds, filter_array = processor._filter_array(
+        None, None, None)
+    workflow = pe.Workflow(name='benchmark', base_dir=work_dir)
+    pipeline = analysis.pipeline('derive_pipeline')
+    for pipeline, req_outputs, flt_array in processor._pipeline_stack(
+            [pipeline], [{'derived'}], filter_array, subject_inds,
+            visit_inds):
+        processor._connect_pipeline(pipeline, req_outputs, workflow,
+                                    subject_inds, visit_inds, flt_array)
+    connect_time = time.time() - start
+    start = time.time()
+    expanded = generate_expanded_graph(deepcopy(workflow._create_flat_graph()))
+    expand_time = time.time() - start
+    return (int(pipeline.to_process_array.sum()), connect_time, expand_time,
+            expanded.number_of_nodes())
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--num_subjects', type=int, default=500,
+                        help="Number of subjects in the dataset")
+    parser.add_argument('--num_visits', type=int, default=8,
+                        help="Number of possible visits")
+    parser.add_argument('--max_visits', type=int, default=2,
+                        help="Maximum number of visits per subject")
+    parser.add_argument('--seed', type=int, default=1,
+                        help="Seed used to select the visits of each subject")
+    args = parser.parse_args()
+    dataset_dir = tempfile.mkdtemp()
+    try:
+        create_dataset(dataset_dir, args.num_subjects, args.num_visits,
+                       args.max_visits, args.seed)
+        for iteration in ('product', 'sessions'):
+            work_dir = tempfile.mkdtemp()
+            try:
+                (num_sessions, connect_time, expand_time,
+                 num_nodes) = benchmark(dataset_dir, work_dir, iteration)
+            finally:
+                shutil.rmtree(work_dir)
+            print("{}: connect {:.2f}s, expand {:.2f}s, {} expanded nodes "
+                  "({} sessions of {} subjects x {} visits)".format(
+                      iteration, connect_time, expand_time, num_nodes,
+                      num_sessions, args.num_subjects, args.num_visits))
+    finally:
+        shutil.rmtree(dataset_dir)
@@ -0,0 +1,97 @@
+"""
+Benchmarks matching inputs against the sessions of a synthetic dataset, in
+which each session contains a number of text files and DICOM-like series
+directories (whose format can only be matched by listing their contents).
+Reports the time taken to match all the inputs serially and in a pool of
+threads.
+
+    $ python benchmarks/matching.py --num_subjects 500 --num_visits 4
+"""
+import os
+import os.path as op
+import time
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from arcana.data import FilesetFilter
+from arcana.data.file_format import FileFormat, text_format
+from arcana.repository import Dataset
+
+
+dicom_format = FileFormat(name='dicom', extension=None, directory=True,
+                          within_dir_exts=['.dcm'])
+
+
+def create_dataset(dataset_dir, num_subjects, num_visits, num_scans):
+    for subj_i in range(num_subjects):
+        for visit_i in range(num_visits):
+            sess_dir = op.join(dataset_dir, 'subject{}'.format(subj_i),
+                               'visit{}'.format(visit_i))
+            os.makedirs(sess_dir)
+            for scan_i in range(num_scans):
+                with open(op.join(sess_dir, 'scan_{}.txt'.format(scan_i)),
+                          'w') as f:
+                    f.write(str(scan_i))
+                series_dir = op.join(sess_dir, 'series_{}'.format(scan_i))
+                os.mkdir(series_dir)
+                for i in range(3):
+                    open(op.join(series_dir, '{}.dcm'.format(i)), 'w').close()
+
+
+def inputs(num_scans):
+    "Half the inputs are matched by name and half by regular expression"
+    filters = []
+    for scan_i in range(num_scans):
+        if scan_i % 2:
+            filters.append(FilesetFilter(
+                'series{}'.format(scan_i), 'series_{}'.format(scan_i),
+                dicom_format))
+            filters.append(FilesetFilter(
+                'scan{}'.format(scan_i), 'scan_{}'.format(scan_i),
+                text_format))
+        else:
+            filters.append(FilesetFilter(
+                'series{}'.format(scan_i), r'series_{}$'.format(scan_i),
+                dicom_format, is_regex=True))
+            filters.append(FilesetFilter(
+                'scan{}'.format(scan_i), r'scan_{}$'.format(scan_i),
+                text_format, is_regex=True))
+    return filters
+
+
+def benchmark(tree, filters, num_threads):
+    start = time.time()
+    slices = [f.match(tree, num_threads=num_threads) for f in filters]
+    return time.time() - start, slices
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--num_subjects', type=int, default=500,
+                        help="Number of subjects in the dataset")
+    parser.add_argument('--num_visits', type=int, default=4,
+                        help="Number of visits of each subject")
+    parser.add_argument('--num_scans', type=int, default=15,
+                        help=("Number of text files and series directories in "
+                              "each session (the number of inputs is twice "
+                              "this)"))
+    parser.add_argument('--num_threads', type=int, default=None,
+                        help=("Number of threads to match with (default "
+                              "that of ThreadPoolExecutor)"))
+    args = parser.parse_args()
+    dataset_dir = tempfile.mkdtemp()
+    try:
+        create_dataset(dataset_dir, args.num_subjects, args.num_visits,
+                       args.num_scans)
+        start = time.time()
+        tree = Dataset(dataset_dir, depth=2).tree
+        print("Constructed tree of {} sessions in {:.2f}s".format(
+            args.num_subjects * args.num_visits, time.time() - start))
+        filters = inputs(args.num_scans)
+        serial_time, serial = benchmark(tree, filters, 1)
+        threaded_time, threaded = benchmark(tree, filters, args.num_threads)
+        assert [list(s) for s in serial] == [list(s) for s in threaded]
+        print("Matched {} inputs: serial {:.2f}s, threaded {:.2f}s".format(
+            len(filters), serial_time, threaded_time))
+    finally:
+        shutil.rmtree(dataset_dir)
@@ -0,0 +1,58 @@
+"""
+Benchmarks writing derived fields into a shared 'fields.json' file of a
+LocalFileSystemRepo from many concurrent processes, comparing the writing
+of each field individually (one lock/read/write cycle per field) with
+writing all fields of a process in bulk with 'put_fields'.
+
+    $ python benchmarks/put_fields.py --num_processes 16 --num_fields 40
+"""
+import time
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from arcana.repository import Dataset
+from arcana.data import Field
+
+
+def write_fields(args):
+    dataset_dir, worker_i, num_fields, bulk = args
+    dataset = Dataset(dataset_dir, clear_cache=False)
+    fields = [Field('field_{}_{}'.format(worker_i, i), value=float(i),
+                    frequency='per_dataset', dataset=dataset,
+                    from_analysis='benchmark')
+              for i in range(num_fields)]
+    if bulk:
+        dataset.repository.put_fields(fields)
+    else:
+        for field in fields:
+            dataset.repository.put_field(field)
+
+
+def benchmark(num_processes, num_fields, num_writers, bulk):
+    dataset_dir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        with Pool(num_processes) as pool:
+            pool.map(write_fields, [(dataset_dir, i, num_fields, bulk)
+                                    for i in range(num_writers)])
+        return time.time() - start
+    finally:
+        shutil.rmtree(dataset_dir)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--num_processes', type=int, default=16,
+                        help="Number of concurrent writer processes")
+    parser.add_argument('--num_fields', type=int, default=40,
+                        help="Number of fields written by each writer")
+    parser.add_argument('--num_writers', type=int, default=64,
+                        help="Total number of writers (e.g. sink nodes)")
+    args = parser.parse_args()
+    for bulk in (False, True):
+        elapsed = benchmark(args.num_processes, args.num_fields,
+                            args.num_writers, bulk)
+        print("{}: {:.2f}s ({} writers x {} fields, {} processes)".format(
+            'put_fields' if bulk else 'put_field', elapsed,
+            args.num_writers, args.num_fields, args.num_processes))
@@ -0,0 +1,58 @@
+"""
+Benchmarks the construction of per-session fileset and field slices over
+large numbers of sessions, and the lookup of each of their items by subject
+and visit ID.
+
+    $ python benchmarks/slices.py --num_subjects 2500 --num_visits 4
+"""
+import time
+import random
+from argparse import ArgumentParser
+from arcana.data import Fileset, Field, FilesetSlice, FieldSlice
+from arcana.data.file_format import text_format
+
+
+def create_items(num_subjects, num_visits, seed):
+    "Creates the items of the slices in a random order"
+    filesets = []
+    fields = []
+    for subj_i in range(num_subjects):
+        for visit_i in range(num_visits):
+            ids = dict(subject_id='subject{}'.format(subj_i),
+                       visit_id='visit{}'.format(visit_i))
+            filesets.append(Fileset('image', text_format, **ids))
+            fields.append(Field('value', value=subj_i + visit_i, **ids))
+    random.seed(seed)
+    random.shuffle(filesets)
+    random.shuffle(fields)
+    return filesets, fields
+
+
+def benchmark(slice_cls, name, items):
+    start = time.time()
+    slce = slice_cls(name, items, frequency='per_session')
+    construct_time = time.time() - start
+    start = time.time()
+    for item in items:
+        assert slce.item(item.subject_id, item.visit_id) is item
+    lookup_time = time.time() - start
+    return construct_time, lookup_time
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--num_subjects', type=int, default=2500,
+                        help="Number of subjects in the slices")
+    parser.add_argument('--num_visits', type=int, default=4,
+                        help="Number of visits of each subject")
+    parser.add_argument('--seed', type=int, default=1,
+                        help="Seed used to shuffle the order of the items")
+    args = parser.parse_args()
+    filesets, fields = create_items(args.num_subjects, args.num_visits,
+                                    args.seed)
+    for slice_cls, name, items in ((FilesetSlice, 'image', filesets),
+                                   (FieldSlice, 'value', fields)):
+        construct_time, lookup_time = benchmark(slice_cls, name, items)
+        print("{}: construct {:.3f}s, lookup all items {:.3f}s ({} sessions)"
+              .format(slice_cls.__name__, construct_time, lookup_time,
+                      len(items)))
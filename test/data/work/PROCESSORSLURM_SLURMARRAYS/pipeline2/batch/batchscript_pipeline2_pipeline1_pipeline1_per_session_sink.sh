@@ -0,0 +1,23 @@
+#!/bin/bash
+
+# Set the email
+#SBATCH --email=test@email.org
+
+# Request CPU resource for a parallel job
+#SBATCH --ntasks=1
+
+# Memory usage (MB)
+#SBATCH --mem-per-cpu=4000
+
+# Set your minimum acceptable walltime, format: day-hours:minutes:seconds
+#SBATCH --time=0-00:20:00
+
+# Kill job if dependencies fail
+#SBATCH --kill-on-invalid-dep=yes
+
+# Set mail triggers
+#SBATCH --mail-type=FAIL
+
+# Node and CPU options
+
+/root/.pyenv/versions/3.11.7/bin/python -c "from arcana.processor.slurm import run_array_task; run_array_task('/root/package/test/data/work/PROCESSORSLURM_SLURMARRAYS/pipeline2/batch/array_pipeline2_pipeline1_pipeline1_per_session_sink.json')"
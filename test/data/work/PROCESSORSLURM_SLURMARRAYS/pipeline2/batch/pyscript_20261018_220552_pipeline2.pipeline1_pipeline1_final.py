@@ -0,0 +1,56 @@
+import os
+import sys
+
+can_import_matplotlib = True #Silently allow matplotlib to be ignored
+try:
+    import matplotlib
+    matplotlib.use('Agg')
+except ImportError:
+    can_import_matplotlib = False
+    pass
+
+import os
+value = os.environ.get('NIPYPE_NO_ET', None)
+if value is None:
+    # disable ET for any submitted job
+    os.environ['NIPYPE_NO_ET'] = "1"
+from nipype import config, logging
+
+from nipype.utils.filemanip import loadpkl, savepkl
+from socket import gethostname
+from traceback import format_exception
+info = None
+pklfile = '/root/package/test/data/work/PROCESSORSLURM_SLURMARRAYS/pipeline2/batch/node_20261018_220552_pipeline2.pipeline1_pipeline1_final.pklz'
+batchdir = '/root/package/test/data/work/PROCESSORSLURM_SLURMARRAYS/pipeline2/batch'
+from nipype.utils.filemanip import loadpkl, savepkl
+try:
+    from collections import OrderedDict
+    config_dict={'logging': {'workflow_level': 'INFO', 'utils_level': 'INFO', 'interface_level': 'INFO', 'log_to_file': 'false', 'log_directory': '/root', 'log_size': '16384000', 'log_rotate': '4'}, 'execution': {'create_report': 'true', 'crashdump_dir': '/root/package', 'hash_method': 'timestamp', 'job_finished_timeout': '5', 'keep_inputs': 'false', 'local_hash_check': 'true', 'matplotlib_backend': 'Agg', 'plugin': 'Linear', 'remove_node_directories': 'false', 'remove_unnecessary_outputs': 'true', 'try_hard_link_datasink': 'true', 'single_thread_matlab': 'true', 'crashfile_format': 'pklz', 'stop_on_first_crash': 'false', 'stop_on_first_rerun': 'false', 'use_relative_paths': 'false', 'stop_on_unknown_version': 'false', 'write_provenance': 'false', 'parameterize_dirs': 'true', 'poll_sleep_duration': '2', 'xvfb_max_wait': '10', 'check_version': 'true'}, 'monitoring': {'enabled': 'false', 'sample_frequency': '1', 'summary_append': 'true'}, 'check': {'interval': '1209600'}}
+    config.update_config(config_dict)
+    ## Only configure matplotlib if it was successfully imported,
+    ## matplotlib is an optional component to nipype
+    if can_import_matplotlib:
+        config.update_matplotlib()
+    logging.update_logging(config)
+    traceback=None
+    cwd = os.getcwd()
+    info = loadpkl(pklfile)
+    result = info['node'].run(updatehash=info['updatehash'])
+except Exception as e:
+    etype, eval, etr = sys.exc_info()
+    traceback = format_exception(etype,eval,etr)
+    if info is None or not os.path.exists(info['node'].output_dir()):
+        result = None
+        resultsfile = os.path.join(batchdir, 'crashdump_20261018_220552_pipeline2.pipeline1_pipeline1_final.pklz')
+    else:
+        result = info['node'].result
+        resultsfile = os.path.join(info['node'].output_dir(),
+                               'result_%s.pklz'%info['node'].name)
+
+    if info is None:
+        savepkl(resultsfile, dict(result=result, hostname=gethostname(),
+                              traceback=traceback))
+    else:
+        from nipype.pipeline.plugins.base import report_crash
+        report_crash(info['node'], traceback, gethostname())
+    raise Exception(e)
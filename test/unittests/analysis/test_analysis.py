@@ -12,7 +12,7 @@ from arcana.analysis.multi import (
     MultiAnalysis, MultiAnalysisMetaClass, SubCompSpec)
 from nipype.interfaces.base import (
     BaseInterface, File, TraitedSpec, traits, isdefined)
-from arcana.analysis.parameter import ParamSpec
+from arcana.analysis.parameter import ParamSpec, Parameter
 from arcana.data.file_format import FileFormat, IdentityConverter
 from nipype.interfaces.utility import IdentityInterface
 from arcana.exceptions import ArcanaNoConverterError
@@ -306,6 +306,55 @@ class TestAnalysis(BaseMultiSubjectTestCase):
         self.assertEqual(a, 'a')
         self.assertEqual(b, 'b')
 
+    def test_pipeline_cache(self):
+        analysis = self.make_analysis()
+        pipeline1 = analysis.pipeline('pipeline1')
+        node_names = sorted(pipeline1.node_names)
+        analysis.derive('derived4')
+        # The pipeline is reused and restored to its constructed state
+        self.assertIs(analysis.pipeline('pipeline1'), pipeline1)
+        self.assertEqual(sorted(pipeline1.node_names), node_names)
+        self.assertContentsEqual(analysis.data('derived4', derive=True),
+                                 [2.0, 2.0, 2.0, 2.0, 2.0, 2.0])
+        pipeline2 = analysis.pipeline('pipeline2')
+        analysis.clear_pipelines('pipeline2')
+        self.assertIsNot(analysis.pipeline('pipeline2'), pipeline2)
+        # Pipelines aren't shared between analyses with different parameters
+        other = self.create_analysis(
+            ExampleAnalysis, 'other', inputs=[
+                FilesetFilter('one', 'one_input', text_format),
+                FilesetFilter('ten', 'ten_input', text_format)],
+            parameters={'pipeline_parameter': False})
+        self.assertRaisesRegex(Exception, "Pipeline parameter was not "
+                               "accessible", other.pipeline, 'pipeline1')
+        self.assertIs(analysis.pipeline('pipeline1'), pipeline1)
+        # The pipeline is regenerated if a parameter read by its constructor
+        # changes
+        parameters = analysis._parameters  # pylint: disable=protected-access
+        parameters['pipeline_parameter'] = Parameter('pipeline_parameter',
+                                                     False)
+        self.assertRaisesRegex(Exception, "Pipeline parameter was not "
+                               "accessible", analysis.pipeline, 'pipeline1')
+        parameters['pipeline_parameter'] = Parameter('pipeline_parameter',
+                                                     True)
+        regenerated = analysis.pipeline('pipeline1')
+        self.assertIsNot(regenerated, pipeline1)
+        self.assertEqual(sorted(regenerated.node_names), node_names)
+
+    def test_prov_cache(self):
+        analysis = self.make_analysis()
+        pipeline1 = analysis.pipeline('pipeline1')
+        pipeline1.cap()
+        workflow_prov = pipeline1.prov['workflow']
+        pipeline1.reset()
+        pipeline1.cap()
+        self.assertIs(pipeline1.prov['workflow'], workflow_prov)
+        # Adding a node invalidates the serialised workflow
+        pipeline1.reset()
+        pipeline1.add('extra', IdentityInterface(['file']))
+        pipeline1.cap()
+        self.assertIn('pipeline1_extra', pipeline1.prov['workflow']['nodes'])
+
     def test_subject_summary(self):
         analysis = self.make_analysis()
         summaries = analysis.data('subject_summary', derive=True)
@@ -512,7 +561,7 @@ class TestInputValidation(BaseTestCase):
                 f.write(spec_name)
 
     def test_input_validation(self):
-        self.create_analysis(
+        analysis = self.create_analysis(
             TestInputValidationAnalysis,
             'test_input_validation',
             inputs=[
@@ -520,6 +569,8 @@ class TestInputValidation(BaseTestCase):
                 FilesetFilter('b', 'b', test3_format),
                 FilesetFilter('c', 'a', test1_format),
                 FilesetFilter('d', 'd', test3_format)])
+        # Inputs are validated when they are bound on first access
+        self.assertEqual(len(analysis.inputs), 4)
 
 
 class TestInputValidationFail(BaseTestCase):
@@ -533,14 +584,14 @@ class TestInputValidationFail(BaseTestCase):
                 f.write(spec.name)
 
     def test_input_validation_fail(self):
-        self.assertRaises(
-            ArcanaUsageError,
-            self.create_analysis,
+        analysis = self.create_analysis(
             TestInputValidationAnalysis,
             'test_validation_fail',
             inputs=[
                 FilesetFilter('a', 'a', test3_format),
                 FilesetFilter('b', 'b', test3_format)])
+        # Inputs are validated when they are bound on first access
+        self.assertRaises(ArcanaUsageError, getattr, analysis, 'inputs')
 
 
 class TestInputNoConverter(BaseTestCase):
@@ -558,9 +609,7 @@ class TestInputNoConverter(BaseTestCase):
                 f.write(spec.name)
 
     def test_input_validation_fail(self):
-        self.assertRaises(
-            ArcanaNoConverterError,
-            self.create_analysis,
+        analysis = self.create_analysis(
             TestInputValidationAnalysis,
             'test_validation_fail',
             inputs=[
@@ -568,6 +617,8 @@ class TestInputNoConverter(BaseTestCase):
                 FilesetFilter('b', 'b', test3_format),
                 FilesetFilter('c', 'c', test3_format),
                 FilesetFilter('d', 'd', test3_format)])
+        self.assertRaises(ArcanaNoConverterError, getattr, analysis,
+                          'inputs')
 
 
 class AlwaysRaisedError(Exception):
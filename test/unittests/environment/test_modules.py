@@ -1,5 +1,9 @@
 import os
+import time
+import shutil
+import tempfile
 from unittest import TestCase
+from unittest.mock import patch
 from nipype.interfaces.utility import Merge, Split
 from arcana.data import (
     InputFilesetSpec, FilesetSpec, FilesetFilter, FieldSpec)
@@ -10,6 +14,7 @@ import unittest
 from arcana.utils.testing import BaseTestCase, TestMath
 from arcana.data.file_format import text_format
 from arcana.environment import ModulesEnv
+from arcana.environment.modules import ModulesCache
 from arcana.processor import SingleProc
 from future.utils import with_metaclass
 from arcana.environment import BaseRequirement
@@ -153,3 +158,43 @@ class TestModulesRun(TestCase):
             ArcanaModulesError,
             ModulesEnv._run_module_cmd,  # pylint: disable=protected-access
             'load', 'somereallyunlikelymodulename')
+
+
+class TestModulesCache(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.module_dir = os.path.join(self.tmp_dir, 'modulefiles')
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        os.makedirs(os.path.join(self.module_dir, 'firsttestmodule'))
+        env = {k: v for k, v in os.environ.items() if k != 'MODULESHOME'}
+        env['MODULEPATH'] = self.module_dir
+        self.env_patch = patch.dict(os.environ, env, clear=True)
+        self.env_patch.start()
+        cache = ModulesCache(self.cache_dir)
+        cache.update(available={'firsttestmodule': ['0.15']})
+        cache.update(versions={'firsttestmodule:firsttestmodule/0.15':
+                               '0.15.9'})
+
+    def tearDown(self):
+        self.env_patch.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_cached(self):
+        # Neither the available modules nor the exact version require module
+        # commands to be run as they are loaded from the cache
+        env = ModulesEnv(cache_dir=self.cache_dir)
+        version, = env.satisfy(first_req.v('0.15'))
+        self.assertEqual(str(version), '0.15.9')
+        self.assertEqual(version.local_name, 'firsttestmodule')
+        self.assertEqual(version.local_version, '0.15')
+
+    def test_modulepath_changed(self):
+        os.makedirs(os.path.join(self.module_dir, 'secondtestmodule'))
+        self.assertRaises(ArcanaModulesNotInstalledException, ModulesEnv,
+                          cache_dir=self.cache_dir)
+
+    def test_expired(self):
+        time.sleep(0.01)
+        self.assertRaises(ArcanaModulesNotInstalledException, ModulesEnv,
+                          cache_dir=self.cache_dir, cache_ttl=0.001)
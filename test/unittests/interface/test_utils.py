@@ -2,7 +2,9 @@ from builtins import next
 import os.path
 from arcana.utils.testing import BaseTestCase
 from nipype.pipeline import engine as pe
-from arcana.utils.interfaces import ZipDir, UnzipDir
+from arcana.utils.interfaces import (
+    ZipDir, UnzipDir, InProcessZipDir, InProcessUnzipDir, InProcessTarGzDir,
+    InProcessUnTarGzDir)
 
 
 class TestUtilsInterface(BaseTestCase):
@@ -28,3 +30,39 @@ class TestUtilsInterface(BaseTestCase):
                              if n.name == 'unzip').result
         self.assertEqual(
             os.listdir(unzip_results.outputs.unzipped), ['test_file'])
+
+    def test_in_process_zip_unzip(self):
+        with open(os.path.join(self.test_path, 'image.nii.gz'), 'wb') as f:
+            f.write(os.urandom(1000))
+        sub_dir = os.path.join(self.test_path, 'sub')
+        os.mkdir(sub_dir)
+        with open(os.path.join(sub_dir, 'sub_file'), 'w') as f:
+            f.write('sub' * 1000)
+        for compress_level in (0, 9):
+            zipnode = pe.Node(InProcessZipDir(compress_level=compress_level,
+                                              num_threads=2),
+                              name='zip')
+            zipnode.inputs.dirname = self.test_path
+            unzipnode = pe.Node(InProcessUnzipDir(num_threads=2),
+                                name='unzip')
+            workflow = pe.Workflow('test_zip{}'.format(compress_level),
+                                   base_dir=self.work_dir)
+            workflow.connect(zipnode, 'zipped', unzipnode, 'zipped')
+            exc_graph = workflow.run()
+            unzipped = next(n for n in exc_graph.nodes()
+                            if n.name == 'unzip').result.outputs.unzipped
+            self.assertEqual(sorted(os.listdir(unzipped)),
+                             ['image.nii.gz', 'sub', 'test_file'])
+            with open(os.path.join(unzipped, 'sub', 'sub_file')) as f:
+                self.assertEqual(f.read(), 'sub' * 1000)
+
+    def test_in_process_targz_untargz(self):
+        targznode = pe.Node(InProcessTarGzDir(num_threads=2), name='targz')
+        targznode.inputs.dirname = self.test_path
+        untargznode = pe.Node(InProcessUnTarGzDir(), name='untargz')
+        workflow = pe.Workflow('test_targz', base_dir=self.work_dir)
+        workflow.connect(targznode, 'zipped', untargznode, 'gzipped')
+        exc_graph = workflow.run()
+        gunzipped = next(n for n in exc_graph.nodes()
+                         if n.name == 'untargz').result.outputs.gunzipped
+        self.assertEqual(os.listdir(gunzipped), ['test_file'])
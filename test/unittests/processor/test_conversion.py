@@ -0,0 +1,115 @@
+import os
+import os.path as op
+import stat
+import tempfile
+import shutil
+from nipype.interfaces.utility import IdentityInterface
+from arcana.processor import SingleProc
+from arcana.processor.conversion import ConversionCache
+from arcana.data import InputFilesetSpec, FilesetSpec, FilesetFilter, Fileset
+from arcana.data.file_format import directory_format, zip_format
+from arcana.analysis.base import Analysis, AnalysisMetaClass
+from arcana.utils.testing import BaseTestCase
+
+
+class ZipAnalysis(Analysis, metaclass=AnalysisMetaClass):
+
+    add_data_specs = [
+        InputFilesetSpec('directory', directory_format),
+        FilesetSpec('zipped', zip_format, 'zip_pipeline')]
+
+    def zip_pipeline(self, **name_maps):
+        pipeline = self.new_pipeline(
+            name='zip_pipeline',
+            name_maps=name_maps,
+            desc="A pipeline that requires its input to be zipped")
+        pipeline.add(
+            'identity',
+            IdentityInterface(fields=['file']),
+            inputs={
+                'file': ('directory', zip_format)},
+            outputs={
+                'zipped': ('file', zip_format)})
+        return pipeline
+
+
+class TestConversionCache(BaseTestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        super(TestConversionCache, self).setUp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    @property
+    def INPUT_FILESETS(self):
+        path = op.join(self.tempdir, 'directory')
+        if not op.exists(path):
+            os.makedirs(path)
+            with open(op.join(path, 'dummy.txt'), 'w') as f:
+                f.write('blah')
+        return {'directory': Fileset.from_path(path, format=directory_format)}
+
+    @property
+    def cache_path(self):
+        return op.join(self.tempdir, 'cache')
+
+    def test_conversion_cache(self):
+        inputs = [FilesetFilter('directory', 'directory', directory_format)]
+        analysis = self.create_analysis(
+            ZipAnalysis, 'first', inputs,
+            processor=SingleProc(self.work_dir,
+                                 conversion_cache=self.cache_path))
+        analysis.derive('zipped')
+        cache = ConversionCache(self.cache_path)
+        self.assertEqual(len(cache.entries()), 1)
+        # A separate analysis converting the same input reuses the output
+        analysis = self.create_analysis(
+            ZipAnalysis, 'second', inputs,
+            processor=SingleProc(self.work_dir,
+                                 conversion_cache=self.cache_path))
+        with self.assertLogs('arcana', level='INFO') as logs:
+            zipped = analysis.data('zipped', derive=True)
+        self.assertTrue(any('from conversion cache' in l
+                            for l in logs.output))
+        self.assertCreated(list(zipped)[0])
+        self.assertEqual(len(cache.entries()), 1)
+        # Least recently used entries are evicted when the cache is too big
+        ConversionCache(self.cache_path, max_size_gb=0).evict()
+        self.assertEqual(cache.entries(), [])
+
+    def test_cached_copies(self):
+        cache = ConversionCache(self.cache_path)
+        node_dir = op.join(self.tempdir, 'node')
+        os.makedirs(op.join(node_dir, 'out_dir', 'sub'))
+        for fname in ('out.txt', op.join('out_dir', 'sub', 'a.txt')):
+            with open(op.join(node_dir, fname), 'w') as f:
+                f.write(fname)
+        cache.put('key', {'out_file': op.join(node_dir, 'out.txt'),
+                          'out_dir': op.join(node_dir, 'out_dir')}, node_dir)
+        cached_path = op.join(self.cache_path, 'key', cache.FILES_DIR,
+                              'out.txt')
+        self.assertFalse(os.stat(cached_path).st_mode & stat.S_IWUSR)
+        # The outputs are copied, not linked, into the working directory so
+        # editing them in place doesn't affect the cache
+        hit_dir = op.join(self.tempdir, 'hit')
+        os.makedirs(op.join(hit_dir, 'out_dir'))
+        outputs = cache.get('key', hit_dir)
+        self.assertEqual(outputs['out_file'], op.join(hit_dir, 'out.txt'))
+        with open(op.join(hit_dir, 'out_dir', 'sub', 'a.txt')) as f:
+            self.assertEqual(f.read(), op.join('out_dir', 'sub', 'a.txt'))
+        self.assertNotEqual(os.stat(outputs['out_file']).st_ino,
+                            os.stat(cached_path).st_ino)
+        with open(outputs['out_file'], 'w') as f:
+            f.write('modified')
+        with open(cached_path) as f:
+            self.assertEqual(f.read(), 'out.txt')
+        # Entries whose files have been corrupted are treated as misses and
+        # removed
+        os.chmod(cached_path, 0o644)
+        with open(cached_path, 'w') as f:
+            f.write('corrupted')
+        with self.assertLogs('arcana', level='WARNING'):
+            self.assertIsNone(cache.get('key', op.join(self.tempdir, 'miss')))
+        self.assertFalse(op.exists(op.join(self.cache_path, 'key')))
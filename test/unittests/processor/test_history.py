@@ -0,0 +1,114 @@
+import sys
+import os.path as op
+import json
+from unittest import TestCase
+import tempfile
+import shutil
+from nipype.interfaces.utility import IdentityInterface
+from arcana.processor import SingleProc, SlurmProc
+from arcana.processor.history import ResourceHistory, interface_name
+from arcana.environment.base import Node
+from arcana.environment import StaticEnv
+from arcana.data import Field, FieldFilter
+from arcana.repository import Tree
+from arcana.utils.testing import BaseMultiSubjectTestCase
+
+sys.path.insert(0, op.dirname(__file__))
+from test_to_process import (  # noqa pylint: disable=import-error
+    TestDialationAnalysis)
+sys.path.pop(0)
+
+
+class TestResourceHistory(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.history = ResourceHistory(op.join(self.tmp_dir, 'history.jsonl'),
+                                       percentile=50, min_samples=3,
+                                       padding=1.0)
+        self.node = Node(environment=StaticEnv(),
+                         interface=IdentityInterface('x'), name='node',
+                         wall_time=150, n_procs=1, mem_gb=8)
+        self.node._hierarchy = 'workflow.pipeline'
+        self.interface = interface_name(self.node)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def add_history(self):
+        # Synthetic history where the resources are proportional to the size
+        # of the inputs
+        for size in (100, 200, 300, 400):
+            self.history.record('pipeline', 'node', self.interface,
+                                wall_time=size / 10.0, mem_gb=size / 100.0,
+                                input_size=size)
+
+    def test_estimate(self):
+        self.assertEqual(
+            self.history.estimate('pipeline', 'node', self.interface),
+            (None, None))
+        self.add_history()
+        wall_time, mem_gb = self.history.estimate('pipeline', 'node',
+                                                  self.interface)
+        self.assertAlmostEqual(wall_time, 25.0)
+        self.assertAlmostEqual(mem_gb, 2.5)
+        # Scaled by input size
+        wall_time, mem_gb = self.history.estimate(
+            'pipeline', 'node', self.interface, input_size=1000)
+        self.assertAlmostEqual(wall_time, 100.0)
+        self.assertAlmostEqual(mem_gb, 10.0)
+        self.assertEqual(
+            self.history.estimate('pipeline', 'other', self.interface),
+            (None, None))
+
+    def test_slurm_template(self):
+        processor = SlurmProc(self.tmp_dir, email='test@email.org',
+                              resource_history=self.history)
+        # Falls back to the static hints without history
+        template = processor.slurm_template(self.node)
+        self.assertIn('#SBATCH --time=0-02:30:00\n', template)
+        self.assertIn('#SBATCH --mem-per-cpu=8000\n', template)
+        self.add_history()
+        template = processor.slurm_template(self.node)
+        self.assertIn('#SBATCH --time=0-00:25:00\n', template)
+        self.assertIn('#SBATCH --mem-per-cpu=2500\n', template)
+
+
+class TestRecordResources(BaseMultiSubjectTestCase):
+
+    NUM_SUBJECTS = 2
+    NUM_VISITS = 2
+    STUDY_INPUTS = [FieldFilter('acquired_field1', 'acquired_field1', int)]
+
+    @property
+    def input_tree(self):
+        fields = []
+        for subj_i in range(self.NUM_SUBJECTS):
+            for visit_i in range(self.NUM_VISITS):
+                fields.append(
+                    Field(name='acquired_field1', value=visit_i + subj_i * 10,
+                          dtype=int, frequency='per_session',
+                          subject_id=str(subj_i), visit_id=str(visit_i)))
+        return Tree.construct(self.dataset.repository, fields=fields)
+
+    def test_record(self):
+        history_path = op.join(self.work_dir, 'history.jsonl')
+        analysis = self.create_analysis(
+            TestDialationAnalysis, 'record', inputs=self.STUDY_INPUTS,
+            processor=SingleProc(self.work_dir,
+                                 resource_history=history_path))
+        analysis.derive('derived_field1')
+        with open(history_path) as f:
+            records = [json.loads(l) for l in f]
+        math_records = [r for r in records if r['node'] == 'pipeline1_math']
+        self.assertEqual(len(math_records), 4)
+        # Peak memory isn't recorded as NiPype's resource monitor isn't
+        # enabled
+        self.assertTrue(all(r['pipeline'] == 'pipeline1'
+                            and r['wall_time'] >= 0 and r['mem_gb'] is None
+                            for r in math_records))
+        # The history is used to estimate the resources of the node
+        math = analysis.pipeline('pipeline1').node('math')
+        wall_time, _ = analysis.processor.node_resources(
+            math, pipeline_name='pipeline1')
+        self.assertLess(wall_time, math.wall_time)
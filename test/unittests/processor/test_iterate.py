@@ -0,0 +1,64 @@
+import sys
+import os.path as op
+from arcana.processor import SingleProc
+from arcana.data import Field, FieldFilter
+from arcana.repository import Tree
+from arcana.utils.testing import BaseMultiSubjectTestCase
+from arcana.exceptions import ArcanaUsageError
+
+sys.path.insert(0, op.dirname(__file__))
+from test_to_process import (  # noqa pylint: disable=import-error
+    TestDialationAnalysis)
+sys.path.pop(0)
+
+
+class TestSessionIteration(BaseMultiSubjectTestCase):
+
+    NUM_SUBJECTS = 3
+    NUM_VISITS = 3
+    STUDY_INPUTS = [FieldFilter('acquired_field1', 'acquired_field1', int)]
+    # A sparse (non-factorizable) selection of sessions
+    SESSION_IDS = [('0', '0'), ('1', '1'), ('1', '2'), ('2', '0')]
+
+    @property
+    def input_tree(self):
+        fields = []
+        for subj_i in range(self.NUM_SUBJECTS):
+            for visit_i in range(self.NUM_VISITS):
+                fields.append(
+                    Field(name='acquired_field1', value=visit_i + subj_i * 10,
+                          dtype=int, frequency='per_session',
+                          subject_id=str(subj_i), visit_id=str(visit_i)))
+        return Tree.construct(self.dataset.repository, fields=fields)
+
+    def derive(self, name, iteration):
+        analysis = self.create_analysis(
+            TestDialationAnalysis, name, inputs=self.STUDY_INPUTS,
+            processor=SingleProc(self.work_dir, iteration=iteration))
+        field1 = analysis.data('derived_field1', session_ids=self.SESSION_IDS,
+                               derive=True)
+        return analysis, {(f.subject_id, f.visit_id): f.value for f in field1}
+
+    def test_sessions(self):
+        analysis, values = self.derive('sessions', 'sessions')
+        self.assertEqual(values, {('0', '0'): 1, ('1', '1'): 12,
+                                  ('1', '2'): 13, ('2', '0'): 21})
+        # Check that sessions that weren't selected weren't processed
+        self.assertFalse(analysis.data('derived_field1').item('0', '1').exists)
+
+    def test_modes_match(self):
+        _, sessions_values = self.derive('auto', 'auto')
+        _, product_values = self.derive('product', 'product')
+        self.assertEqual(sessions_values, product_values)
+
+    def test_joined_fallback(self):
+        # Pipelines that join over visits can't iterate over sessions
+        analysis = self.create_analysis(
+            TestDialationAnalysis, 'joined', inputs=self.STUDY_INPUTS,
+            processor=SingleProc(self.work_dir, iteration='sessions'))
+        field2 = analysis.data('derived_field2', derive=True)
+        self.assertEqual(field2.value(subject_id='0'), 6)
+
+    def test_bad_mode(self):
+        self.assertRaises(ArcanaUsageError, SingleProc, self.work_dir,
+                          iteration='unknown')
@@ -0,0 +1,99 @@
+import sys
+import os.path as op
+from arcana.processor import SingleProc
+from arcana.processor.metrics import (
+    MetricsLog, resource_usage, usage_between)
+from arcana.data import Field, FieldFilter
+from arcana.repository import Tree
+from arcana.utils.testing import BaseMultiSubjectTestCase
+
+sys.path.insert(0, op.dirname(__file__))
+from test_to_process import (  # noqa pylint: disable=import-error
+    TestDialationAnalysis)
+sys.path.pop(0)
+
+
+class TestMetrics(BaseMultiSubjectTestCase):
+
+    NUM_SUBJECTS = 2
+    NUM_VISITS = 2
+    STUDY_INPUTS = [FieldFilter('acquired_field1', 'acquired_field1', int)]
+
+    @property
+    def input_tree(self):
+        fields = []
+        for subj_i in range(self.NUM_SUBJECTS):
+            for visit_i in range(self.NUM_VISITS):
+                fields.append(
+                    Field(name='acquired_field1', value=visit_i + subj_i * 10,
+                          dtype=int, frequency='per_session',
+                          subject_id=str(subj_i), visit_id=str(visit_i)))
+        return Tree.construct(self.dataset.repository, fields=fields)
+
+    def test_usage(self):
+        before = resource_usage()
+        with open(op.join(self.work_dir, 'usage.txt'), 'w') as f:
+            f.write('x' * 10000)
+        metrics = usage_between(before, resource_usage())
+        self.assertGreaterEqual(metrics['wall_time'], 0)
+        if metrics['write_bytes'] is not None:
+            self.assertGreaterEqual(metrics['write_bytes'], 10000)
+
+    def test_session_summary(self):
+        metrics_log = MetricsLog(op.join(self.work_dir, 'metrics.jsonl'))
+        for subj_id in ('0', '1'):
+            for visit_id in ('0', '1'):
+                metrics_log.append('pipeline1', 'node', 'Interface',
+                                   {'wall_time': 1.0}, subject_id=subj_id,
+                                   visit_id=visit_id)
+        metrics_log.append('pipeline1', 'summary', 'Interface',
+                           {'wall_time': 2.0})
+        metrics_log.append('pipeline2', 'node', 'Interface',
+                           {'wall_time': 4.0}, subject_id='0', visit_id='1')
+        self.assertEqual(len(metrics_log.records()), 6)
+        summary = metrics_log.session_summary('pipeline1', '0', '1')
+        self.assertEqual(sorted(summary), ['node', 'summary'])
+        self.assertEqual(summary['node']['runs'], 1)
+        self.assertEqual(summary['node']['wall_time'], 1.0)
+        # Per-visit sinks summarise the nodes run for all subjects
+        summary = metrics_log.session_summary('pipeline1', visit_id='1')
+        self.assertEqual(summary['node']['runs'], 2)
+        self.assertEqual(summary['node']['wall_time'], 2.0)
+
+    def test_collect(self):
+        analysis = self.create_analysis(
+            TestDialationAnalysis, 'collect', inputs=self.STUDY_INPUTS,
+            processor=SingleProc(self.work_dir, metrics_in_prov=True))
+        analysis.derive('derived_field1')
+        metrics_log = analysis.processor.metrics_log
+        self.assertTrue(op.exists(metrics_log.path))
+        records = metrics_log.records()
+        math_records = [r for r in records if r['node'] == 'pipeline1_math']
+        self.assertEqual(
+            sorted((r['subject_id'], r['visit_id']) for r in math_records),
+            [('0', '0'), ('0', '1'), ('1', '0'), ('1', '1')])
+        self.assertTrue(all(r['pipeline'] == 'pipeline1'
+                            and r['wall_time'] >= 0
+                            and not r['repository_io']
+                            for r in math_records))
+        self.assertTrue(any(r['repository_io'] for r in records))
+        # Aggregate by pipeline and node
+        summary = MetricsLog(metrics_log.path).summary()
+        self.assertEqual(summary[('pipeline1', 'pipeline1_math')]['runs'], 4)
+        self.assertIn('pipeline1_math', metrics_log.report())
+        # Summary of the session's nodes is saved in the provenance
+        field1 = analysis.data('derived_field1')
+        prov = field1.item('0', '1').record.prov
+        self.assertIn('pipeline1_math', prov['metrics'])
+        self.assertEqual(prov['metrics']['pipeline1_math']['runs'], 1)
+        # Only the nodes run for the sink's own session are included
+        session_records = metrics_log.session_records('pipeline1', '0', '1')
+        self.assertTrue(session_records)
+        self.assertTrue(all(r['subject_id'] in ('0', None)
+                            and r['visit_id'] in ('1', None)
+                            for r in session_records))
+        self.assertEqual(
+            {n: m['runs'] for n, m in prov['metrics'].items()},
+            {'pipeline1_per_session_source': 1, 'pipeline1_math': 1})
+        # Metrics aren't checked for provenance mismatches
+        analysis.derive('derived_field1')
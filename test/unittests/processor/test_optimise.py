@@ -0,0 +1,94 @@
+import sys
+import os.path as op
+from unittest import TestCase
+from nipype.pipeline import engine as pe
+from nipype.interfaces.utility import IdentityInterface, Merge
+from arcana.processor import SingleProc
+from arcana.processor.optimise import optimise_workflow
+from arcana.data import Field, FieldFilter
+from arcana.repository import Tree
+from arcana.utils.testing import BaseMultiSubjectTestCase, TestMath
+
+sys.path.insert(0, op.dirname(__file__))
+from test_to_process import (  # noqa pylint: disable=import-error
+    TestDialationAnalysis)
+sys.path.pop(0)
+
+
+class TestOptimiseWorkflow(TestCase):
+
+    def test_passes(self):
+        workflow = pe.Workflow(name='optimise')
+        inputnode = pe.Node(IdentityInterface(['x']), name='inputnode')
+        inputnode.inputs.x = 1.0
+        # Two nodes performing the same operation on the same input
+        math1 = pe.Node(TestMath(op='add', as_file=False, y=1.0),
+                        name='math1')
+        math2 = pe.Node(TestMath(op='add', as_file=False, y=1.0),
+                        name='math2')
+        math3 = pe.Node(TestMath(op='mul', as_file=False, y=2.0),
+                        name='math3')
+        merge1 = pe.Node(Merge(2), name='merge1')
+        merge2 = pe.Node(Merge(2), name='merge2')
+        final = pe.Node(TestMath(op='add', as_file=False), name='final')
+        unused = pe.Node(Merge(1), name='unused')
+        workflow.connect(inputnode, 'x', math1, 'x')
+        workflow.connect(inputnode, 'x', math2, 'x')
+        workflow.connect(inputnode, 'x', math3, 'x')
+        workflow.connect(math1, 'z', merge1, 'in1')
+        workflow.connect(math2, 'z', merge1, 'in2')
+        workflow.connect(merge1, 'out', merge2, 'in1')
+        workflow.connect(math3, 'z', merge2, 'in2')
+        workflow.connect(merge2, 'out', final, 'x')
+        workflow.connect(final, 'z', unused, 'in1')
+        optimised, stats = optimise_workflow(workflow)
+        self.assertEqual(stats['nodes_before'], 8)
+        self.assertEqual(stats['identity_removed'], 1)
+        self.assertEqual(stats['deduplicated'], 1)
+        self.assertEqual(stats['dead_ends_removed'], 1)
+        self.assertEqual(stats['fused'], 1)
+        self.assertEqual(stats['nodes_after'], 4)
+        self.assertEqual(
+            sorted(n.name for n in optimised._graph.nodes()),
+            ['final', 'math1', 'math3', 'merge2'])
+        merge = optimised.get_node('merge2')
+        self.assertEqual(merge.interface._numinputs, 3)
+        self.assertEqual(
+            sorted(d for _, _, data in optimised._graph.in_edges(
+                merge, data=True) for _, d in data['connect']),
+            ['in1', 'in2', 'in3'])
+
+
+class TestOptimiseGraph(BaseMultiSubjectTestCase):
+
+    NUM_SUBJECTS = 2
+    NUM_VISITS = 2
+    STUDY_INPUTS = [FieldFilter('acquired_field1', 'acquired_field1', int)]
+
+    FIELD5_VALUES = {
+        ('0', '0'): 41,
+        ('0', '1'): 43,
+        ('1', '0'): 61,
+        ('1', '1'): 63}
+
+    @property
+    def input_tree(self):
+        fields = []
+        for subj_i in range(self.NUM_SUBJECTS):
+            for visit_i in range(self.NUM_VISITS):
+                fields.append(
+                    Field(name='acquired_field1', value=visit_i + subj_i * 10,
+                          dtype=int, frequency='per_session',
+                          subject_id=str(subj_i), visit_id=str(visit_i)))
+        return Tree.construct(self.dataset.repository, fields=fields)
+
+    def test_optimise_graph(self):
+        analysis = self.create_analysis(
+            TestDialationAnalysis, 'optimise_graph', inputs=self.STUDY_INPUTS,
+            processor=SingleProc(self.work_dir, optimise_graph=True))
+        with self.assertLogs('arcana', level='INFO') as logs:
+            field5 = analysis.data('derived_field5', derive=True)
+        self.assertEqual(
+            {(f.subject_id, f.visit_id): f.value for f in field5},
+            self.FIELD5_VALUES)
+        self.assertTrue(any('Optimised' in l for l in logs.output))
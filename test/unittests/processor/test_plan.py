@@ -0,0 +1,53 @@
+import sys
+import os.path as op
+from arcana.processor import SingleProc
+from arcana.processor.plan import (
+    MISSING_OUTPUT, PROV_MISMATCH, PREREQUISITE)
+from arcana.utils.testing import BaseTestCase
+
+sys.path.insert(0, op.dirname(__file__))
+from test_to_process import (  # noqa pylint: disable=import-error
+    TestProvAnalysis, STUDY_INPUTS, INPUT_FILESETS, INPUT_FIELDS)
+sys.path.pop(0)
+
+
+class TestPlan(BaseTestCase):
+
+    INPUT_FILESETS = INPUT_FILESETS
+    INPUT_FIELDS = INPUT_FIELDS
+
+    def test_plan(self):
+        analysis = self.create_analysis(TestProvAnalysis, 'plan',
+                                        inputs=STUDY_INPUTS)
+        plan = analysis.plan('derived_field2')
+        self.assertEqual([p.pipeline_name for p in plan],
+                         ['pipeline1', 'pipeline2', 'pipeline3'])
+        self.assertEqual(plan.num_nodes, 3)
+        node = plan['pipeline2'].nodes[0]
+        self.assertEqual((node.subject_id, node.visit_id), self.SESSION)
+        self.assertIn((PREREQUISITE, 'pipeline1'), node.reasons)
+        self.assertIn((MISSING_OUTPUT, 'derived_fileset1'), node.reasons)
+        self.assertIsNotNone(plan['pipeline3'].wall_time)
+        table = str(plan)
+        self.assertIn('pipeline3', table)
+        self.assertIn('3 node(s) to process', table)
+        # Check that nothing was derived while planning
+        self.assertFalse(analysis.data('derived_field2').item(
+            *self.SESSION).exists)
+        analysis.derive('derived_field2')
+        self.assertEqual(analysis.plan('derived_field2').num_nodes, 0)
+
+    def test_plan_mismatch(self):
+        analysis = self.create_analysis(TestProvAnalysis, 'plan_mismatch',
+                                        inputs=STUDY_INPUTS)
+        analysis.derive('derived_field3')
+        analysis = self.create_analysis(
+            TestProvAnalysis, 'plan_mismatch',
+            processor=SingleProc(self.work_dir, reprocess=True),
+            inputs=STUDY_INPUTS, parameters={'subtract': 100})
+        plan = analysis.plan('derived_field3')
+        self.assertEqual([p.pipeline_name for p in plan if p.nodes],
+                         ['pipeline3'])
+        self.assertEqual(
+            plan['pipeline3'].nodes[0].reasons,
+            [(PROV_MISMATCH, 'workflow/nodes/pipeline3_math2/parameters/y')])
@@ -0,0 +1,245 @@
+import sys
+import os
+import os.path as op
+import time
+import threading
+import tempfile
+import shutil
+from unittest import TestCase
+from arcana.processor import SingleProc
+from arcana.processor.prefetch import InputPrefetcher
+from arcana.utils.testing import BaseTestCase
+from arcana.exceptions import ArcanaUsageError
+from arcana.repository.interfaces import sourced_marker
+
+sys.path.insert(0, op.dirname(__file__))
+from test_to_process import (  # noqa pylint: disable=import-error
+    TestProvAnalysis, STUDY_INPUTS, INPUT_FILESETS, INPUT_FIELDS)
+sys.path.pop(0)
+
+
+class DummyFileset(object):
+
+    def __init__(self, path, tracker, delay=0.0):
+        self.path = path
+        self.aux_files = {}
+        self.tracker = tracker
+        self.delay = delay
+
+    def get(self):
+        self.tracker.enter()
+        time.sleep(self.delay)
+        self.tracker.exit()
+
+
+class DummyRepository(object):
+
+    def __init__(self):
+        self.depth = 0
+        self.num_connections = 0
+
+    def __enter__(self):
+        if not self.depth:
+            self.num_connections += 1
+        self.depth += 1
+        return self
+
+    def __exit__(self, *args):
+        self.depth -= 1
+
+
+class DummyDataset(object):
+
+    def __init__(self, repository):
+        self.repository = repository
+
+
+class ConcurrencyTracker(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = 0
+        self.maximum = 0
+        self.count = 0
+
+    def enter(self):
+        with self.lock:
+            self.current += 1
+            self.count += 1
+            self.maximum = max(self.maximum, self.current)
+
+    def exit(self):
+        with self.lock:
+            self.current -= 1
+
+
+class VirtualTimePrefetcher(InputPrefetcher):
+    "Advances a virtual clock instead of waiting when throttled"
+
+    def __init__(self, *args, **kwargs):
+        self.now = 0.0
+        super(VirtualTimePrefetcher, self).__init__(*args, **kwargs)
+
+    def _clock(self):
+        return self.now
+
+    def _wait(self, delay):
+        self.now += delay
+
+
+def wait_for(condition, timeout=10.0, interval=0.01):
+    """
+    Polls the condition until it is met or the timeout elapses, returning
+    whether it was met
+    """
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+class TestInputPrefetcher(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = op.join(self.tmp_dir, 'data.txt')
+        with open(self.path, 'wb') as f:
+            f.write(b'x' * 10000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def sessions(self, tracker, num_sessions=10, per_session=2, delay=0.0):
+        return [(('subj{}'.format(i), 'visit'),
+                 [DummyFileset(self.path, tracker, delay=delay)
+                  for _ in range(per_session)])
+                for i in range(num_sessions)]
+
+    def test_fetch_all(self):
+        tracker = ConcurrencyTracker()
+        with InputPrefetcher(self.sessions(tracker), lookahead=3,
+                             max_workers=2) as prefetcher:
+            prefetcher.join()
+        self.assertEqual(tracker.count, 20)
+        self.assertEqual(len(prefetcher.fetched), 20)
+        self.assertEqual(prefetcher.num_bytes, 200000)
+        self.assertFalse(prefetcher.failed)
+
+    def test_bounded_concurrency(self):
+        tracker = ConcurrencyTracker()
+        prefetcher = InputPrefetcher(
+            self.sessions(tracker, delay=0.01), lookahead=4, max_workers=2)
+        prefetcher.start()
+        prefetcher.join()
+        self.assertEqual(tracker.count, 20)
+        self.assertLessEqual(tracker.maximum, 2)
+
+    def test_bandwidth(self):
+        tracker = ConcurrencyTracker()
+        # At 0.1 MB/s the last of 10 x 10KB retrievals can't start until
+        # 90KB / 0.1 MB/s = 0.9 s after the first
+        with VirtualTimePrefetcher(self.sessions(tracker, per_session=1),
+                                   lookahead=2, max_workers=1,
+                                   max_bandwidth=0.1) as prefetcher:
+            prefetcher.join()
+        self.assertEqual(tracker.count, 10)
+        self.assertAlmostEqual(prefetcher.now, 0.9)
+
+    def test_stop(self):
+        tracker = ConcurrencyTracker()
+        prefetcher = InputPrefetcher(
+            self.sessions(tracker, delay=0.05), lookahead=1, max_workers=1)
+        prefetcher.start()
+        prefetcher.stop()
+        self.assertFalse(prefetcher.running)
+        self.assertLess(tracker.count, 20)
+
+    def test_failure(self):
+
+        class FailingFileset(DummyFileset):
+
+            def get(self):
+                raise IOError("Could not download")
+
+        tracker = ConcurrencyTracker()
+        sessions = self.sessions(tracker, num_sessions=2)
+        sessions[0][1].append(FailingFileset(self.path, tracker))
+        with InputPrefetcher(sessions, lookahead=2) as prefetcher:
+            prefetcher.join()
+        self.assertEqual(len(prefetcher.fetched), 4)
+        self.assertEqual(len(prefetcher.failed), 1)
+
+    def test_connection_held(self):
+        tracker = ConcurrencyTracker()
+        repository = DummyRepository()
+        sessions = self.sessions(tracker, num_sessions=4)
+        connected = []
+        for _, filesets in sessions:
+            for fileset in filesets:
+                fileset.dataset = DummyDataset(repository)
+                fileset.get = (lambda: connected.append(repository.depth))
+        with InputPrefetcher(sessions, lookahead=2) as prefetcher:
+            prefetcher.join()
+        self.assertEqual(len(connected), 8)
+        self.assertTrue(all(connected))
+        self.assertEqual(repository.num_connections, 1)
+        self.assertEqual(repository.depth, 0)
+
+    def test_follow_progress(self):
+        tracker = ConcurrencyTracker()
+        sessions = self.sessions(tracker, num_sessions=6, per_session=1)
+        progress_dir = op.join(self.tmp_dir, 'progress')
+        os.mkdir(progress_dir)
+        # The first session has already been sourced by the workflow
+        open(sourced_marker(progress_dir, 'subj0', 'visit'), 'w').close()
+        prefetcher = InputPrefetcher(sessions, lookahead=2,
+                                     progress_dir=progress_dir,
+                                     poll_interval=0.01)
+        prefetcher.start()
+        try:
+            # Only the two sessions after the sourced one are within the
+            # lookahead, and the sourced session isn't retrieved again
+            self.assertTrue(wait_for(lambda: tracker.count == 2))
+            time.sleep(0.1)  # Give it the chance to run ahead
+            self.assertEqual(tracker.count, 2)
+            # Mark the sessions in reverse order so session 3 is marked as
+            # sourced before it comes within the lookahead
+            for i in reversed(range(1, 4)):
+                open(sourced_marker(progress_dir, 'subj{}'.format(i),
+                                    'visit'), 'w').close()
+            # Sessions 4 and 5 are now within the lookahead (session 3 was
+            # sourced before it could be prefetched)
+            self.assertTrue(wait_for(lambda: not prefetcher.running))
+            self.assertEqual(tracker.count, 4)
+        finally:
+            prefetcher.stop()
+
+    def test_bad_lookahead(self):
+        self.assertRaises(ArcanaUsageError, InputPrefetcher, [], lookahead=0)
+
+
+class TestPrefetchRun(BaseTestCase):
+
+    INPUT_FILESETS = INPUT_FILESETS
+    INPUT_FIELDS = INPUT_FIELDS
+
+    def test_run_with_prefetch(self):
+        analysis = self.create_analysis(
+            TestProvAnalysis,
+            'prefetch',
+            processor=SingleProc(self.work_dir, prefetch=2,
+                                 prefetch_workers=2),
+            inputs=STUDY_INPUTS)
+        self.assertEqual(
+            analysis.data('derived_field2', derive=True).value(*self.SESSION),
+            156.0)
+        # The source nodes mark the sessions they source for the prefetcher
+        progress_dirs = os.listdir(op.join(
+            self.work_dir, SingleProc.PREFETCH_PROGRESS_DIR))
+        self.assertTrue(any(
+            op.exists(sourced_marker(
+                op.join(self.work_dir, SingleProc.PREFETCH_PROGRESS_DIR, d),
+                *self.SESSION))
+            for d in progress_dirs))
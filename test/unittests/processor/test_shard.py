@@ -0,0 +1,81 @@
+import sys
+import os.path as op
+import json
+from arcana.processor import SingleProc
+from arcana.data import Field, FieldFilter
+from arcana.repository import Tree
+from arcana.utils.testing import BaseMultiSubjectTestCase
+
+sys.path.insert(0, op.dirname(__file__))
+from test_to_process import (  # noqa pylint: disable=import-error
+    TestDialationAnalysis)
+sys.path.pop(0)
+
+
+class TestShards(BaseMultiSubjectTestCase):
+
+    NUM_SUBJECTS = 3
+    NUM_VISITS = 2
+    STUDY_INPUTS = [FieldFilter('acquired_field1', 'acquired_field1', int)]
+
+    @property
+    def input_tree(self):
+        fields = []
+        for subj_i in range(self.NUM_SUBJECTS):
+            for visit_i in range(self.NUM_VISITS):
+                fields.append(
+                    Field(name='acquired_field1', value=visit_i + subj_i * 10,
+                          dtype=int, frequency='per_session',
+                          subject_id=str(subj_i), visit_id=str(visit_i)))
+        return Tree.construct(self.dataset.repository, fields=fields)
+
+    def create(self, name, **kwargs):
+        return self.create_analysis(
+            TestDialationAnalysis, name, inputs=self.STUDY_INPUTS,
+            processor=SingleProc(self.work_dir, **kwargs))
+
+    def test_partition(self):
+        analysis = self.create('partition')
+        processor = analysis.processor
+        # Independent sessions
+        shards = processor.shards(analysis.pipeline('pipeline1'),
+                                  shard_size=4)
+        self.assertEqual([len(s) for s in shards], [4, 2])
+        # Visits of each subject are joined
+        shards = processor.shards(analysis.pipeline('pipeline2'),
+                                  shard_size=1)
+        self.assertEqual(shards, [[('0', '0'), ('0', '1')],
+                                  [('1', '0'), ('1', '1')],
+                                  [('2', '0'), ('2', '1')]])
+        # Subjects of each visit are joined
+        shards = processor.shards(analysis.pipeline('pipeline3'),
+                                  shard_size=4)
+        self.assertEqual([sorted(set(v for _, v in s)) for s in shards],
+                         [['0'], ['1']])
+        # Everything is joined
+        shards = processor.shards(analysis.pipeline('pipeline4'),
+                                  shard_size=1)
+        self.assertEqual([len(s) for s in shards], [6])
+
+    def test_sharded_run(self):
+        analysis = self.create('sharded_run', shard_size=2)
+        field2 = analysis.data('derived_field2', derive=True)
+        self.assertEqual(field2.value(subject_id='0'), 3)
+        self.assertEqual(field2.value(subject_id='1'), 23)
+        self.assertEqual(field2.value(subject_id='2'), 43)
+        self.assertFalse(op.exists(op.join(
+            self.work_dir, 'pipeline2' + SingleProc.SHARD_LEDGER_SUFFIX)))
+
+    def test_resume(self):
+        analysis = self.create('resume', shard_size=2)
+        shards = analysis.processor.shards(analysis.pipeline('pipeline1'))
+        # Write a ledger that records the first shard as completed
+        with open(op.join(self.work_dir, 'pipeline1'
+                          + SingleProc.SHARD_LEDGER_SUFFIX), 'w') as f:
+            json.dump({'shards': shards, 'completed': [0]}, f)
+        analysis.derive('derived_field1')
+        field1 = analysis.data('derived_field1')
+        for subj_id, visit_id in shards[0]:
+            self.assertFalse(field1.item(subj_id, visit_id).exists)
+        for subj_id, visit_id in shards[1] + shards[2]:
+            self.assertTrue(field1.item(subj_id, visit_id).exists)
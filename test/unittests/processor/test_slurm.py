@@ -1,11 +1,29 @@
+import os
+import os.path as op
+import sys
+import json
+import stat
 import logging
 import tempfile
 import shutil
+from glob import glob
 from arcana.processor import SlurmProc
+from arcana.processor.slurm import (
+    ArcanaSlurmArrayPlugin, ArcanaSlurmBundlePlugin)
 from nipype.interfaces.utility import IdentityInterface
 from unittest import TestCase
 from arcana.environment.base import Node
 from arcana.environment import StaticEnv
+from arcana.data import Field, FieldFilter
+from arcana.repository import Tree
+from arcana.utils.testing import BaseMultiSubjectTestCase
+from arcana.exceptions import (
+    ArcanaJobSubmittedException, ArcanaUsageError, ArcanaError)
+
+sys.path.insert(0, op.dirname(__file__))
+from test_to_process import (  # noqa pylint: disable=import-error
+    TestDialationAnalysis)
+sys.path.pop(0)
 
 
 logger = logging.getLogger('arcana')
@@ -34,12 +52,274 @@ class TestSlurmTemplate(TestCase):
             generated, ref_template.strip(),
             '\n{}\n----\n{}'.format(generated, ref_template))
 
+    def test_bundle_template(self):
+        nodes = [
+            Node(environment=StaticEnv(), interface=IdentityInterface('x'),
+                 name='x', wall_time=150, n_procs=10, mem_gb=2),
+            Node(environment=StaticEnv(), interface=IdentityInterface('y'),
+                 name='y', wall_time=30, n_procs=2, mem_gb=4)]
+        generated = self.processor.slurm_template(nodes)
+        self.assertIn('#SBATCH --ntasks=10\n', generated)
+        self.assertIn('#SBATCH --mem-per-cpu=4000\n', generated)
+        self.assertIn('#SBATCH --time=0-03:00:00\n', generated)
+
     def test_wall_time(self):
         self.assertEqual(self.processor.wall_time_str(1550.5), '1-01:50:30')
         self.assertEqual(self.processor.wall_time_str(1.75), '0-00:01:45')
         self.assertEqual(self.processor.wall_time_str(725), '0-12:05:00')
 
 
+class TestSlurmSubmission(BaseMultiSubjectTestCase):
+
+    NUM_SUBJECTS = 3
+    NUM_VISITS = 2
+    STUDY_INPUTS = [FieldFilter('acquired_field1', 'acquired_field1', int)]
+
+    @property
+    def input_tree(self):
+        fields = []
+        for subj_i in range(self.NUM_SUBJECTS):
+            for visit_i in range(self.NUM_VISITS):
+                fields.append(
+                    Field(name='acquired_field1', value=visit_i + subj_i * 10,
+                          dtype=int, frequency='per_session',
+                          subject_id=str(subj_i), visit_id=str(visit_i)))
+        return Tree.construct(self.dataset.repository, fields=fields)
+
+    def setUp(self):
+        super(TestSlurmSubmission, self).setUp()
+        # Put a stub 'sbatch' on the path that logs its arguments and runs
+        # the submitted job (or tasks of the array) immediately
+        self.stub_dir = tempfile.mkdtemp()
+        self.sbatch_log = op.join(self.stub_dir, 'sbatch.log')
+        stub_path = op.join(self.stub_dir, 'sbatch')
+        with open(stub_path, 'w') as f:
+            f.write(sbatch_stub.format(python=sys.executable,
+                                       log=self.sbatch_log))
+        os.chmod(stub_path, os.stat(stub_path).st_mode | stat.S_IEXEC)
+        self.orig_environ = dict(os.environ)
+        os.environ['PATH'] = self.stub_dir + os.pathsep + os.environ['PATH']
+        os.environ['PYTHONPATH'] = os.pathsep.join(sys.path)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.orig_environ)
+        shutil.rmtree(self.stub_dir)
+
+    def test_job_arrays(self):
+        analysis = self.create_analysis(
+            TestDialationAnalysis, 'job_arrays', inputs=self.STUDY_INPUTS,
+            processor=SlurmProc(self.work_dir, email='test@email.org',
+                                job_arrays=True, iteration='product'))
+        self.assertRaises(ArcanaJobSubmittedException, analysis.derive,
+                          'derived_field2')
+        with open(self.sbatch_log) as f:
+            submissions = {s['name']: s for s in map(json.loads, f)}
+        manifests = {}
+        for path in glob(op.join(self.work_dir, '*', 'batch',
+                                 ArcanaSlurmArrayPlugin.MANIFEST_PREFIX
+                                 + '*.json')):
+            with open(path) as f:
+                manifest = json.load(f)
+            manifests[manifest['name']] = manifest
+        # One submission per workflow node instead of per expanded node
+        self.assertEqual(sorted(submissions), sorted(manifests))
+        def array(suffix):
+            return next(n for n in manifests if n.endswith(suffix))
+        math1 = array('pipeline1_math')
+        math2 = array('pipeline2_math')
+        source1 = array('pipeline1_per_session_source')
+        source2 = array('pipeline2_per_session_source')
+        self.assertEqual(submissions[math1]['array'], '0-5')
+        self.assertEqual(len(manifests[math1]['tasks']), 6)
+        self.assertEqual(len(manifests[math2]['tasks']), 3)
+        self.assertEqual(manifests[math1]['job_id'],
+                         submissions[math1]['job_id'])
+        # Each task only depends on the corresponding task of the source
+        self.assertEqual(submissions[math1]['dependency'],
+                         'aftercorr:' + submissions[source1]['job_id'])
+        # The visits of each subject are joined, so the whole upstream array
+        # needs to complete
+        self.assertEqual(submissions[math2]['dependency'],
+                         'afterok:' + submissions[source2]['job_id'])
+        # Check that the tasks were run by the stub in place of Slurm
+        field2 = analysis.data('derived_field2')
+        self.assertEqual(field2.value(subject_id='0'), 3)
+        self.assertEqual(field2.value(subject_id='2'), 43)
+
+    def test_bundles(self):
+        analysis = self.create_analysis(
+            TestDialationAnalysis, 'bundles', inputs=self.STUDY_INPUTS,
+            processor=SlurmProc(self.work_dir, email='test@email.org',
+                                bundle_size=2, iteration='product'))
+        self.assertRaises(ArcanaJobSubmittedException, analysis.derive,
+                          'derived_field2')
+        with open(self.sbatch_log) as f:
+            submissions = {s['name']: s for s in map(json.loads, f)}
+        manifest_path, = glob(op.join(self.work_dir, '*', 'batch',
+                                      ArcanaSlurmBundlePlugin.MANIFEST_NAME))
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        self.assertEqual(sorted(submissions), sorted(manifest))
+        # The source, math and sink nodes of 2 sessions in each bundle
+        session_bundles = [b for b in manifest.values()
+                           if any(n.endswith('pipeline1_math')
+                                  for n in b['nodes'])]
+        self.assertEqual(len(session_bundles), 3)
+        self.assertTrue(all(len(b['nodes']) == 6 for b in session_bundles))
+        for name, bundle in manifest.items():
+            if bundle['dependencies']:
+                self.assertEqual(
+                    submissions[name]['dependency'],
+                    'afterok:' + ':'.join(manifest[d]['job_id']
+                                          for d in bundle['dependencies']))
+        field2 = analysis.data('derived_field2')
+        self.assertEqual(field2.value(subject_id='0'), 3)
+        self.assertEqual(field2.value(subject_id='2'), 43)
+
+    def test_bad_bundle_args(self):
+        self.assertRaises(ArcanaUsageError, SlurmProc, self.work_dir,
+                          email='test@email.org', bundle_size=1,
+                          job_arrays=True)
+        self.assertRaises(ArcanaUsageError, SlurmProc, self.work_dir,
+                          email='test@email.org', bundle_size=1,
+                          bundle_plugin='unknown')
+
+
+class TestSlurmLedger(BaseMultiSubjectTestCase):
+
+    NUM_SUBJECTS = 3
+    NUM_VISITS = 2
+    STUDY_INPUTS = [FieldFilter('acquired_field1', 'acquired_field1', int)]
+
+    input_tree = TestSlurmSubmission.input_tree
+
+    def setUp(self):
+        super(TestSlurmLedger, self).setUp()
+        # Put stub 'sbatch', 'squeue' and 'sacct' commands on the path, which
+        # don't run anything and report the job states saved in a JSON file
+        self.stub_dir = tempfile.mkdtemp()
+        self.states_path = op.join(self.stub_dir, 'states.json')
+        for cmd in ('sbatch', 'squeue', 'sacct'):
+            stub_path = op.join(self.stub_dir, cmd)
+            with open(stub_path, 'w') as f:
+                f.write(scheduler_stub.format(python=sys.executable,
+                                              states=self.states_path))
+            os.chmod(stub_path, os.stat(stub_path).st_mode | stat.S_IEXEC)
+        self.orig_environ = dict(os.environ)
+        os.environ['PATH'] = self.stub_dir + os.pathsep + os.environ['PATH']
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.orig_environ)
+        shutil.rmtree(self.stub_dir)
+
+    def set_states(self, states):
+        with open(self.states_path, 'w') as f:
+            json.dump(states, f)
+
+    def ledger_jobs(self, processor):
+        with open(processor.ledger_path('pipeline1')) as f:
+            return json.load(f)['jobs']
+
+    def test_status_and_resume(self):
+        analysis = self.create_analysis(
+            TestDialationAnalysis, 'ledger', inputs=self.STUDY_INPUTS,
+            processor=SlurmProc(self.work_dir, email='test@email.org',
+                                bundle_size=1, iteration='product'))
+        processor = analysis.processor
+        self.assertRaises(ArcanaJobSubmittedException, analysis.derive,
+                          'derived_field1')
+        jobs = self.ledger_jobs(processor)
+        # Jobs the scheduler doesn't know about
+        self.assertTrue(all(s == SlurmProc.UNKNOWN_STATE
+                            for s in processor.status().values()))
+        failed_session = ['pipeline1', '1', '0']
+        self.set_states({
+            j['job_id']: ('FAILED' if failed_session in j['sessions']
+                          else 'COMPLETED') for j in jobs})
+        status = processor.wait(poll_interval=0)
+        self.assertEqual(status[('pipeline1', '1', '0')], 'FAILED')
+        self.assertEqual(status[('pipeline1', '0', '0')], 'COMPLETED')
+        # Only the failed session should be resubmitted
+        self.assertRaises(ArcanaJobSubmittedException, processor.resume)
+        resubmitted = set(tuple(s) for j in self.ledger_jobs(processor)
+                          for s in j['sessions'] if None not in s)
+        self.assertEqual(resubmitted, {tuple(failed_session)})
+        # Jobs that are still running
+        self.set_states({j['job_id']: 'RUNNING'
+                         for j in self.ledger_jobs(processor)})
+        self.assertRaises(ArcanaError, processor.wait, poll_interval=0,
+                          timeout=0)
+        self.assertRaises(ArcanaUsageError, processor.resume)
+        # All jobs completed
+        self.set_states({j['job_id']: 'COMPLETED'
+                         for j in self.ledger_jobs(processor)})
+        processor.resume()
+        self.assertFalse(op.exists(processor.ledger_path('pipeline1')))
+
+    def test_node_jobs(self):
+        analysis = self.create_analysis(
+            TestDialationAnalysis, 'node_jobs', inputs=self.STUDY_INPUTS,
+            processor=SlurmProc(self.work_dir, email='test@email.org',
+                                iteration='product'))
+        self.assertRaises(ArcanaJobSubmittedException, analysis.derive,
+                          'derived_field1')
+        jobs = self.ledger_jobs(analysis.processor)
+        math_sessions = [tuple(j['sessions'][0]) for j in jobs
+                         if 'pipeline1_math' in j['name']]
+        self.assertEqual(sorted(math_sessions),
+                         [('pipeline1', str(s), str(v))
+                          for s in range(3) for v in range(2)])
+
+
+scheduler_stub = """#!{python}
+import os.path as op
+import sys
+import json
+cmd = op.basename(sys.argv[0])
+states_path = '{states}'
+if cmd == 'sbatch':
+    job_id_path = op.join(op.dirname(states_path), 'last_job_id')
+    job_id = int(open(job_id_path).read()) + 1 if op.exists(job_id_path) else 1000
+    with open(job_id_path, 'w') as f:
+        f.write(str(job_id))
+    print(job_id)
+else:
+    states = json.load(open(states_path)) if op.exists(states_path) else {{}}
+    requested = sys.argv[sys.argv.index('-j') + 1].split(',')
+    for job_id, state in states.items():
+        if job_id.split('_')[0] not in requested:
+            continue
+        if cmd == 'sacct' or state in ('PENDING', 'RUNNING'):
+            print(job_id + '|' + state)
+"""
+
+
+sbatch_stub = """#!{python}
+import os
+import sys
+import json
+import subprocess as sp
+args = dict(a.lstrip('-').split('=', 1) for a in sys.argv[1:]
+            if a.startswith('--') and '=' in a)
+args['name'] = sys.argv[sys.argv.index('-J') + 1]
+log = '{log}'
+num_jobs = sum(1 for _ in open(log)) if os.path.exists(log) else 0
+args['job_id'] = str(1000 + num_jobs)
+with open(log, 'a') as f:
+    f.write(json.dumps(args) + '\\n')
+if 'array' in args:
+    first, last = (int(i) for i in args['array'].split('-'))
+    for task_id in range(first, last + 1):
+        env = dict(os.environ, SLURM_ARRAY_TASK_ID=str(task_id))
+        sp.check_call(['bash', sys.argv[-1]], env=env)
+else:
+    sp.check_call(['bash', sys.argv[-1]])
+print(args['job_id'])
+"""
+
+
 ref_template = """
 #!/bin/bash
 
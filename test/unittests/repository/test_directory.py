@@ -1,14 +1,21 @@
 import os
 import os.path as op
+import tempfile
+import shutil
+import json
+import copy
+from multiprocessing import Pool
+from unittest import TestCase
 from arcana.data.file_format import text_format
 from arcana.analysis import Analysis, AnalysisMetaClass
 from arcana.data import (
     Fileset, InputFilesetSpec, FilesetSpec, Field)
 from arcana.utils.testing import BaseMultiSubjectTestCase
-from arcana.repository import Tree
+from arcana.repository import Tree, Dataset, LocalFileSystemRepo
 from future.utils import with_metaclass
 from arcana.utils.testing import BaseTestCase
 from arcana.data.file_format import FileFormat
+from arcana.pipeline.provenance import Record
 
 
 # A dummy format that contains a header
@@ -53,6 +60,230 @@ class TestLocalFileSystemRepo(BaseTestCase):
         pass
 
 
+class TestPutStrategies(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.dataset_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+        shutil.rmtree(self.dataset_dir)
+
+    def put(self, put_strategy, format=text_format, contents='contents'):
+        dataset = Dataset(self.dataset_dir,
+                          repository=LocalFileSystemRepo(
+                              put_strategy=put_strategy))
+        src_path = op.join(self.work_dir, 'output' + format.ext)
+        with open(src_path, 'w') as f:
+            f.write(contents)
+        aux_files = {}
+        for aux_name, aux_path in format.default_aux_file_paths(
+                src_path).items():
+            with open(aux_path, 'w') as f:
+                f.write(aux_name)
+            aux_files[aux_name] = aux_path
+        fileset = Fileset('derived', format, dataset=dataset,
+                          from_analysis='analysis')
+        fileset.set_path(src_path, aux_files=aux_files)
+        target_path = dataset.repository.fileset_path(fileset)
+        return src_path, target_path, fileset
+
+    def test_copy(self):
+        src_path, target_path, _ = self.put('copy')
+        with open(target_path) as f:
+            self.assertEqual(f.read(), 'contents')
+        self.assertFalse(op.samefile(src_path, target_path))
+
+    def test_link(self):
+        src_path, target_path, _ = self.put('link')
+        self.assertTrue(op.samefile(src_path, target_path))
+        # Check existing files are overwritten
+        src_path, target_path, _ = self.put('link', contents='updated')
+        with open(target_path) as f:
+            self.assertEqual(f.read(), 'updated')
+
+    def test_move(self):
+        src_path, target_path, fileset = self.put('move',
+                                                  format=with_header_format)
+        self.assertFalse(op.exists(src_path))
+        self.assertEqual(fileset.path, target_path)
+        with open(fileset.aux_file('header')) as f:
+            self.assertEqual(f.read(), 'header')
+
+    def test_auto(self):
+        src_path, target_path, _ = self.put('auto',
+                                            format=with_header_format)
+        with open(target_path) as f:
+            self.assertEqual(f.read(), 'contents')
+        with open(op.splitext(target_path)[0] + '.hdr') as f:
+            self.assertEqual(f.read(), 'header')
+        self.assertFalse(op.samefile(src_path, target_path))
+
+    def test_checksums(self):
+        for put_strategy in LocalFileSystemRepo.PUT_STRATEGIES:
+            self.tearDown()
+            self.setUp()
+            _, target_path, fileset = self.put(put_strategy,
+                                               format=with_header_format)
+            stored = Fileset(
+                'derived', with_header_format, path=target_path,
+                aux_files=with_header_format.default_aux_file_paths(
+                    target_path))
+            self.assertEqual(fileset.checksums, stored.calculate_checksums(),
+                             put_strategy)
+
+
+def put_fields_worker(args):
+    dataset_dir, worker_i, num_fields = args
+    dataset = Dataset(dataset_dir, clear_cache=False)
+    dataset.put_fields(
+        [Field('field_{}_{}'.format(worker_i, i), value=float(i),
+               frequency='per_dataset', dataset=dataset,
+               from_analysis='analysis')
+         for i in range(num_fields)])
+
+
+class TestPutFields(TestCase):
+
+    NUM_WORKERS = 8
+    NUM_FIELDS = 40
+
+    def setUp(self):
+        self.dataset_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dataset_dir)
+
+    def test_concurrent_writers(self):
+        with Pool(self.NUM_WORKERS) as pool:
+            pool.map(put_fields_worker,
+                     [(self.dataset_dir, i, self.NUM_FIELDS)
+                      for i in range(self.NUM_WORKERS * 2)])
+        dataset = Dataset(self.dataset_dir)
+        fpath = dataset.repository.fields_json_path(
+            Field('dummy', value=1.0, frequency='per_dataset',
+                  from_analysis='analysis'), dataset)
+        with open(fpath) as f:
+            dct = json.load(f)
+        self.assertEqual(len(dct), self.NUM_WORKERS * 2 * self.NUM_FIELDS)
+        self.assertEqual(dct['field_3_7'], 7.0)
+        # Check no temporary files have been left behind
+        self.assertEqual(
+            [f for f in os.listdir(op.dirname(fpath)) if f.endswith('.tmp')],
+            [])
+
+
+class TestStagedCommits(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.dataset_dir = tempfile.mkdtemp()
+        self.dataset = Dataset(self.dataset_dir)
+        self.repository = self.dataset.repository
+        self.sess_dir = op.join(self.dataset_dir, 'analysis')
+        self.staging_dir = op.join(self.sess_dir,
+                                   LocalFileSystemRepo.STAGING_DIR)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+        shutil.rmtree(self.dataset_dir)
+
+    def put_outputs(self, fail=False):
+        src_path = op.join(self.work_dir, 'output.txt')
+        with open(src_path, 'w') as f:
+            f.write('contents')
+        with self.dataset.stage('per_session', None, None, 'analysis'):
+            Fileset('derived', text_format, dataset=self.dataset,
+                    from_analysis='analysis').path = src_path
+            self.dataset.put_fields([Field('field', value=1.0,
+                                           dataset=self.dataset,
+                                           from_analysis='analysis')])
+            # Nothing should be visible until the stage is committed
+            self.assertEqual(self.found(), (set(), set(), set()))
+            if fail:
+                raise RuntimeError("Sink failed")
+            self.dataset.put_record(Record('pipeline', 'per_session', None,
+                                           None, 'analysis', {}))
+
+    def found(self):
+        filesets, fields, records = self.repository.find_data(self.dataset)
+        return (set(f.name for f in filesets), set(f.name for f in fields),
+                set(r.pipeline_name for r in records))
+
+    def test_commit(self):
+        self.put_outputs()
+        self.assertEqual(self.found(), ({'derived'}, {'field'}, {'pipeline'}))
+        self.assertFalse(op.exists(self.staging_dir))
+
+    def test_failed_stage(self):
+        self.assertRaises(RuntimeError, self.put_outputs, fail=True)
+        self.assertEqual(self.found(), (set(), set(), set()))
+        self.assertFalse(op.exists(op.join(self.sess_dir, 'derived.txt')))
+
+    def test_abandoned_stage(self):
+        # Simulate a stage left by a process that was killed before it was
+        # committed, while rerunning a pipeline
+        os.makedirs(op.join(self.sess_dir, LocalFileSystemRepo.PROV_DIR))
+        stage_dir = op.join(self.staging_dir, 'localhost_1_abc')
+        os.makedirs(stage_dir)
+        with open(op.join(stage_dir, 'derived.txt'), 'w') as f:
+            f.write('partial')
+        os.utime(stage_dir, (0, 0))
+        self.assertEqual(self.found(), (set(), set(), set()))
+        self.assertFalse(op.exists(self.staging_dir))
+
+    def test_two_instances(self):
+        # Sinks hold their own copies of the dataset, so stages in progress
+        # within the process must not be removed by other instances
+        other = copy.deepcopy(self.dataset)
+        src_path = op.join(self.work_dir, 'output.txt')
+        with open(src_path, 'w') as f:
+            f.write('contents')
+        with self.dataset.stage('per_session', None, None, 'analysis'):
+            Fileset('derived', text_format, dataset=self.dataset,
+                    from_analysis='analysis').path = src_path
+            other.repository.find_data(other)
+            self.assertEqual(len(os.listdir(self.staging_dir)), 1)
+            self.dataset.put_record(Record('pipeline', 'per_session', None,
+                                           None, 'analysis', {}))
+        self.assertEqual(self.found(), ({'derived'}, set(), {'pipeline'}))
+
+    def test_stale_heartbeat(self):
+        # Stages from other hosts are judged by the last time their owner
+        # touched the heartbeat file, not when the stage was created
+        os.makedirs(op.join(self.sess_dir, LocalFileSystemRepo.PROV_DIR))
+        live_dir = op.join(self.staging_dir, 'otherhost_1_live')
+        stale_dir = op.join(self.staging_dir, 'otherhost_1_stale')
+        for stage_dir in (live_dir, stale_dir):
+            os.makedirs(stage_dir)
+            with open(op.join(stage_dir, 'derived.txt'), 'w') as f:
+                f.write('partial')
+            open(op.join(stage_dir, LocalFileSystemRepo.HEARTBEAT_FNAME),
+                 'w').close()
+            os.utime(stage_dir, (0, 0))
+        os.utime(op.join(stale_dir, LocalFileSystemRepo.HEARTBEAT_FNAME),
+                 (0, 0))
+        self.assertEqual(self.found(), (set(), set(), set()))
+        self.assertEqual(os.listdir(self.staging_dir), ['otherhost_1_live'])
+
+    def test_roll_forward(self):
+        # Simulate a stage that was committed but not moved into place
+        stage_dir = op.join(self.staging_dir,
+                            'localhost_1_abc' + LocalFileSystemRepo.
+                            COMMITTED_SUFFIX)
+        os.makedirs(op.join(stage_dir, LocalFileSystemRepo.PROV_DIR))
+        with open(op.join(stage_dir, 'derived.txt'), 'w') as f:
+            f.write('contents')
+        with open(op.join(stage_dir, LocalFileSystemRepo.FIELDS_FNAME),
+                  'w') as f:
+            json.dump({'field': 1.0}, f)
+        Record('pipeline', 'per_session', None, None, 'analysis', {}).save(
+            op.join(stage_dir, LocalFileSystemRepo.PROV_DIR, 'pipeline.json'))
+        self.assertEqual(self.found(), ({'derived'}, {'field'}, {'pipeline'}))
+        self.assertFalse(op.exists(self.staging_dir))
+
+
 class TestDirectoryProjectInfo(BaseMultiSubjectTestCase):
     """
     This unittest tests out that extracting the existing scans and
@@ -224,3 +455,22 @@ class TestDirectoryProjectInfo(BaseMultiSubjectTestCase):
             tree, self.local_tree,
             "Generated project doesn't match reference:{}"
             .format(tree.find_mismatch(self.local_tree)))
+
+    def test_exists_array(self):
+        tree = self.local_tree
+        # Subjects and visits are rows and columns of the arrays
+        self.assertEqual(tree.exists_array('hundreds').tolist(),
+                         [[True, False], [False, False]])
+        self.assertEqual(tree.exists_array('a').tolist(),
+                         [[True, True], [False, True]])
+        # Summary items are broadcast across their rows/columns
+        self.assertEqual(
+            tree.exists_array('e', frequency='per_subject').tolist(),
+            [[True, True], [True, True]])
+        self.assertEqual(
+            tree.exists_array('ones', frequency='per_visit').tolist(),
+            [[True, False], [True, False]])
+        self.assertTrue(
+            tree.exists_array('g', frequency='per_dataset').all())
+        self.assertFalse(tree.exists_array('a', from_analysis='an').any())
+        self.assertTrue(tree.nodes_array().all())
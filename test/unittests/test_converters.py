@@ -7,7 +7,7 @@ from arcana.data.file_format import (
 from arcana.analysis.base import Analysis, AnalysisMetaClass
 from arcana.utils.testing import BaseTestCase
 from nipype.interfaces.utility import IdentityInterface
-from arcana.utils.interfaces import ZipDir
+from arcana.utils.interfaces import ZipDir, InProcessZipDir
 from future.utils import with_metaclass
 from unittest import TestCase
 
@@ -16,7 +16,7 @@ class TestConverterAvailability(TestCase):
 
     def test_find_converter(self):
         converter = zip_format.converter_from(directory_format)
-        self.assertIsInstance(converter.interface, ZipDir)
+        self.assertIsInstance(converter.interface, InProcessZipDir)
 
 
 class ConversionAnalysis(with_metaclass(AnalysisMetaClass, Analysis)):
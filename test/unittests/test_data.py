@@ -2,16 +2,20 @@ import tempfile
 import shutil
 import os
 import os.path as op
-import unittest
 from unittest import TestCase
 from nipype.interfaces.utility import IdentityInterface
 from arcana.utils.testing import BaseTestCase, BaseMultiSubjectTestCase
 from arcana.analysis.base import Analysis, AnalysisMetaClass
 from arcana.analysis.parameter import SwitchSpec
 from arcana.data import (
-    InputFilesetSpec, FilesetSpec, FieldSpec, FilesetFilter)
+    InputFilesetSpec, FilesetSpec, FieldSpec, FilesetFilter, FieldSlice)
+from arcana.data.input import unique_fileset_matches
 from arcana.data.file_format import text_format, FileFormat
-from arcana.exceptions import ArcanaDesignError, ArcanaError
+from arcana.data.item import Fileset, Field
+from arcana.repository.tree import Tree
+from arcana.exceptions import (
+    ArcanaDesignError, ArcanaError, ArcanaInputMissingMatchError,
+    ArcanaIndexError)
 from future.utils import PY2
 from future.utils import with_metaclass
 import pydicom
@@ -101,6 +105,23 @@ class TestFilesetSpecPickle(TestCase):
             self.assertEqual(obj, re_obj)
 
 
+class TestSlice(TestCase):
+
+    def test_per_session(self):
+        fields = [Field('a', value=i * 10 + j, subject_id='subject{}'.format(i),
+                        visit_id='visit{}'.format(j))
+                  for i in reversed(range(3)) for j in reversed(range(2))
+                  if (i, j) != (1, 1)]
+        slce = FieldSlice('a', fields, frequency='per_session')
+        # Items are sorted by subject and then visit ID
+        self.assertEqual([f.value for f in slce], [0, 1, 10, 20, 21])
+        # and are held by reference
+        self.assertIs(slce.item('subject2', 'visit1'), fields[0])
+        self.assertEqual(len(slce), 5)
+        with self.assertRaises(ArcanaIndexError):
+            slce.item('subject1', 'visit1')
+
+
 class TestMatchAnalysis(with_metaclass(AnalysisMetaClass, Analysis)):
 
     add_data_specs = [
@@ -116,9 +137,64 @@ class TestMatchAnalysis(with_metaclass(AnalysisMetaClass, Analysis)):
 
 class TestFilesetSelecting(BaseMultiSubjectTestCase):
 
-    @unittest.skip("Test not implemented")
+    SUBJECT_IDS = ['subject1', 'subject2', 'subject3']
+    VISIT_IDS = ['visit1', 'visit2']
+    DATASET_CONTENTS = {'scan_1': 1, 'scan_2': 2, 'other': 3}
+
+    @property
+    def input_tree(self):
+        filesets = []
+        for subj_id in self.SUBJECT_IDS:
+            for visit_id in self.VISIT_IDS:
+                names = ['scan_1', 'other']
+                # The second scan is missing from one session
+                if (subj_id, visit_id) != ('subject2', 'visit2'):
+                    names.append('scan_2')
+                for name in names:
+                    filesets.append(Fileset(name, text_format,
+                                            subject_id=subj_id,
+                                            visit_id=visit_id))
+        return Tree.construct(self.dataset.repository, filesets=filesets)
+
     def test_match_pattern(self):
-        pass
+        tree = self.dataset.tree
+        inpt = FilesetFilter('scan', 'scan_.*', text_format, is_regex=True,
+                             order=0)
+        # Matching nodes in parallel threads gives the same results as
+        # matching them serially
+        matches = inpt.match(tree, num_threads=4)
+        self.assertEqual(list(matches), list(inpt.match(tree, num_threads=1)))
+        self.assertEqual([f.name for f in matches], ['scan_1'] * 6)
+        self.assertEqual(
+            [(f.subject_id, f.visit_id) for f in matches],
+            [(s, v) for s in self.SUBJECT_IDS for v in self.VISIT_IDS])
+        matches = FilesetFilter('other', 'other', text_format).match(tree)
+        self.assertEqual([f.name for f in matches], ['other'] * 6)
+        # Errors are collated across the nodes
+        inpt = FilesetFilter('scan', 'scan_.*', text_format, is_regex=True,
+                             order=1)
+        with self.assertRaises(ArcanaInputMissingMatchError) as cm:
+            inpt.match(tree, num_threads=4)
+        self.assertIn('subject2', str(cm.exception))
+        self.assertNotIn('subject1', str(cm.exception))
+
+    def test_pattern_prefix(self):
+        self.assertEqual(
+            FilesetFilter('scan', r'scan_\d+', is_regex=True).pattern_prefix,
+            'scan_')
+        self.assertEqual(
+            FilesetFilter('scan', 'scan_1|other', is_regex=True)
+            .pattern_prefix, '')
+        self.assertEqual(
+            FilesetFilter('scan', '(?i)scan', is_regex=True).pattern_prefix,
+            '')
+        session = self.dataset.tree.session('subject1', 'visit1')
+        self.assertEqual(session.fileset_names_with_prefix('scan_'),
+                         ['scan_1', 'scan_2'])
+        # Patterns without a literal prefix are matched against every name
+        matches = FilesetFilter('scan', 'scan_2|other', text_format,
+                                is_regex=True, order=1).match_node(session)
+        self.assertEqual(matches.name, 'scan_2')
 
 
 class TestDicomTagMatch(BaseTestCase):
@@ -302,3 +378,28 @@ class TestDerivable(BaseTestCase):
             getattr,
             analysis_unhandled.spec('requires_foo'),
             'derivable')
+
+
+class TestCacheInputs(BaseTestCase):
+
+    INPUT_FILESETS = {'required': 'blah'}
+
+    def test_unique_matches(self):
+        analysis = self.create_analysis(
+            TestDerivableAnalysis,
+            'analysis',
+            inputs=[FilesetFilter('required', 'required', text_format),
+                    FilesetFilter('optional', 'required', text_format)])
+        matches = unique_fileset_matches(
+            analysis.bound_spec(i) for i in analysis.inputs)
+        self.assertEqual(len(matches), 1)
+        self.assertEqual(matches[0].name, 'required')
+
+    def test_cache_inputs(self):
+        analysis = self.create_analysis(
+            TestDerivableAnalysis,
+            'analysis',
+            inputs=[FilesetFilter('required', 'required', text_format),
+                    FilesetFilter('optional', 'required', text_format)])
+        self.assertEqual(
+            analysis.cache_inputs(num_threads=2, show_progress=False), [])